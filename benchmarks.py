@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+"""
+benchmarks.py - times the modem, display and LED hot paths against the fake hardware, and compares runs.
+
+Each case runs one call (e.g. GPSModem.get_gps against a fake_modem.FakeModem, or oled_putString through grove_bus
+to a fake_i2c.FakeSSD1327) over and over, and records per call:
+
+    cpu_us          CPU time in microseconds, the best of several repeats
+    cpu_us_median   the median of the repeats
+    alloc_bytes     the most memory allocated at once during a call (needs tracemalloc, Python 3)
+    retained_bytes  memory still allocated after the call, averaged over several calls
+    ops             hardware operations counted by the fakes: serial commands and bytes, I2C transactions and bytes,
+                    GPIO writes
+
+Logging is turned off while the cases run, so the times are the code's own. The results are written as JSON and two
+runs can be compared; CPU time has to grow by more than the threshold to count as a regression (it is noisy), memory
+by more than 10% and 64 bytes, and any extra hardware operation counts.
+
+    python benchmarks.py                                run everything, writing benchmarks.json
+    python benchmarks.py run -o after.json -k oled      only the cases with 'oled' in their name
+    python benchmarks.py compare before.json after.json exits with 1 if anything regressed
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+_cpu = getattr(time, 'process_time', None) or time.clock
+
+# Results format, bumped when a field changes meaning
+VERSION = 1
+
+# (metric, relative increase, absolute increase) that must both be exceeded to count as a regression
+THRESHOLDS = [('cpu_us', 0.25, 1.0), ('alloc_bytes', 0.10, 64), ('retained_bytes', 0.10, 64)]
+
+CASES = collections.OrderedDict()
+
+# A text mode PDU from AT+CMGR=1, the user data of which starts at character 54
+PDU = '07914180835760F0040B914180835760F000008121316101722B0FC8329BFD065DDF723619D4026501'
+
+
+def case(name):
+    """
+    Registers a case. The decorated function sets it up and returns ``(call, counters)``: the function to time, and
+    one that returns the fakes' cumulative operation counts as a dict.
+    """
+    def register(setup):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+def _emptying(call, *recorded):
+    """
+    ``call``, followed by emptying the lists the fakes record what was sent in, which would otherwise grow through the
+    run and show up in the memory figures
+    """
+    def run():
+        result = call()
+        for items in recorded:
+            del items[:]
+        return result
+    return run
+
+
+def _modem():
+    import fake_modem
+    import gps_modem
+    fake = fake_modem.FakeModem()
+    return fake, gps_modem.GPSModem(fake, probe=False)
+
+
+def _modem_case(fake, call):
+    commands = [0]
+
+    def run():
+        result = call()
+        commands[0] += len(fake.commands)
+        del fake.commands[:]
+        return result
+    return run, lambda: {'serial_commands': commands[0], 'serial_bytes': fake.bytes_sent + fake.bytes_received}
+
+
+@case('gps_modem.get_gps')
+def _get_gps():
+    fake, modem = _modem()
+    return _modem_case(fake, modem.get_gps)
+
+
+@case('gps_modem.get_cell_monitor')
+def _get_cell_monitor():
+    fake, modem = _modem()
+    return _modem_case(fake, modem.get_cell_monitor)
+
+
+@case('gps_modem.pop_message')
+def _pop_message():
+    fake, modem = _modem()
+
+    def call():
+        fake.inbox.append(('+14155550199', 'What is the temperature?'))
+        return modem.pop_message()
+    return _modem_case(fake, call)
+
+
+@case('gps_modem.unpack_msg')
+def _unpack_msg():
+    fake, modem = _modem()
+    pdu = PDU[54:]
+    return lambda: modem.unpack_msg(pdu), lambda: {}
+
+
+def _serial_mutex():
+    import fake_modem
+    import serial_mutex
+    port = fake_modem.FakeSerial()
+    return port, serial_mutex.SerialMutex(port)
+
+
+@case('serial_mutex.write_')
+def _write():
+    port, ser = _serial_mutex()
+
+    def counters():
+        return {'serial_writes': port.writes, 'serial_reads': port.reads,
+                'serial_bytes': port.bytes_written + port.bytes_read}
+    # Without the fixed sleep, which would be the whole of the time
+    return _emptying(lambda: ser.write_('AT+QGPSLOC?\r', 0), port.modem.commands), counters
+
+
+@case('serial_mutex.make_pdu')
+def _make_pdu():
+    port, ser = _serial_mutex()
+    return lambda: ser.make_pdu('4155157916', 'What is the temperature?'), lambda: {}
+
+
+@case('serial_mutex.encode_address')
+def _encode_address():
+    port, ser = _serial_mutex()
+    return lambda: ser.encode_address('4155157916', []), lambda: {}
+
+
+def _oled():
+    import fake_i2c
+    import grove_bus
+    import grove_oled
+    grove_bus.reset()
+    bus = fake_i2c.FakeSMBus()
+    device = bus.attach(grove_oled.Oled_Address, fake_i2c.FakeSSD1327())
+    grove_bus.set_smbus(bus, grove_oled.Oled_Bus)
+    grove_oled.oled_init()
+    return grove_oled, device, lambda: {'i2c_transactions': bus.transactions, 'i2c_bytes': bus.bytes}
+
+
+@case('grove_oled.oled_putChar')
+def _put_char():
+    grove_oled, device, counters = _oled()
+    grove_oled.oled_setTextXY(0, 0)
+    return _emptying(lambda: grove_oled.oled_putChar('A'), device.commands), counters
+
+
+@case('grove_oled.oled_putString')
+def _put_string():
+    grove_oled, device, counters = _oled()
+
+    def call():
+        # A line of the status screen, the way boot_display updates one
+        grove_oled.oled_setTextXY(9, 0)
+        grove_oled.oled_putString('Registering ')
+    return _emptying(call, device.commands), counters
+
+
+@case('grove_led.ChainableLED.setColorRGB')
+def _set_color_rgb():
+    import fake_gpio
+    import grove_led
+    gpio = fake_gpio.FakeGPIO(grove_led.CLK_PIN, grove_led.DATA_PIN)
+    leds = 8
+    led = grove_led.ChainableLED(grove_led.CLK_PIN, grove_led.DATA_PIN, leds, gpio=gpio)
+    count = [0]
+
+    def call():
+        # A different color every time, so every call sends a frame
+        n = count[0] = count[0] + 1
+        led.setColorRGB(n % leds, n % 256, 255 - n % 256, 0)
+    return _emptying(call, gpio.bits), lambda: {'gpio_writes': gpio.outputs}
+
+
+def _allocations(call, calls=10):
+    """(most bytes allocated at once during a call, bytes retained per call), or (None, None) without tracemalloc"""
+    if tracemalloc is None:
+        return None, None
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        call()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        for n in range(calls - 1):
+            call()
+        retained = (tracemalloc.get_traced_memory()[0] - base) / float(calls)
+    finally:
+        tracemalloc.stop()
+    return peak, round(retained, 1)
+
+
+def measure(setup, min_time=0.5, repeats=5):
+    """Runs one case, returning its results"""
+    call, counters = setup()
+    call()
+    # Enough calls per repeat that each repeat takes about min_time / repeats
+    calls = 1
+    while True:
+        start = _cpu()
+        for n in range(calls):
+            call()
+        elapsed = _cpu() - start
+        if elapsed >= min_time / repeats or calls >= 1 << 20:
+            break
+        calls *= 2
+    times = []
+    before = counters()
+    for r in range(repeats):
+        start = _cpu()
+        for n in range(calls):
+            call()
+        times.append((_cpu() - start) / calls)
+    after = counters()
+    total = float(calls * repeats)
+    ops = dict((name, round((after[name] - before[name]) / total, 3)) for name in after)
+    alloc, retained = _allocations(call)
+    times.sort()
+    return {
+        'calls': calls * repeats,
+        'cpu_us': round(times[0] * 1e6, 3),
+        'cpu_us_median': round(times[len(times) // 2] * 1e6, 3),
+        'alloc_bytes': alloc,
+        'retained_bytes': retained,
+        'ops': ops,
+    }
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names=None, min_time=0.5):
+    """Runs the cases whose name contains one of ``names`` (all of them by default) and returns the results"""
+    results = collections.OrderedDict()
+    logging.disable(logging.CRITICAL)
+    try:
+        for name, setup in CASES.items():
+            if names and not any(n in name for n in names):
+                continue
+            results[name] = measure(setup, min_time)
+            _print_result(name, results[name])
+    finally:
+        logging.disable(logging.NOTSET)
+    return {
+        'version': VERSION,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def _print_result(name, result):
+    ops = ', '.join('%s %g' % (op, count) for op, count in sorted(result['ops'].items()))
+    print("%-36s %9.2f us %8s B peak %8s B retained  %s" % (
+        name, result['cpu_us'], result['alloc_bytes'] if result['alloc_bytes'] is not None else '-',
+        result['retained_bytes'] if result['retained_bytes'] is not None else '-', ops))
+
+
+def compare(old, new, cpu_threshold=None):
+    """
+    Compares two runs' results, returning ``(regressions, improvements)``: lists of (case, metric, old, new) for
+    metrics that got worse or better by more than their threshold, and for every change in hardware operations
+    """
+    thresholds = [(metric, cpu_threshold if metric == 'cpu_us' and cpu_threshold is not None else relative,
+                   absolute) for metric, relative, absolute in THRESHOLDS]
+    regressions = []
+    improvements = []
+    for name, after in new['results'].items():
+        before = old['results'].get(name)
+        if before is None:
+            continue
+        for metric, relative, absolute in thresholds:
+            a, b = before.get(metric), after.get(metric)
+            if a is None or b is None:
+                continue
+            if b > a * (1 + relative) and b - a > absolute:
+                regressions.append((name, metric, a, b))
+            elif b < a * (1 - relative) and a - b > absolute:
+                improvements.append((name, metric, a, b))
+        for op in sorted(set(before['ops']) | set(after['ops'])):
+            a, b = before['ops'].get(op, 0), after['ops'].get(op, 0)
+            if b > a:
+                regressions.append((name, op, a, b))
+            elif b < a:
+                improvements.append((name, op, a, b))
+    return regressions, improvements
+
+
+def _load(path):
+    with open(path) as f:
+        results = json.load(f)
+    if results.get('version') != VERSION:
+        raise ValueError("%s has results version %s, expected %d" % (path, results.get('version'), VERSION))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the hot paths against fake hardware")
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help="run the cases and write the results")
+    run_parser.add_argument('-o', '--output', default='benchmarks.json', help="where to write the results")
+    run_parser.add_argument('-k', '--keyword', action='append', help="only run cases with this in their name")
+    run_parser.add_argument('--min-time', type=float, default=0.5, help="seconds of CPU time to spend per case")
+    commands.add_parser('list', help="list the cases")
+    compare_parser = commands.add_parser('compare', help="compare two runs, exiting with 1 if anything regressed")
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=None,
+                                help="relative CPU time increase that counts as a regression (default %.2f)" %
+                                     THRESHOLDS[0][1])
+    args = parser.parse_args(argv if argv is not None else sys.argv[1:] or ['run'])
+
+    if args.command == 'list':
+        for name in CASES:
+            print(name)
+        return 0
+
+    if args.command == 'run':
+        results = run(args.keyword, args.min_time)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Results written to %s" % args.output)
+        return 0
+
+    old, new = _load(args.old), _load(args.new)
+    regressions, improvements = compare(old, new, args.threshold)
+    print("%s (%s) -> %s (%s)" % (args.old, old.get('commit'), args.new, new.get('commit')))
+    for label, changes in (('REGRESSION', regressions), ('improved', improvements)):
+        for name, metric, a, b in changes:
+            change = '%+.0f%%' % ((b - a) * 100.0 / a) if a else 'new'
+            print("%-10s %-36s %-16s %10g -> %-10g %s" % (label, name, metric, a, b, change))
+    missing = [name for name in old['results'] if name not in new['results']]
+    if missing:
+        print("not in %s: %s" % (args.new, ', '.join(missing)))
+    print("%d regressions, %d improvements" % (len(regressions), len(improvements)))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
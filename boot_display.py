@@ -1,53 +1,337 @@
 #!/usr/bin/env python
 """
 boot_display.py - This script will display the IP address on the OLED Grove Display after the device has booted.
+
+The modem library is only imported once the first screen is up, so the display shows signs of life as early as
+possible. The eth0 address is shown straight away, while the modem is brought up on a background thread one stage at
+a time, each painted on the display as it completes:
+
+    modem       the modem answers and is fully functional
+    registered  the modem is registered on the network
+    pdp         the PDP context is up, and the cell IP address is shown
+    phone       the phone number is shown
+    ready       SMS and GPS are set up
+
+A stage that fails (the modem is not up yet, the network is still being searched for) is tried again every few
+seconds until the deadline. Each stage is logged with its time since the script started and since the kernel booted,
+then the whole timeline as one line of JSON, to track time to connected across devices.
+
+``python boot_display.py bench`` measures the import time and time to first pixel against a fake display, and how soon
+the modem details are shown against a fake modem.
 """
+import time
+
+START = time.time()
 
 import grove_oled
-import gps_modem
+import json
+import logging
 import socket
 import fcntl
 import struct
+import threading
 
+_monotonic = getattr(time, 'monotonic', time.time)
 
-def main():
+MODEM = 'modem'
+REGISTERED = 'registered'
+PDP = 'pdp'
+PHONE = 'phone'
+READY = 'ready'
+FAILED = 'failed'
+
+# What the status line shows once a stage is done, which is the stage being worked on next
+STATUS = {
+    MODEM: "Registering",
+    REGISTERED: "PDP...",
+    PDP: "Phone...",
+    PHONE: "SMS/GPS...",
+    READY: "Ready",
+    FAILED: "No modem",
+}
+
+COLUMNS = grove_oled.Width // 8
+STATUS_ROW = 9
+
+_paint_lock = threading.Lock()
+
+
+def uptime():
+    """Seconds since the kernel booted, or None if /proc/uptime can not be read"""
+    try:
+        with open('/proc/uptime') as f:
+            return float(f.read().split()[0])
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Timeline(object):
+    """When each boot stage completed, in seconds since ``start``"""
+    def __init__(self, start=None, clock=None):
+        self.logger = logging.getLogger('boot_display')
+        self.clock = clock or time.time
+        self.start = start if start is not None else self.clock()
+        self.stages = []
+        self.lock = threading.Lock()
+
+    def mark(self, stage, detail=None, attempts=1):
+        elapsed = self.clock() - self.start
+        entry = {'stage': stage, 'elapsed': round(elapsed, 3), 'uptime': uptime(), 'attempts': attempts}
+        if detail is not None:
+            entry['detail'] = detail
+        with self.lock:
+            self.stages.append(entry)
+        self.logger.info("[boot_display] %s after %.1fs (%d attempt%s)%s", stage, elapsed, attempts,
+                         's' if attempts > 1 else '', ': %s' % detail if detail is not None else '')
+        return elapsed
+
+    def elapsed(self, stage):
+        """Seconds from the start to ``stage``, or None if it has not completed"""
+        with self.lock:
+            for entry in self.stages:
+                if entry['stage'] == stage:
+                    return entry['elapsed']
+        return None
+
+    def log(self):
+        with self.lock:
+            self.logger.info("[boot_display] Boot timeline: %s", json.dumps(self.stages, sort_keys=True))
+
+
+class ModemBoot(object):
+    def __init__(self, ser=None, timeline=None, retry_interval=2.0, deadline=300.0, clock=None, sleep=None):
+        """
+        :param ser:             passed to GPSModem, None for the modem on /dev/ttyS4
+        :param timeline:        the Timeline to mark each stage in
+        :param retry_interval:  seconds to wait before trying a stage that failed again
+        :param deadline:        seconds after which a modem that is still not up is given up on
+        """
+        self.logger = logging.getLogger('boot_display')
+        self.ser = ser
+        self.clock = clock or _monotonic
+        self.sleep = sleep or time.sleep
+        self.timeline = timeline if timeline is not None else Timeline(clock=self.clock)
+        self.retry_interval = retry_interval
+        self.deadline = deadline
+        self.modem = None
+        self.values = {}
+        self.error = None
+        self.listeners = []
+        self.done = threading.Event()
+        self._thread = None
+
+    def add_listener(self, callback):
+        """
+        Registers ``callback(stage, value)``, called on the boot thread as each stage completes, with the cell IP
+        for PDP and the phone number for PHONE. If the modem does not come up it is called with FAILED and the error.
+        """
+        self.listeners.append(callback)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.run, name='boot_display')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        """Waits for the modem to be ready, or given up on. Returns True if it is ready."""
+        self.done.wait(timeout)
+        return READY in self.values
+
+    def run(self):
+        """Runs the stages in order on the calling thread"""
+        stages = [(MODEM, self._modem), (REGISTERED, self._registered), (PDP, self._pdp), (PHONE, self._phone),
+                  (READY, self._ready)]
+        give_up = self.clock() + self.deadline
+        try:
+            for stage, function in stages:
+                attempts = 0
+                while True:
+                    attempts += 1
+                    try:
+                        value = function()
+                        break
+                    except Exception as ex:
+                        if self.clock() + self.retry_interval > give_up:
+                            raise IOError("%s failed after %d attempts: %s" % (stage, attempts, ex))
+                        self.logger.warning("[boot_display] %s not ready yet (attempt %d): %s", stage, attempts, ex)
+                        self.sleep(self.retry_interval)
+                self.values[stage] = value
+                self.timeline.mark(stage, value, attempts)
+                self._notify(stage, value)
+        except IOError as ex:
+            self.error = str(ex)
+            self.logger.error("[boot_display] Gave up on the modem: %s", ex)
+            self.timeline.mark(FAILED, self.error)
+            self._notify(FAILED, self.error)
+        finally:
+            self.done.set()
+
+    def _notify(self, stage, value):
+        for callback in self.listeners:
+            try:
+                callback(stage, value)
+            except Exception as ex:
+                self.logger.exception("[boot_display] Listener failed on %s: %s", stage, ex)
+
+    def _modem(self):
+        if self.modem is None:
+            import gps_modem
+            self.modem = gps_modem.GPSModem(self.ser, probe=False)
+        self.modem.is_ok()
+        self.modem.set_verbose_error()
+        self.modem.test_cfun()
+
+    def _registered(self):
+        self.modem.test_cereg()
+        self.modem.test_qcsq()
+
+    def _pdp(self):
+        self.modem.test_qiact(0)
+        return self.modem.get_ip()
+
+    def _phone(self):
+        return self.modem.get_phone_number()
+
+    def _ready(self):
+        self.modem.test_sms_service()
+        self.modem.test_gps()
+        self.modem.set_text_mode()
+
+
+def show_hello():
     grove_oled.oled_init()
     grove_oled.oled_setNormalDisplay()
     grove_oled.oled_clearDisplay()
     grove_oled.oled_setTextXY(0, 0)
     grove_oled.oled_putString("Hello...")
+    return time.time() - START
 
-    hostname = socket.gethostname()
 
+def paint(row, text):
+    """Writes ``text`` on a row of the display, blanking the rest of the row. Safe to call from any thread."""
+    with _paint_lock, grove_oled.oled_hold():
+        grove_oled.oled_setTextXY(row, 0)
+        grove_oled.oled_putString(text[:COLUMNS].ljust(COLUMNS))
+
+
+def show_stage(stage, value):
+    if stage == PDP:
+        paint(6, "Cell IP:")
+        paint(7, value)
+    elif stage == PHONE:
+        paint(3, "Phone:")
+        paint(4, value)
+    paint(STATUS_ROW, STATUS[stage])
+
+
+def local_ip(interface='eth0'):
+    """The IPv4 address of ``interface``, or None if it does not have one yet"""
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    ip = socket.inet_ntoa(fcntl.ioctl(s.fileno(), 0x8915,  struct.pack('256s', 'eth0'[:15]))[20:24])
+    try:
+        return socket.inet_ntoa(fcntl.ioctl(s.fileno(), 0x8915, struct.pack('256s', interface[:15].encode()))[20:24])
+    except IOError:
+        return None
+    finally:
+        s.close()
+
+
+def main():
+    first_pixel = show_hello()
+    print("First pixel after %.3fs" % first_pixel)
+    logging.basicConfig(format='%(asctime)-15s %(message)s', level=logging.INFO)
+
+    timeline = Timeline(START)
+    timeline.mark('display')
+
+    # The modem takes the longest, so it gets going before anything else
+    paint(STATUS_ROW, "Modem...")
+    boot = ModemBoot(timeline=timeline)
+    boot.add_listener(show_stage)
+    boot.start()
+
+    hostname = socket.gethostname()
+    ip = local_ip()
 
     print("Computer Name: " + hostname)
-    print("Computer IP Address: " + ip)
+    print("Computer IP Address: %s" % ip)
 
-    grove_oled.oled_setTextXY(0, 0)
-    grove_oled.oled_putString("IP:       ")
-    grove_oled.oled_setTextXY(1, 0)
-    grove_oled.oled_putString(ip)
+    paint(0, "IP:")
+    paint(1, ip or "No eth0")
+    timeline.mark('ip', ip)
+
+    boot.wait()
+    timeline.log()
 
-    # First we need initialize our modem so that we get our IMSI
 
-    modem = gps_modem.GPSModem()
-    phone = modem.get_phone_number()
-    cell_ip = modem.get_ip()
+def benchmark():
+    # Each measurement runs in a fresh interpreter, since the modules are already imported here
+    import subprocess
+    import sys
+
+    def run(code):
+        return float(subprocess.check_output([sys.executable, '-c', code]).decode().strip())
+
+    imports = run("import time; s = time.time(); import boot_display; print(time.time() - s)")
+    modem = run("import time; s = time.time(); import gps_modem; print(time.time() - s)")
+    first_pixel = run("import time; s = time.time(); import grove_bus, fake_i2c; "
+                      "grove_bus.set_i2c_device(fake_i2c.FakeSSD1327(), 0x3c, 2); "
+                      "import boot_display; boot_display.show_hello(); print(time.time() - s)")
+    print("import boot_display: %.1f ms" % (imports * 1000))
+    print("import gps_modem (deferred until after the first screen): %.1f ms" % (modem * 1000))
+    print("time to first pixel: %.1f ms, of which oled_init sleeps 100 ms" % (first_pixel * 1000))
+
+    # Time until the modem details are on the display, constructing GPSModem() the way main used to and through
+    # ModemBoot, with the modem already registered and straight after it powers up (20 seconds before it registers).
+    # Simulated time runs 20 times faster than real time.
+    import fake_i2c
+    import fake_modem
+    import gps_modem
+    import grove_bus
+
+    logging.basicConfig(level=logging.CRITICAL)
+    grove_bus.set_i2c_device(fake_i2c.FakeSSD1327(), grove_oled.Oled_Address, grove_oled.Oled_Bus)
+    grove_oled.oled_init()
+
+    class ScaledClock(object):
+        scale = 20.0
 
-    print("Setting display. Phone: {} IP: {}".format(phone, cell_ip))
+        def time(self):
+            return _monotonic() * self.scale
 
-    grove_oled.oled_setTextXY(3, 0)
-    grove_oled.oled_putString("Phone:   ")
-    grove_oled.oled_setTextXY(4, 0)
-    grove_oled.oled_putString(phone)
+        def sleep(self, seconds):
+            time.sleep(seconds / self.scale)
 
-    grove_oled.oled_setTextXY(6, 0)
-    grove_oled.oled_putString("Cell IP:")
-    grove_oled.oled_setTextXY(7, 0)
-    grove_oled.oled_putString(cell_ip)
+    for cold in (False, True):
+        state = 'cold modem' if cold else 'registered'
+        for name in ('GPSModem()', 'ModemBoot'):
+            clock = ScaledClock()
+            fake = fake_modem.FakeModem(clock=clock)
+            if cold:
+                fake.context = False
+                fake._registered_at = clock.time() + fake.attach_time
+            stime = clock.time()
+            if name == 'GPSModem()':
+                try:
+                    modem = gps_modem.GPSModem(fake)
+                    show_stage(PDP, modem.get_ip())
+                    show_stage(PHONE, modem.get_phone_number())
+                    print("%-10s %-10s cell IP and phone shown after %5.1fs" % (name, state, clock.time() - stime))
+                except IOError as ex:
+                    print("%-10s %-10s failed after %5.1fs: %s" % (name, state, clock.time() - stime, ex))
+                continue
+            boot = ModemBoot(fake, Timeline(stime, clock.time), clock=clock.time, sleep=clock.sleep)
+            boot.add_listener(show_stage)
+            boot.start()
+            boot.wait()
+            print("%-10s %-10s %s" % (name, state, ', '.join('%s %.1fs' % (entry['stage'], entry['elapsed'])
+                                                             for entry in boot.timeline.stages)))
 
 
 if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+        sys.exit(0)
     main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+fake_gpio.py - a stand-in for Adafruit_BBIO.GPIO, so bit-banged devices like the chainable LED can run and be
+benchmarked without a BeagleBone.
+
+FakeGPIO counts the output calls, and records the data pin on every rising edge of the clock pin, so the bits a
+device would have clocked in can be checked. FakeDHT22 stands in for the Adafruit_DHT module.
+"""
+import time
+
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+
+
+class FakeGPIO(object):
+    OUT = OUT
+    IN = IN
+    LOW = LOW
+    HIGH = HIGH
+
+    def __init__(self, clk_pin="P9_14", data_pin="P9_16"):
+        self.clk_pin = clk_pin
+        self.data_pin = data_pin
+        self.levels = {}
+        self.modes = {}
+        self.outputs = 0
+        self.bits = []
+
+    def reset_counters(self):
+        self.outputs = 0
+        self.bits = []
+
+    def setup(self, pin, mode):
+        self.modes[pin] = mode
+        self.levels.setdefault(pin, LOW)
+
+    def output(self, pin, value):
+        self.outputs += 1
+        value = HIGH if value else LOW
+        if pin == self.clk_pin and value == HIGH and self.levels.get(pin) == LOW:
+            self.bits.append(self.levels.get(self.data_pin, LOW))
+        self.levels[pin] = value
+
+    def input(self, pin):
+        return self.levels.get(pin, LOW)
+
+    def clocked_bytes(self):
+        """The clocked-in bits as bytes, most significant bit first"""
+        data = bytearray()
+        for i in range(0, len(self.bits) - 7, 8):
+            byte = 0
+            for bit in self.bits[i:i + 8]:
+                byte = (byte << 1) | bit
+            data.append(byte)
+        return data
+
+    def p9813_colors(self):
+        """
+        The (red, green, blue) each LED of a P9813 chain was last sent. Every frame is 32 zero bits, then 32 bits per
+        LED starting with two 1 bits, then 32 more zero bits.
+        """
+        data = self.clocked_bytes()
+        colors = []
+        frame = []
+        i = 0
+        while i + 4 <= len(data):
+            word = data[i:i + 4]
+            if word[0] & 0xC0 == 0xC0:
+                frame.append((word[3], word[2], word[1]))
+            elif frame:
+                colors = frame
+                frame = []
+            i += 4
+        return colors
+
+
+class FakeLines(object):
+    """A libgpiod line bulk requested as [clk, data] outputs, recording the data line on rising clock edges"""
+    def __init__(self):
+        self.values = [1, 0]
+        self.calls = 0
+        self.bits = []
+
+    def set_values(self, values):
+        self.calls += 1
+        if values[0] and not self.values[0]:
+            self.bits.append(values[1])
+        self.values = list(values)
+
+    def get_values(self):
+        return list(self.values)
+
+    def release(self):
+        pass
+
+
+class FakeRegisters(object):
+    """
+    An AM335x GPIO bank's registers as 32-bit words, for gpio_backend.MmapBackend: writes to SETDATAOUT and
+    CLEARDATAOUT change DATAOUT, and the data bit is recorded on rising clock edges
+    """
+    OE = 0x134 >> 2
+    DATAOUT = 0x13C >> 2
+    CLEARDATAOUT = 0x190 >> 2
+    SETDATAOUT = 0x194 >> 2
+
+    def __init__(self, clk_mask, data_mask):
+        self.clk_mask = clk_mask
+        self.data_mask = data_mask
+        self.words = {self.OE: 0xFFFFFFFF, self.DATAOUT: 0}
+        self.writes = 0
+        self.bits = []
+
+    def __getitem__(self, index):
+        return self.words.get(index, 0)
+
+    def __setitem__(self, index, value):
+        self.writes += 1
+        before = self.words[self.DATAOUT]
+        if index == self.SETDATAOUT:
+            after = before | value
+        elif index == self.CLEARDATAOUT:
+            after = before & ~value
+        else:
+            self.words[index] = value
+            return
+        if after & self.clk_mask and not before & self.clk_mask:
+            self.bits.append(1 if after & self.data_mask else 0)
+        self.words[self.DATAOUT] = after
+
+
+class FakeDHT22(object):
+    """
+    The Adafruit_DHT read and read_retry functions for a DHT22 that reads ``humidity`` and ``temperature``, taking
+    ``read_time`` seconds per attempt, with every ``fail_every``-th attempt failing the way a missed bit does
+    """
+    DHT22 = 22
+
+    def __init__(self, humidity=45.0, temperature=23.7, read_time=0.025, fail_every=0, sleep=None):
+        self.humidity = humidity
+        self.temperature = temperature
+        self.read_time = read_time
+        self.fail_every = fail_every
+        self.sleep = sleep or time.sleep
+        self.attempts = 0
+
+    def read(self, sensor, pin):
+        self.attempts += 1
+        self.sleep(self.read_time)
+        if self.fail_every and self.attempts % self.fail_every == 0:
+            return None, None
+        return self.humidity, self.temperature
+
+    def read_retry(self, sensor, pin, retries=15, delay_seconds=2):
+        for n in range(retries):
+            humidity, temperature = self.read(sensor, pin)
+            if humidity is not None and temperature is not None:
+                return humidity, temperature
+            self.sleep(delay_seconds)
+        return None, None
@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+"""
+fake_i2c.py - I2C devices that stand in for the Grove hardware on bus 2, so display and sensor code can run and be
+benchmarked without a BeagleBone.
+
+FakeI2CDevice has the Adafruit_GPIO.I2C.Device methods that grove_oled uses and counts the transactions and bytes
+sent. FakeSSD1327 also interprets the commands and data the way the OLED controller does, so what would be on the glass
+can be checked.
+
+FakeSMBus stands in for smbus.SMBus, passing each transfer to a fake device such as FakeADXL345, a register map that
+makes samples in simulated time, or FakeSHT31, which answers the SHT3x commands.
+"""
+import struct
+import threading
+
+
+class FakeI2CDevice(object):
+    def __init__(self, address=0x3c, busnum=2, clock_hz=100000):
+        self.address = address
+        self.busnum = busnum
+        self.clock_hz = clock_hz
+        self.transactions = 0
+        self.bytes = 0
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes = 0
+
+    def bus_time(self):
+        """
+        Seconds the counted traffic would keep the bus busy: 9 clocks per byte (address byte included), plus start and
+        stop conditions per transaction
+        """
+        return (self.transactions * (9 + 2) + self.bytes * 9) / float(self.clock_hz)
+
+    def _transfer(self, register, data):
+        self.transactions += 1
+        self.bytes += 1 + len(data)
+        self.received(register, data)
+
+    def received(self, register, data):
+        """Called with every write, override to emulate the device"""
+        pass
+
+    def write8(self, register, value):
+        self._transfer(register, [value & 0xFF])
+
+    def writeList(self, register, data):
+        self._transfer(register, data)
+
+    def readU8(self, register):
+        self.transactions += 1
+        self.bytes += 2
+        return 0
+
+    def readList(self, register, length):
+        self.transactions += 1
+        self.bytes += 1 + length
+        return bytearray(length)
+
+    # The FakeSMBus device interface, to attach the device to a fake bus
+
+    def write(self, register, data):
+        self._transfer(register, data)
+
+    def read(self, register, length):
+        return [0] * length
+
+
+# Number of argument bytes following each SSD1327 command
+_SSD1327_ARGS = {
+    0x15: 2, 0x75: 2, 0x81: 1, 0xA0: 1, 0xA1: 1, 0xA2: 1, 0xA8: 1, 0xAB: 1, 0xB1: 1, 0xB3: 1, 0xB6: 1, 0xB8: 15,
+    0xBC: 1, 0xBE: 1, 0xD5: 1, 0xFD: 1,
+}
+
+
+class FakeSSD1327(FakeI2CDevice):
+    """The Grove 96x96 OLED: 128x128 4-bit GDDRAM, two pixels per byte, of which columns 8-55 and 96 rows show"""
+    def __init__(self, address=0x3c, busnum=2, clock_hz=100000):
+        super(FakeSSD1327, self).__init__(address, busnum, clock_hz)
+        self.ram = bytearray(64 * 128)
+        self.col_start, self.col_end = 0, 63
+        self.row_start, self.row_end = 0, 127
+        self.col, self.row = 0, 0
+        self.remap = 0x00
+        self.start_line = 0
+        self.offset = 0
+        self.commands = []
+        self._pending = []
+
+    def received(self, register, data):
+        if register in (0x80, 0x00):
+            for byte in data:
+                self._command(byte)
+        elif register in (0x40, 0xC0):
+            for byte in data:
+                self._data(byte)
+
+    def _command(self, byte):
+        if self._pending:
+            self._pending[1].append(byte)
+        else:
+            self._pending = [byte, []]
+        cmd, args = self._pending
+        if len(args) < _SSD1327_ARGS.get(cmd, 0):
+            return
+        self._pending = []
+        self.commands.append(cmd)
+        if cmd == 0x15:
+            self.col_start, self.col_end = args[0] & 0x3F, args[1] & 0x3F
+            self.col = self.col_start
+        elif cmd == 0x75:
+            self.row_start, self.row_end = args[0] & 0x7F, args[1] & 0x7F
+            self.row = self.row_start
+        elif cmd == 0xA0:
+            self.remap = args[0]
+        elif cmd == 0xA1:
+            self.start_line = args[0] & 0x7F
+        elif cmd == 0xA2:
+            self.offset = args[0] & 0x7F
+
+    def _data(self, byte):
+        self.ram[self.row * 64 + self.col] = byte
+        if self.remap & 0x04:
+            # Vertical address increment
+            self.row += 1
+            if self.row > self.row_end:
+                self.row = self.row_start
+                self.col = self.col_start if self.col >= self.col_end else self.col + 1
+        else:
+            self.col += 1
+            if self.col > self.col_end:
+                self.col = self.col_start
+                self.row = self.row_start if self.row >= self.row_end else self.row + 1
+
+    def pixel(self, x, y):
+        """Gray level (0-15) of the visible pixel at x, y, taking the display start line into account"""
+        byte = self.ram[((y + self.start_line) % 128) * 64 + 8 + x // 2]
+        return byte >> 4 if x % 2 == 0 else byte & 0x0F
+
+    def screen(self):
+        """The 96 visible rows as strings, '#' for lit pixels"""
+        return [''.join('#' if self.pixel(x, y) else '.' for x in range(96)) for y in range(96)]
+
+
+class FakeI2CMsg(object):
+    """An smbus2.i2c_msg stand-in: a write of ``buf`` or a read of ``len`` bytes"""
+    def __init__(self, addr, read, buf):
+        self.addr = addr
+        self.read_msg = read
+        self.buf = buf
+        self.len = len(buf)
+
+    @classmethod
+    def write(cls, addr, data):
+        return cls(addr, False, list(data))
+
+    @classmethod
+    def read(cls, addr, length):
+        return cls(addr, True, [0] * length)
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        return iter(self.buf)
+
+
+class FakeSMBus(object):
+    """
+    An smbus.SMBus stand-in that passes each transfer on to the fake device attached at its address and counts the
+    traffic. With a clock (a fake_modem.FakeClock, or the time module to run in real time), every transfer also takes
+    as long as it would on the bus, and transfers from different threads that overlap are counted in ``collisions``
+    (on a real bus they would corrupt each other). i2c_rdwr takes smbus2 style messages made with ``i2c_msg``.
+    """
+    i2c_msg = FakeI2CMsg
+
+    def __init__(self, busnum=2, clock=None, clock_hz=100000):
+        self.busnum = busnum
+        self.clock = clock
+        self.clock_hz = clock_hz
+        self.devices = {}
+        self.transactions = 0
+        self.bytes = 0
+        self.collisions = 0
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def attach(self, address, device):
+        self.devices[address] = device
+        return device
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes = 0
+
+    def bus_time(self):
+        """Seconds the counted traffic would keep the bus busy, as FakeI2CDevice.bus_time"""
+        return (self.transactions * (9 + 2) + self.bytes * 9) / float(self.clock_hz)
+
+    def _transfer(self, address, length, messages=1):
+        # Address and register bytes included, plus the repeated start's address byte for reads
+        with self._lock:
+            self.transactions += 1
+            self.bytes += length
+            if self._active:
+                self.collisions += 1
+            self._active += 1
+        try:
+            if self.clock is not None:
+                self.clock.sleep((9 + 2 + (messages - 1) + length * 9) / float(self.clock_hz))
+        finally:
+            with self._lock:
+                self._active -= 1
+        try:
+            return self.devices[address]
+        except KeyError:
+            raise IOError(121, "Remote I/O error")
+
+    def write_byte_data(self, address, register, value):
+        self._transfer(address, 3).write(register, [value & 0xFF])
+
+    def write_i2c_block_data(self, address, register, data):
+        self._transfer(address, 2 + len(data)).write(register, list(data))
+
+    def read_byte_data(self, address, register):
+        return self._transfer(address, 4).read(register, 1)[0]
+
+    def read_i2c_block_data(self, address, register, length=32):
+        return self._transfer(address, 3 + length).read(register, length)
+
+    def i2c_rdwr(self, *messages):
+        # One combined transfer: a write message is a register and its data, and a read message reads from the
+        # register the message before it wrote
+        self._transfer(messages[0].addr, sum(1 + len(m) for m in messages), len(messages))
+        register = None
+        for message in messages:
+            device = self.devices[message.addr]
+            if message.read_msg:
+                message.buf = list(device.read(register, message.len))
+            else:
+                register = message.buf[0]
+                if message.len > 1:
+                    device.write(register, message.buf[1:])
+
+    def close(self):
+        pass
+
+
+class FakeADXL345(object):
+    """
+    The ADXL345 register map, making samples at the configured output data rate from ``clock`` while measuring.
+    ``signal(t)`` gives the acceleration in g as (x, y, z); by default 1 g on z plus a 0.5 g, 50 Hz vibration on x.
+    The 32 entry FIFO works in bypass, FIFO and stream mode, and every sample that is lost because it was not read in
+    time is counted in ``lost``. Activity, inactivity, single tap and free fall set their INT_SOURCE bits, though with
+    simpler rules than the chip's.
+    """
+    RATES = {0x0F: 1600.0, 0x0E: 800.0, 0x0D: 400.0, 0x0C: 200.0, 0x0B: 100.0, 0x0A: 50.0, 0x09: 25.0}
+
+    def __init__(self, clock, signal=None):
+        import collections
+        import math
+        self.clock = clock
+        self.signal = signal or (lambda t: (0.5 * math.sin(2 * math.pi * 50 * t), 0.0, 1.0))
+        self.regs = bytearray(0x40)
+        self.regs[0x00] = 0xE5    # DEVID
+        self.regs[0x2C] = 0x0A    # BW_RATE, 100 Hz
+        self.fifo = collections.deque()
+        self.latest = bytearray(6)
+        self.latest_unread = False
+        self.generated = 0
+        self.lost = 0
+        self.overrun = False
+        self.events = 0
+        self._next = None
+        self._ref = None
+        self._still_since = None
+        self._active = False
+        self._fall_since = None
+        self._tap_until = 0.0
+
+    def _rate(self):
+        return self.RATES.get(self.regs[0x2C] & 0x0F, 100.0)
+
+    def _encode(self, g):
+        data_format = self.regs[0x31]
+        g_range = 2 << (data_format & 0x03)
+        if data_format & 0x08:
+            lsb_per_g = 256.0                       # Full resolution, 3.9 mg/LSB at every range
+        else:
+            lsb_per_g = 512.0 / g_range             # 10 bits across the range
+        limit = int(g_range * lsb_per_g) - 1
+        counts = [max(-limit - 1, min(limit, int(round(v * lsb_per_g)))) for v in g]
+        return bytearray(struct.pack('<hhh', *counts))
+
+    def _update(self):
+        if not self.regs[0x2D] & 0x08:
+            self._next = None
+            return
+        now = self.clock.time()
+        period = 1.0 / self._rate()
+        if self._next is None:
+            self._next = now + period
+        if self._next > now:
+            return
+        count = int((now - self._next) / period) + 1
+        mode = self.regs[0x38] & 0xC0
+        # A long gap can only leave the last 32 in the FIFO
+        skip = max(0, count - 33) if mode != 0x40 else 0
+        if skip:
+            self.lost += skip
+            self.generated += skip
+            self.overrun = True
+            self._next += skip * period
+            count -= skip
+        for n in range(count):
+            g = self.signal(self._next)
+            sample = self._encode(g)
+            if self.regs[0x2E] & 0x5C:
+                self._events(self._next, g)
+            self._next += period
+            self.generated += 1
+            if mode == 0x00:
+                if self.latest_unread:
+                    self.overrun = True
+                self.latest = sample
+                self.latest_unread = True
+                continue
+            if len(self.fifo) >= 32:
+                self.overrun = True
+                self.lost += 1
+                if mode == 0x40:
+                    continue
+                self.fifo.popleft()
+            self.fifo.append(sample)
+
+    def _events(self, t, g):
+        # A simplified version of the chip's motion detection: activity/inactivity against the reference taken at the
+        # last change (AC coupled) or against zero (DC), single taps on the tap axes and free fall on all three axes
+        regs = self.regs
+        ctl = regs[0x27]
+        if self._ref is None:
+            self._ref = g
+        if regs[0x2E] & 0x10:
+            dev = [abs(g[i] - self._ref[i]) if ctl & 0x80 else abs(g[i]) for i in range(3)]
+            if any(ctl & (0x40 >> i) and dev[i] > regs[0x24] * 0.0625 for i in range(3)):
+                if not self._active:
+                    self.events |= 0x10
+                self._active = True
+                self._ref = g
+                self._still_since = t
+        if regs[0x2E] & 0x08 and self._active:
+            dev = [abs(g[i] - self._ref[i]) if ctl & 0x08 else abs(g[i]) for i in range(3)]
+            if all(not ctl & (0x04 >> i) or dev[i] <= regs[0x25] * 0.0625 for i in range(3)):
+                if self._still_since is None:
+                    self._still_since = t
+                if t - self._still_since >= regs[0x26]:
+                    self.events |= 0x08
+                    self._active = False
+                    self._ref = g
+            else:
+                self._still_since = t
+                self._ref = g
+        if regs[0x2E] & 0x40 and t >= self._tap_until:
+            if any(regs[0x2A] & (0x04 >> i) and abs(g[i]) > regs[0x1D] * 0.0625 for i in range(3)):
+                self.events |= 0x40
+                self._tap_until = t + regs[0x22] * 0.00125 + 0.05
+        if regs[0x2E] & 0x04:
+            if all(abs(v) < regs[0x28] * 0.0625 for v in g):
+                if self._fall_since is None:
+                    self._fall_since = t
+                if t - self._fall_since >= regs[0x29] * 0.005:
+                    self.events |= 0x04
+            else:
+                self._fall_since = None
+
+    def write(self, register, data):
+        self._update()
+        for value in data:
+            if register == 0x38 and value & 0xC0 == 0x00:
+                # Bypass mode empties the FIFO
+                self.fifo.clear()
+            self.regs[register] = value
+            if register == 0x2D:
+                self._next = self.clock.time() + 1.0 / self._rate() if value & 0x08 else None
+            register += 1
+
+    def read(self, register, length):
+        self._update()
+        out = []
+        while len(out) < length:
+            if register == 0x32 and length - len(out) >= 6:
+                if self.fifo:
+                    self.latest = self.fifo.popleft()
+                else:
+                    self.latest_unread = False
+                out.extend(self.latest)
+                register = 0x38
+                continue
+            if register == 0x30:
+                value = 0x00
+                if self.fifo or self.latest_unread:
+                    value |= 0x80
+                if len(self.fifo) > (self.regs[0x38] & 0x1F):
+                    value |= 0x02
+                if self.overrun:
+                    value |= 0x01
+                    self.overrun = False
+                # The event bits latch until INT_SOURCE is read
+                value |= self.events & self.regs[0x2E]
+                self.events = 0
+            elif register == 0x39:
+                value = min(len(self.fifo), 32)
+            else:
+                value = self.regs[register & 0x3F]
+            out.append(value)
+            register += 1
+        return out
+
+
+class FakeSHT31(object):
+    """
+    The SHT31 temperature and humidity sensor: single shot and periodic measurements in simulated time, fetch data,
+    break, heater, status and soft reset. Reads are NACKed (IOError) while there is no result, as the sensor does.
+    Results come from ``temperature`` and ``humidity``, and ``corrupt_every`` = n flips a bit in every nth result read.
+    """
+    DURATION = {0x00: 0.0125, 0x0B: 0.0045, 0x16: 0.0025}
+    PERIODIC = {0x20: 2.0, 0x21: 1.0, 0x22: 0.5, 0x23: 0.25, 0x27: 0.1}
+
+    def __init__(self, clock, temperature=23.7, humidity=45.0):
+        self.clock = clock
+        self.temperature = temperature
+        self.humidity = humidity
+        self.status = 0x0010
+        self.corrupt_every = 0
+        self.results_read = 0
+        self.commands = []
+        self.period = None
+        self._started = None
+        self._fetched = None
+        self._ready_at = None
+        self._out = None
+
+    @staticmethod
+    def _crc(data):
+        crc = 0xFF
+        for byte in data:
+            crc ^= byte
+            for bit in range(8):
+                crc = ((crc << 1) ^ 0x31) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        return crc
+
+    def _words(self, *words):
+        out = []
+        for word in words:
+            pair = [word >> 8, word & 0xFF]
+            out.extend(pair + [self._crc(pair)])
+        return out
+
+    def _result(self):
+        temperature = int(round((self.temperature + 45) * 65535 / 175.0))
+        humidity = int(round(self.humidity * 65535 / 100.0))
+        out = self._words(temperature, humidity)
+        self.results_read += 1
+        if self.corrupt_every and self.results_read % self.corrupt_every == 0:
+            out[1] ^= 0x01
+        return out
+
+    def write(self, register, data):
+        command = register << 8 | (data[0] if data else 0)
+        self.commands.append(command)
+        now = self.clock.time()
+        if self.period is not None and command not in (0xE000, 0x3093, 0x30A2):
+            self.status |= 0x0002
+            return
+        self._out = None
+        if register == 0x24 or register == 0x2C:
+            self._ready_at = now + self.DURATION.get(data[0] & 0x1F, 0.0125)
+        elif register in self.PERIODIC:
+            self.period = self.PERIODIC[register]
+            self._started = now
+            self._fetched = None
+        elif command == 0xE000:
+            self._out = 'fetch'
+        elif command in (0x3093, 0x30A2):
+            self.period = None
+            self._ready_at = None
+            if command == 0x30A2:
+                self.status = 0x0010
+        elif command == 0x306D:
+            self.status |= 0x2000
+        elif command == 0x3066:
+            self.status &= ~0x2000
+        elif command == 0x3041:
+            self.status &= 0x2000
+        elif command == 0xF32D:
+            self._out = self._words(self.status)
+
+    def _measurements(self, now):
+        # Number of periodic measurements finished by now
+        if now < self._started + 0.0125:
+            return 0
+        return int((now - self._started - 0.0125) / self.period) + 1
+
+    def read(self, register, length):
+        now = self.clock.time()
+        out = self._out
+        self._out = None
+        if out == 'fetch':
+            done = self._measurements(now) if self.period is not None else 0
+            if done == 0 or done == self._fetched:
+                raise IOError(121, "Remote I/O error")
+            self._fetched = done
+            out = self._result()
+        elif out is None:
+            if self._ready_at is None or now < self._ready_at:
+                raise IOError(121, "Remote I/O error")
+            self._ready_at = None
+            out = self._result()
+        return (out + [0xFF] * length)[:length]
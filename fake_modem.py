@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""
+fake_modem.py - a simulated Skywire modem that stands in for SerialMutex, so modem code can run without hardware.
+
+The fake answers the AT commands that GPSModem sends from a small model of the radio, network registration and PDP
+context, on a clock that can be simulated so that scenarios which take minutes on a real modem run instantly. Faults
+(radio off, network outage, deregistration, dropped context) are injected with the inject_* methods.
+
+FakeSerial puts the same model behind a pyserial port, to run SerialMutex itself.
+"""
+import logging
+import socket
+import threading
+
+
+class FakeClock(object):
+    """A clock that only moves when something sleeps on it"""
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(0.0, seconds)
+
+
+class FakeModem(object):
+    def __init__(self, clock=None, command_time=1.0, attach_time=20.0, boot_time=15.0, baud=115200, sms_time=6.0):
+        """
+        :param clock:           a FakeClock, or None to use a new one. Pass ``time`` to run in real time
+        :param command_time:    seconds a plain command takes, like the fixed sleep in SerialMutex.write
+        :param attach_time:     seconds from radio on (or network back) to registered
+        :param boot_time:       seconds a module reboot (AT+CFUN=1,1) takes before it starts attaching
+        :param baud:            serial line speed, every byte to and from the modem costs 10 bit times
+        :param sms_time:        seconds sending an SMS takes
+        """
+        self.logger = logging.getLogger('fake_modem')
+        self.clock = clock if clock is not None else FakeClock()
+        self.command_time = command_time
+        self.attach_time = attach_time
+        self.boot_time = boot_time
+        self.baud = baud
+        self.sms_time = sms_time
+        self.commands = []
+        self.urc_listeners = []
+        self.sent_messages = []
+        self.inbox = []
+        self.fail_next = {}
+
+        self.cfun = 1
+        self.context = True
+        self.ip = '10.170.12.34'
+        self.phone = '+14155550123'
+        self.imsi = '311480123456789'
+        self.rssi = 20
+        self.roaming = False
+        self.gps_fix = '042434.668,3745.8152N,12223.3605W,1.00,0.0,3,325.98,0.04,0.02,291117,07'
+        # Serving cell, then neighbours, as AT#MONIZIP reports them: cell, LAC, cell id, ARFCN, power, C1, C2
+        self.cells = ['#MONIZIP: S,00FD,8AF3,686,-84,19,19,0,0', '#MONIZIP: N1,00FD,8AF5,760,-94,9,9',
+                      '#MONIZIP: N2,FFFF,0000,688,-111,-1,-1', '#MONIZIP: N3,00FD,8AF7,687,-101,3,3',
+                      '#MONIZIP: N4,00FE,9A01,685,-105,1,1']
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._registered_at = self.clock.time()
+        self._outage_until = None
+        self._stuck = None
+        self._urcs = []
+        self._urc_lock = threading.Lock()
+        self.sockets = {}
+        self.received = {}
+
+    # -- fault injection --------------------------------------------------------------------------------------------
+
+    def inject_radio_off(self):
+        """The radio has been switched off (AT+CFUN=0), e.g. by a brown-out or a stray command"""
+        self.cfun = 0
+        self._drop_context()
+
+    def inject_outage(self, duration):
+        """No network for ``duration`` seconds, after which the modem re-attaches on its own"""
+        now = self.clock.time()
+        self._outage_until = now + duration
+        self._registered_at = now + duration + self.attach_time
+        self._drop_context()
+
+    def inject_deregistration(self, clears_on='cops', denied=False):
+        """
+        The modem drops off the network and stays searching (or denied) until ``clears_on`` happens: 'cops' for an
+        operator reselection (AT+COPS=0), 'cycle' for a radio off/on, 'reset' for a module reboot.
+        """
+        self._stuck = (clears_on, denied)
+        self._drop_context()
+
+    def inject_context_drop(self):
+        """The network tears down the PDP context while staying registered"""
+        self._drop_context()
+
+    def inject_error(self, command, response='\r\nERROR\r\n'):
+        """The next command starting with ``command`` fails with ``response``"""
+        self.fail_next[command] = response
+
+    def _drop_context(self):
+        if self.context:
+            self._queue_urc('+QIURC: "pdpdeact",1')
+        self.context = False
+        for connect_id in list(self.sockets):
+            self._close_socket(connect_id, notify=True)
+
+    def _queue_urc(self, line):
+        with self._urc_lock:
+            self._urcs.append(line)
+
+    # -- simulated state --------------------------------------------------------------------------------------------
+
+    def has_service(self):
+        return self.cfun == 1 and (self._outage_until is None or self.clock.time() >= self._outage_until)
+
+    def registration(self):
+        if self.cfun != 1:
+            return 0
+        if not self.has_service():
+            return 2
+        if self._stuck is not None:
+            return 3 if self._stuck[1] else 2
+        if self.clock.time() < self._registered_at:
+            return 2
+        return 5 if self.roaming else 1
+
+    def is_registered(self):
+        return self.registration() in (1, 5)
+
+    def _clear(self, event):
+        if self._stuck is not None and self._stuck[0] == event:
+            self._stuck = None
+            self._registered_at = self.clock.time() + self.attach_time
+
+    # -- SerialMutex interface --------------------------------------------------------------------------------------
+
+    def add_urc_listener(self, callback):
+        self.urc_listeners.append(callback)
+
+    def read_urcs(self):
+        with self._urc_lock:
+            urcs, self._urcs = self._urcs, []
+        for line in urcs:
+            for callback in self.urc_listeners:
+                callback(line)
+        return ''.join('\r\n%s\r\n' % line for line in urcs)
+
+    def write(self, command):
+        return self.write_wait(command, self.command_time)
+
+    def write_wait(self, command, sleep_time):
+        self.commands.append(command)
+        self.clock.sleep(sleep_time)
+        return self._transfer(command, self.response(command))
+
+    def response(self, command):
+        """Everything the modem sends back for ``command``: the echo, any response lines, then OK or ERROR"""
+        cmd = command.rstrip('\r')
+        for prefix in list(self.fail_next):
+            if cmd.startswith(prefix):
+                return command + self.fail_next.pop(prefix)
+        body = self.respond(cmd)
+        if body is None:
+            return command + '\r\nERROR\r\n'
+        return command + '\r\n' + ''.join(line + '\r\n\r\n' for line in body) + 'OK\r\n'
+
+    def _transfer(self, sent, received, payload=0):
+        self.bytes_sent += len(sent) + payload
+        self.bytes_received += len(received)
+        self.clock.sleep((len(sent) + len(received) + payload) * 10.0 / self.baud)
+        return received
+
+    def write_data(self, command, data, timeout=10):
+        self.commands.append(command)
+        cmd = command.rstrip('\r')
+        if not cmd.startswith('AT+QISEND='):
+            return self._transfer(command, command + '\r\nERROR\r\n')
+        parts = cmd[10:].split(',')
+        sock = self.sockets.get(int(parts[0]))
+        if sock is None or len(data) != int(parts[1]) or len(data) > 1460:
+            return self._transfer(command, command + '\r\nERROR\r\n', len(data))
+        try:
+            sock.sendall(bytes(data))
+        except socket.error:
+            self._close_socket(int(parts[0]), notify=True)
+            return self._transfer(command, command + '\r\n> \r\nSEND FAIL\r\n', len(data))
+        return self._transfer(command, command + '\r\n> \r\nSEND OK\r\n', len(data))
+
+    def read_data(self, command, prefix, timeout=10):
+        self.commands.append(command)
+        cmd = command.rstrip('\r')
+        parts = cmd[8:].split(',') if cmd.startswith('AT+QIRD=') else []
+        if not parts or int(parts[0]) not in self.received:
+            return None, self._transfer(command, command + '\r\nERROR\r\n')
+        connect_id = int(parts[0])
+        with self._urc_lock:
+            buf = self.received[connect_id]
+            data = bytes(buf[:int(parts[1])])
+            del buf[:len(data)]
+        rx_buffer = '%s\r\n%s %d\r\n' % (command, prefix, len(data))
+        self._transfer(command, rx_buffer + '\r\nOK\r\n', len(data))
+        return data, rx_buffer
+
+    # -- sockets, bridged to real TCP/UDP sockets on this machine ---------------------------------------------------
+
+    def _open_socket(self, connect_id, protocol, host, port):
+        if not (self.context and self.is_registered()) or connect_id in self.sockets:
+            return 563 if connect_id in self.sockets else 561
+        try:
+            if protocol == 'UDP':
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.connect((host, port))
+            else:
+                sock = socket.create_connection((host, port), timeout=10)
+                sock.settimeout(None)
+        except socket.error:
+            return 566
+        self.sockets[connect_id] = sock
+        self.received[connect_id] = bytearray()
+        thread = threading.Thread(target=self._pump, args=(connect_id, sock), name='fake_modem_%d' % connect_id)
+        thread.daemon = True
+        thread.start()
+        return 0
+
+    def _pump(self, connect_id, sock):
+        # Like the module in buffer access mode: keep what arrives and announce it with a "recv" URC
+        while True:
+            try:
+                data = sock.recv(4096)
+            except socket.error:
+                data = b''
+            if self.sockets.get(connect_id) is not sock:
+                return
+            if not data:
+                self._close_socket(connect_id, notify=True)
+                return
+            with self._urc_lock:
+                self.received[connect_id].extend(data)
+                self._urcs.append('+QIURC: "recv",%d' % connect_id)
+
+    def _close_socket(self, connect_id, notify=False):
+        sock = self.sockets.pop(connect_id, None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+            if notify:
+                self._queue_urc('+QIURC: "closed",%d' % connect_id)
+
+    def respond(self, cmd):
+        """Returns the response lines for ``cmd`` (without the final OK), or None for ERROR"""
+        if cmd in ('AT', 'AT+CMEE=2', 'AT+CMGF=0', 'AT+CMGF=1', 'AT+QGPS=1'):
+            return []
+        if cmd == 'AT+CFUN?':
+            return ['+CFUN: %d' % self.cfun]
+        if cmd == 'AT+CFUN=0':
+            self.cfun = 0
+            self._drop_context()
+            self._clear('cycle')
+            return []
+        if cmd == 'AT+CFUN=1':
+            if self.cfun != 1:
+                self.cfun = 1
+                self._registered_at = self.clock.time() + self.attach_time
+            return []
+        if cmd == 'AT+CFUN=1,1':
+            self.clock.sleep(self.boot_time)
+            self.cfun = 1
+            self._drop_context()
+            self._outage_until = None
+            self._stuck = None
+            self._registered_at = self.clock.time() + self.attach_time
+            return []
+        if cmd == 'AT+COPS=0':
+            self._clear('cops')
+            return []
+        if cmd == 'AT+QCSQ':
+            if not self.has_service():
+                return ['+QCSQ: "NOSERVICE"']
+            return ['+QCSQ: "eMTC",%d,-96,134,-13' % (-113 + 2 * self.rssi)]
+        if cmd == 'AT+CSQ':
+            return ['+CSQ: %d,99' % (self.rssi if self.has_service() else 99)]
+        if cmd == 'AT+CEREG?':
+            return ['+CEREG: 0,%d' % self.registration()]
+        if cmd == 'AT+QIACT?':
+            if self.context and self.is_registered():
+                return ['+QIACT: 1,1,1,"%s"' % self.ip]
+            return []
+        if cmd == 'AT+QIACT=1':
+            if not self.is_registered():
+                return None
+            self.context = True
+            return []
+        if cmd == 'AT+QIDEACT=1':
+            self._drop_context()
+            return []
+        if cmd.startswith('AT+QIOPEN='):
+            # AT+QIOPEN=<contextID>,<connectID>,"TCP","host",port,0,0
+            parts = cmd[10:].split(',')
+            connect_id = int(parts[1])
+            err = self._open_socket(connect_id, parts[2].strip('"'), parts[3].strip('"'), int(parts[4]))
+            self._queue_urc('+QIOPEN: %d,%d' % (connect_id, err))
+            return []
+        if cmd.startswith('AT+QICLOSE='):
+            self._close_socket(int(cmd[11:].split(',')[0]))
+            return []
+        if cmd.startswith('AT+QICFG='):
+            return []
+        if cmd == 'AT+CSMS?':
+            return ['+CSMS: 0,1,1,1']
+        if cmd == 'AT+QGPS?':
+            return ['+QGPS: 1']
+        if cmd == 'AT+QGPSLOC?':
+            return ['+QGPSLOC: ' + self.gps_fix]
+        if cmd == 'AT+CNUM':
+            return ['+CNUM: "","%s",145' % self.phone]
+        if cmd == 'AT+CIMI':
+            return [self.imsi]
+        if cmd == 'AT#MONIZIP=7':
+            return []
+        if cmd == 'AT#MONIZIP':
+            return ['\r\n'.join(self.cells)]
+        if cmd == 'AT#RFSTS':
+            return ['#RFSTS: "310 260",686,-82,00FD,01,3,19,10,2,8AF3,"204043396525363","T-Mobile",3,4']
+        if cmd == 'AT+CMGD=1':
+            if self.inbox:
+                self.inbox.pop(0)
+            return []
+        if cmd == 'AT+CMGR=1':
+            if not self.inbox:
+                return []
+            sender, text = self.inbox[0]
+            return ['+CMGR: "REC UNREAD","%s","","19/10/30,12:00:00-28"\r\n%s' % (sender, text)]
+        return None
+
+    def write_message(self, recipient, text_content):
+        self.clock.sleep(self.sms_time)
+        self.sent_messages.append((recipient, text_content))
+
+    def write_pdu_message(self, recipient, binary_content):
+        self.clock.sleep(self.sms_time)
+        self.sent_messages.append((recipient, binary_content))
+
+    def close(self):
+        pass
+
+    def reset_modem(self):
+        self.respond('AT+CFUN=1,1')
+
+
+class FakeSerial(object):
+    """
+    A pyserial port with a FakeModem on the other end, for running SerialMutex itself without the modem. A command is
+    answered as soon as its carriage return is written, and the reads and writes are counted.
+    """
+    def __init__(self, modem=None):
+        self.modem = modem if modem is not None else FakeModem()
+        self._tx = ''
+        self._rx = ''
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.writes = 0
+        self.reads = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes_written += len(data)
+        self._tx += data
+        if self._tx.endswith('\r'):
+            command, self._tx = self._tx, ''
+            self.modem.commands.append(command)
+            self._rx += self.modem.response(command)
+        return len(data)
+
+    def inWaiting(self):
+        return len(self._rx)
+
+    def read(self, size=1):
+        data, self._rx = self._rx[:size], self._rx[size:]
+        self.reads += 1
+        self.bytes_read += len(data)
+        return data
+
+    def flushOutput(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+if __name__ == "__main__":
+    import gps_modem
+
+    fake = FakeModem()
+    stime = fake.clock.time()
+    modem = gps_modem.GPSModem(fake)
+    print(">>> GPSModem() took %.0f simulated seconds and %d commands" % (fake.clock.time() - stime,
+                                                                         len(fake.commands)))
+    print(">>> IMSI: {}, IP: {}, Phone: {}".format(modem.get_imsi(), modem.get_ip(), modem.get_phone_number()))
+    print(">>> %s" % modem.get_gps())
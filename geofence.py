@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+geofence.py - evaluates GPS fixes from the modem against a large set of circle and polygon geofences.
+
+Fence bounding boxes are bucketed into a uniform lat/lng grid so a fix only looks at the fences in its own cell. The
+candidates are then tested in one shot with NumPy (haversine for circles, ray crossing for polygons), and each fence
+keeps enter/exit/dwell state so a jittery fix on the boundary does not produce a storm of events.
+"""
+import logging
+import math
+import time
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = 111320.0
+
+ENTER = 'enter'
+EXIT = 'exit'
+DWELL = 'dwell'
+
+_EMPTY = np.zeros(0, dtype=np.intp)
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Great-circle distance in meters. The arguments are degrees and may be NumPy arrays that broadcast together"""
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlat = lat2 - lat1
+    dlng = np.radians(lng2) - np.radians(lng1)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GeofenceEngine(object):
+    def __init__(self, cell_size=0.05, confirm=2, dwell_time=300):
+        """
+        :param cell_size:   grid cell size in degrees
+        :param confirm:     consecutive fixes needed before an enter or exit is reported
+        :param dwell_time:  seconds inside a fence before a dwell event is reported
+        """
+        self.logger = logging.getLogger('geofence')
+        self.cell_size = cell_size
+        self.confirm = confirm
+        self.dwell_time = dwell_time
+        self.ids = []
+        self._circles = []
+        self._polygons = []
+        self._grid = None
+        self.inside = np.zeros(0, dtype=bool)
+        self._streak = np.zeros(0, dtype=np.intp)
+        self._since = np.zeros(0)
+        self._entered = np.zeros(0)
+        self._dwelled = np.zeros(0, dtype=bool)
+
+    def add_circle(self, fence_id, lat, lng, radius):
+        """Adds a circular fence, ``radius`` is in meters"""
+        self._circles.append((len(self.ids), float(lat), float(lng), float(radius)))
+        self.ids.append(fence_id)
+        self._grid = None
+
+    def add_polygon(self, fence_id, points):
+        """Adds a polygon fence from a list of (lat, lng) vertices. The polygon is closed implicitly"""
+        if len(points) < 3:
+            raise ValueError("A polygon fence needs at least 3 points")
+        self._polygons.append((len(self.ids), np.asarray(points, dtype=np.float64)))
+        self.ids.append(fence_id)
+        self._grid = None
+
+    def build(self):
+        """
+        Builds the spatial index. Called automatically after fences are added, which start outside; the fences that
+        were already there keep their inside, transition and dwell state.
+        """
+        n = len(self.ids)
+        cs = self.cell_size
+
+        circles = np.array([c[1:] for c in self._circles], dtype=np.float64).reshape(-1, 3)
+        self._c_fence = np.array([c[0] for c in self._circles], dtype=np.intp)
+        self._c_lat = circles[:, 0].copy()
+        self._c_lng = circles[:, 1].copy()
+        self._c_radius = circles[:, 2].copy()
+
+        # Polygon edges live in flat arrays, and the edges of one polygon are contiguous
+        e_fence = []
+        edges = []
+        for idx, pts in self._polygons:
+            e_fence.append(np.full(len(pts), idx, dtype=np.intp))
+            edges.append(np.hstack((pts, np.roll(pts, -1, axis=0))))
+        self._e_fence = np.concatenate(e_fence) if e_fence else _EMPTY
+        edges = np.vstack(edges) if edges else np.zeros((0, 4))
+        self._e_lat0, self._e_lng0, self._e_lat1, self._e_lng1 = [edges[:, i].copy() for i in range(4)]
+
+        grid = {}
+
+        def insert(kind, values, min_lat, max_lat, min_lng, max_lng):
+            for i in range(int(math.floor(min_lat / cs)), int(math.floor(max_lat / cs)) + 1):
+                for j in range(int(math.floor(min_lng / cs)), int(math.floor(max_lng / cs)) + 1):
+                    grid.setdefault((i, j), ([], []))[kind].extend(values)
+
+        for k, (idx, lat, lng, radius) in enumerate(self._circles):
+            dlat = radius / METERS_PER_DEGREE
+            dlng = dlat / max(math.cos(math.radians(lat)), 0.01)
+            insert(0, [k], lat - dlat, lat + dlat, lng - dlng, lng + dlng)
+
+        start = 0
+        for idx, pts in self._polygons:
+            insert(1, range(start, start + len(pts)), pts[:, 0].min(), pts[:, 0].max(), pts[:, 1].min(),
+                   pts[:, 1].max())
+            start += len(pts)
+
+        self._grid = dict((cell, (np.array(c, dtype=np.intp), np.array(e, dtype=np.intp)))
+                          for cell, (c, e) in grid.items())
+
+        # Fences are only ever appended, so the state arrays grow with zeros for the new ones
+        def grow(state):
+            grown = np.zeros(n, dtype=state.dtype)
+            grown[:len(state)] = state
+            return grown
+
+        self.inside = grow(self.inside)
+        self._streak = grow(self._streak)
+        self._since = grow(self._since)
+        self._entered = grow(self._entered)
+        self._dwelled = grow(self._dwelled)
+        self.logger.info("[geofence] Indexed %d fences (%d circles, %d polygons) into %d cells", n,
+                         len(self._circles), len(self._polygons), len(self._grid))
+
+    def _candidates(self, lats, lngs):
+        cs = self.cell_size
+        cells = set(zip(np.floor(lats / cs).astype(int).tolist(), np.floor(lngs / cs).astype(int).tolist()))
+        hits = [self._grid[cell] for cell in cells if cell in self._grid]
+        if not hits:
+            return _EMPTY, _EMPTY
+        if len(hits) == 1:
+            return hits[0]
+        return np.unique(np.concatenate([h[0] for h in hits])), np.unique(np.concatenate([h[1] for h in hits]))
+
+    def contains(self, lats, lngs):
+        """
+        Tests points against the fences in their grid cells.
+        :return:    (fence indices, bool matrix of shape (points, fences))
+        """
+        if self._grid is None:
+            self.build()
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lngs = np.atleast_1d(np.asarray(lngs, dtype=np.float64))
+        ci, ei = self._candidates(lats, lngs)
+        plat = lats[:, None]
+        plng = lngs[:, None]
+
+        c_in = haversine(plat, plng, self._c_lat[ci], self._c_lng[ci]) <= self._c_radius[ci]
+
+        if len(ei):
+            lat0 = self._e_lat0[ei]
+            lat1 = self._e_lat1[ei]
+            lng0 = self._e_lng0[ei]
+            straddle = (lat0 > plat) != (lat1 > plat)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x = lng0 + (plat - lat0) * (self._e_lng1[ei] - lng0) / (lat1 - lat0)
+            crossings = (straddle & (plng < x)).astype(np.int32)
+            ef = self._e_fence[ei]
+            starts = np.flatnonzero(np.r_[True, ef[1:] != ef[:-1]])
+            p_fence = ef[starts]
+            p_in = (np.add.reduceat(crossings, starts, axis=1) & 1).astype(bool)
+        else:
+            p_fence = _EMPTY
+            p_in = np.zeros((len(lats), 0), dtype=bool)
+
+        return np.concatenate((self._c_fence[ci], p_fence)), np.hstack((c_in, p_in))
+
+    def evaluate_track(self, lats, lngs, times):
+        """
+        Runs a window of fixes through the fences in order and returns the enter/exit/dwell events as a list of
+        dicts ``{'event': ..., 'fence': ..., 'now': ...}``
+        """
+        fences, observed = self.contains(lats, lngs)
+        times = np.atleast_1d(np.asarray(times, dtype=np.float64))
+
+        # Fences that are inside or part way through a transition have to be updated even when the track has left
+        # their grid cells, they are simply observed as outside.
+        active = np.flatnonzero(self.inside | (self._streak > 0))
+        idx = np.union1d(fences, active)
+        obs = np.zeros((len(times), len(idx)), dtype=bool)
+        obs[:, np.searchsorted(idx, fences)] = observed
+
+        inside = self.inside[idx]
+        streak = self._streak[idx]
+        since = self._since[idx]
+        entered = self._entered[idx]
+        dwelled = self._dwelled[idx]
+
+        events = []
+        for p, now in enumerate(times.tolist()):
+            differs = obs[p] != inside
+            since = np.where(differs & (streak == 0), now, since)
+            streak = np.where(differs, streak + 1, 0)
+            flip = streak >= self.confirm
+            if flip.any():
+                inside = inside ^ flip
+                streak[flip] = 0
+                entered = np.where(flip & inside, since, entered)
+                dwelled = dwelled & ~flip
+                for k in np.flatnonzero(flip).tolist():
+                    events.append({'event': ENTER if inside[k] else EXIT, 'fence': self.ids[idx[k]], 'now': now})
+            dwell = inside & ~dwelled & (now - entered >= self.dwell_time)
+            if dwell.any():
+                dwelled = dwelled | dwell
+                for k in np.flatnonzero(dwell).tolist():
+                    events.append({'event': DWELL, 'fence': self.ids[idx[k]], 'now': now})
+
+        self.inside[idx] = inside
+        self._streak[idx] = streak
+        self._since[idx] = since
+        self._entered[idx] = entered
+        self._dwelled[idx] = dwelled
+        for e in events:
+            self.logger.info("[geofence] %s fence %s", e['event'], e['fence'])
+        return events
+
+    def evaluate(self, lat, lng, now=None):
+        return self.evaluate_track([lat], [lng], [time.time() if now is None else now])
+
+    def update(self, gps):
+        """Evaluates a fix dict as returned by ``GPSModem.get_gps``. An empty dict (no fix) is ignored"""
+        if not gps:
+            return []
+        return self.evaluate(gps['lat'], gps['lng'], gps.get('now'))
+
+    def fences_at(self, lat, lng):
+        """Returns the ids of every fence containing the point, regardless of hysteresis state"""
+        fences, observed = self.contains([lat], [lng])
+        return [self.ids[i] for i in fences[observed[0]].tolist()]
+
+
+if __name__ == "__main__":
+    # Benchmark: 10k random fences around the bay, evaluated one fix at a time and as a track window
+    rng = np.random.RandomState(42)
+    engine = GeofenceEngine()
+    for n in range(5000):
+        engine.add_circle('c%d' % n, rng.uniform(37.2, 38.2), rng.uniform(-122.8, -121.8), rng.uniform(50, 2000))
+    for n in range(5000):
+        clat, clng = rng.uniform(37.2, 38.2), rng.uniform(-122.8, -121.8)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, rng.randint(4, 9)))
+        r = rng.uniform(0.001, 0.02)
+        engine.add_polygon('p%d' % n, np.column_stack((clat + r * np.sin(angles), clng + r * np.cos(angles))))
+
+    stime = time.time()
+    engine.build()
+    print("Indexed 10000 fences in %.1f ms" % ((time.time() - stime) * 1000))
+
+    fixes = 2000
+    lats = rng.uniform(37.2, 38.2, fixes)
+    lngs = rng.uniform(-122.8, -121.8, fixes)
+    count = 0
+    stime = time.time()
+    for n in range(fixes):
+        count += len(engine.evaluate(lats[n], lngs[n], n))
+    elapsed = time.time() - stime
+    print("Per fix: %.1f us (%d events)" % (elapsed / fixes * 1e6, count))
+
+    # A vehicle track is local, so the window only touches a few grid cells
+    lats = 37.7 + np.cumsum(rng.normal(0, 0.0002, fixes))
+    lngs = -122.4 + np.cumsum(rng.normal(0, 0.0002, fixes))
+    engine.build()
+    stime = time.time()
+    count = len(engine.evaluate_track(lats, lngs, np.arange(fixes)))
+    elapsed = time.time() - stime
+    print("Track window of %d fixes: %.1f ms, %.1f us per fix (%d events)" % (fixes, elapsed * 1000,
+                                                                               elapsed / fixes * 1e6, count))
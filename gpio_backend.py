@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""
+gpio_backend.py - ways of clocking a bit sequence out on a (clock, data) pin pair, for bit-banged devices like the
+chainable LED.
+
+Every backend has emit(bits), which sets the data pin to each bit in turn and pulses the clock (low, then high), so a
+whole frame goes out in one call:
+
+    GPIOModuleBackend   through Adafruit_BBIO.GPIO (or anything with its setup/output interface), two or three
+                        calls into C per bit. Works everywhere, and is the slowest.
+    SysfsBackend        writes to /sys/class/gpio/gpioN/value.
+    GpiodBackend        a libgpiod line request for both pins, one set_values() call per clock edge.
+    MmapBackend         writes the AM335x GPIO set/clear registers through /dev/mem, the fastest. Needs root.
+
+Pins are BeagleBone header names ("P9_14") or (bank, bit) pairs. The sysfs and mmap backends can be pointed at plain
+files, and GpiodBackend and GPIOModuleBackend can be given fakes (see fake_gpio.py), to run without the board.
+"""
+import mmap
+import os
+import struct
+import time
+
+# Header pin -> (GPIO bank, bit)
+PINS = {
+    "P9_14": (1, 18),
+    "P9_16": (1, 19),
+    "P9_21": (0, 3),
+    "P9_22": (0, 2),
+}
+
+# AM335x GPIO banks and registers
+BANK_BASE = [0x44E07000, 0x4804C000, 0x481AC000, 0x481AE000]
+BANK_SIZE = 0x1000
+GPIO_OE = 0x134
+GPIO_DATAOUT = 0x13C
+GPIO_CLEARDATAOUT = 0x190
+GPIO_SETDATAOUT = 0x194
+
+
+def bank_bit(pin):
+    if isinstance(pin, tuple):
+        return pin
+    try:
+        return PINS[pin]
+    except KeyError:
+        raise ValueError("Unknown pin %s" % pin)
+
+
+def gpio_number(pin):
+    bank, bit = bank_bit(pin)
+    return bank * 32 + bit
+
+
+class GPIOModuleBackend(object):
+    name = 'gpio module'
+
+    def __init__(self, clk_pin, data_pin, gpio=None, clock_delay=0):
+        """
+        :param gpio:        Adafruit_BBIO.GPIO (the default) or an object with the same setup/output interface
+        :param clock_delay: seconds each clock level is held
+        """
+        if gpio is None:
+            import Adafruit_BBIO.GPIO as gpio
+        self.gpio = gpio
+        self.clk_pin = clk_pin
+        self.data_pin = data_pin
+        self.clock_delay = clock_delay
+        self.level = None
+        gpio.setup(clk_pin, gpio.OUT)
+        gpio.setup(data_pin, gpio.OUT)
+
+    def emit(self, bits):
+        gpio = self.gpio
+        output = gpio.output
+        clk_pin = self.clk_pin
+        data_pin = self.data_pin
+        low = gpio.LOW
+        high = gpio.HIGH
+        delay = self.clock_delay
+        level = self.level
+        for bit in bits:
+            if bit != level:
+                output(data_pin, high if bit else low)
+                level = bit
+            output(clk_pin, low)
+            if delay:
+                time.sleep(delay)
+            output(clk_pin, high)
+            if delay:
+                time.sleep(delay)
+        self.level = level
+
+    def close(self):
+        pass
+
+
+class SysfsBackend(object):
+    name = 'sysfs'
+
+    def __init__(self, clk_pin, data_pin, root='/sys/class/gpio'):
+        """
+        The pins must already be exported and set as outputs, e.g. by the device tree or with
+        echo 50 > /sys/class/gpio/export; echo out > /sys/class/gpio/gpio50/direction
+        """
+        self.clk_fd = os.open(os.path.join(root, 'gpio%d' % gpio_number(clk_pin), 'value'), os.O_WRONLY)
+        self.data_fd = os.open(os.path.join(root, 'gpio%d' % gpio_number(data_pin), 'value'), os.O_WRONLY)
+        self.level = None
+
+    def _write(self, fd, value):
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, value)
+
+    def emit(self, bits):
+        write = self._write
+        clk_fd = self.clk_fd
+        data_fd = self.data_fd
+        level = self.level
+        for bit in bits:
+            if bit != level:
+                write(data_fd, b'1' if bit else b'0')
+                level = bit
+            write(clk_fd, b'0')
+            write(clk_fd, b'1')
+        self.level = level
+
+    def close(self):
+        os.close(self.clk_fd)
+        os.close(self.data_fd)
+
+
+class GpiodBackend(object):
+    name = 'gpiod'
+
+    def __init__(self, clk_pin, data_pin, lines=None, consumer='grove_led'):
+        """
+        :param lines:   a requested libgpiod line bulk for [clk, data] with set_values(), or None to request the lines
+                        from the pins' gpiochip with the gpiod (v1) bindings
+        """
+        if lines is None:
+            import gpiod
+            clk_bank, clk_bit = bank_bit(clk_pin)
+            data_bank, data_bit = bank_bit(data_pin)
+            if clk_bank != data_bank:
+                raise ValueError("The clock and data pins must be on the same gpiochip")
+            chip = gpiod.Chip('gpiochip%d' % clk_bank)
+            lines = chip.get_lines([clk_bit, data_bit])
+            lines.request(consumer=consumer, type=gpiod.LINE_REQ_DIR_OUT, default_vals=[1, 0])
+        self.lines = lines
+        self.level = 0
+
+    def emit(self, bits):
+        set_values = self.lines.set_values
+        for bit in bits:
+            # Data changes with the falling edge and is clocked in on the rising one
+            set_values([0, bit])
+            set_values([1, bit])
+        if bits:
+            self.level = bits[-1]
+
+    def close(self):
+        self.lines.release()
+
+
+class MmapBackend(object):
+    name = 'mmap'
+
+    def __init__(self, clk_pin, data_pin, path='/dev/mem', offset=None):
+        """
+        :param path:    /dev/mem, or a file of at least BANK_SIZE bytes to stand in for the registers
+        :param offset:  where the GPIO bank starts in ``path``, by default its physical address for /dev/mem and 0
+                        for anything else
+        """
+        clk_bank, clk_bit = bank_bit(clk_pin)
+        data_bank, data_bit = bank_bit(data_pin)
+        if clk_bank != data_bank:
+            raise ValueError("The clock and data pins must be in the same GPIO bank")
+        if offset is None:
+            offset = BANK_BASE[clk_bank] if path == '/dev/mem' else 0
+        self.fd = os.open(path, os.O_RDWR | getattr(os, 'O_SYNC', 0))
+        self.mem = mmap.mmap(self.fd, BANK_SIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE, offset=offset)
+        self.clk_mask = 1 << clk_bit
+        self.data_mask = 1 << data_bit
+        self.level = None
+        if hasattr(memoryview, 'cast'):
+            self.regs = memoryview(self.mem).cast('I')
+        else:
+            self.regs = _Registers(self.mem)
+        # Both pins are outputs (0 in the output enable register)
+        self.regs[GPIO_OE >> 2] &= ~(self.clk_mask | self.data_mask) & 0xFFFFFFFF
+
+    def emit(self, bits):
+        regs = self.regs
+        set_reg = GPIO_SETDATAOUT >> 2
+        clear_reg = GPIO_CLEARDATAOUT >> 2
+        clk = self.clk_mask
+        data = self.data_mask
+        clk_data = clk | data
+        level = self.level
+        for bit in bits:
+            if bit == level:
+                regs[clear_reg] = clk
+            elif bit:
+                regs[clear_reg] = clk
+                regs[set_reg] = data
+                level = bit
+            else:
+                # Data low and clock low in one write
+                regs[clear_reg] = clk_data
+                level = bit
+            regs[set_reg] = clk
+        self.level = level
+
+    def close(self):
+        if hasattr(self.regs, 'release'):
+            self.regs.release()
+        self.mem.close()
+        os.close(self.fd)
+
+
+class _Registers(object):
+    # 32-bit register access for Pythons without memoryview.cast
+    def __init__(self, mem):
+        self.mem = mem
+
+    def __getitem__(self, index):
+        return struct.unpack_from('<I', self.mem, index * 4)[0]
+
+    def __setitem__(self, index, value):
+        struct.pack_into('<I', self.mem, index * 4, value)
+
+
+def benchmark():
+    # Bit rate per backend. The sysfs and mmap backends write to temporary files and the others talk to fakes, so
+    # this measures the Python side of each; on the board the gpio module and sysfs calls cost more.
+    import shutil
+    import tempfile
+    import fake_gpio
+
+    bits = [(n * 7 // 3) & 1 for n in range(32 * 66)]
+    tmp = tempfile.mkdtemp()
+    try:
+        for number in (gpio_number("P9_14"), gpio_number("P9_16")):
+            os.mkdir(os.path.join(tmp, 'gpio%d' % number))
+            open(os.path.join(tmp, 'gpio%d' % number, 'value'), 'w').close()
+        registers = os.path.join(tmp, 'gpio1')
+        with open(registers, 'wb') as f:
+            f.write(b'\xff' * BANK_SIZE)
+
+        gpio = fake_gpio.FakeGPIO("P9_14", "P9_16")
+        lines = fake_gpio.FakeLines()
+        backends = [
+            (GPIOModuleBackend("P9_14", "P9_16", gpio=gpio), lambda: gpio.bits),
+            (SysfsBackend("P9_14", "P9_16", root=tmp), None),
+            (GpiodBackend("P9_14", "P9_16", lines=lines), lambda: lines.bits),
+            (MmapBackend("P9_14", "P9_16", path=registers), None),
+        ]
+        for backend, clocked in backends:
+            repeat = 20
+            stime = time.time()
+            for n in range(repeat):
+                backend.emit(bits)
+            elapsed = time.time() - stime
+            if backend.name == 'mmap':
+                # A file cannot act like the set/clear registers, so check the writes against fake ones
+                timed_regs = backend.regs
+                regs = fake_gpio.FakeRegisters(backend.clk_mask, backend.data_mask)
+                backend.regs = regs
+                backend.level = None
+                backend.emit(bits)
+                backend.regs = timed_regs
+                clocked = lambda: regs.bits
+            check = ''
+            if clocked is not None:
+                check = ', bits received match' if clocked()[-len(bits):] == bits else ', BITS RECEIVED DIFFER'
+            print("%-12s %8.0f kbit/s, a 64 LED frame in %6.2f ms%s" % (
+                backend.name, len(bits) * repeat / elapsed / 1000, elapsed / repeat * 1000, check))
+            backend.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    benchmark()
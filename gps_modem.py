@@ -4,7 +4,6 @@ gps_modem.py - used to work with the modem.
 """
 import logging
 import time
-import serial_mutex
 import re
 import sys
 
@@ -15,13 +14,38 @@ def to_bytes(s):
     return ''.join(map(unichr, s))
 
 
+# The <stat> values of +CEREG that count as registered: home network, unknown (which test_cereg has always accepted)
+# and roaming
+REGISTERED_STATES = (1, 4, 5)
+
+
+def is_registered(stat):
+    """True if ``stat``, as returned by GPSModem.get_registration, means the modem is registered"""
+    return stat in REGISTERED_STATES
+
+
 class GPSModem:
-    def __init__(self):
+    def __init__(self, ser=None, probe=True):
+        """
+        :param ser:     the SerialMutex to talk through. Defaults to the modem on /dev/ttyS4, pass a
+                        fake_modem.FakeModem to run without hardware.
+        :param probe:   run initialize() straight away. boot_display passes False and runs the probes itself, a stage
+                        at a time.
+        """
         self.sms_mode = 1
         fmt = '%(asctime)-15s %(message)s'
         logging.basicConfig(format=fmt, level=logging.INFO)
         self.logger = logging.getLogger('gps_modem')
-        self.ser = serial_mutex.SerialMutex()
+        if ser is None:
+            # pyserial is only needed for the real port
+            import serial_mutex
+            ser = serial_mutex.SerialMutex()
+        self.ser = ser
+        if probe:
+            self.initialize()
+
+    def initialize(self):
+        """Checks the modem is up, registered and has its PDP context, SMS and GPS. Raises IOError if any is not."""
         self.is_ok()
         self.logger.info("[gps_modem] Modem is ready...testing states")
         self.set_verbose_error()
@@ -81,6 +105,38 @@ class GPSModem:
                 self.logger.error("[gps_modem] Failed to set ME functionality (AT+CFUN?)...")
                 raise IOError("Modem is not fully functional")
 
+    def get_functionality(self):
+        """Non-raising AT+CFUN? query, returns the functionality level (1 = full) or -1 if it could not be read"""
+        try:
+            out = self.ser.write('AT+CFUN?\r')
+            start = out.find('+CFUN: ')
+            if start != -1:
+                return int(out[start + 7:start + 8])
+            self.logger.error("[gps_modem] Failed to get ME functionality. out = %s", out)
+        except Exception as ex:
+            self.logger.exception("[gps_modem] Failed to read ME functionality (AT+CFUN?): %s", ex)
+        return -1
+
+    def set_functionality(self, fun):
+        """
+        Sets the ME functionality with AT+CFUN=<fun>. 0 turns the radio off, 1 turns it on and '1,1' reboots the
+        module into full functionality.
+        """
+        self.logger.info("[gps_modem] Setting ME functionality (AT+CFUN=%s)...", fun)
+        out = self.ser.write_wait('AT+CFUN=%s\r' % fun, 5)
+        if out.find('OK') == -1:
+            self.logger.error("[gps_modem] Failed to set ME functionality (AT+CFUN=%s). out = %s", fun, out)
+            raise IOError("Failed to set ME functionality")
+        return True
+
+    def select_operator_auto(self):
+        self.logger.info("[gps_modem] Selecting operator automatically (AT+COPS=0)...")
+        out = self.ser.write_wait('AT+COPS=0\r', 5)
+        if out.find('OK') == -1:
+            self.logger.error("[gps_modem] Failed to select operator (AT+COPS=0). out = %s", out)
+            raise IOError("Failed to select operator")
+        return True
+
     def test_qcsq(self):
         self.logger.info("[gps_modem] Testing query and report signal strength (AT+QCSQ)...")
         out = self.ser.write('AT+QCSQ\r')
@@ -148,10 +204,15 @@ class GPSModem:
             self.logger.error("[gps_modem] Failed to get registration. out = %s", out)
             raise IOError("Failed to get registration")
 
-    def test_qiact(self, attempts):
+    def test_qiact(self, attempts=0):
         self.logger.info("[gps_modem] Querying PCP context (AT+QIACT?)...")
-        out = self.ser.write_wait('AT+QIACT?\r', 5)
-        if out.find('OK') != -1 & attempts < 2:
+        while True:
+            out = self.ser.write_wait('AT+QIACT?\r', 5)
+            if out.find('OK') == -1 or attempts >= 2:
+                self.logger.error("[gps_modem] Failed to activate PCP context (AT+QIACT?). attempts = %d, out = %s",
+                                  attempts, out)
+                raise IOError("Failed to activate PCP context")
+
             # https://www.quectel.com/UploadImage/Downlad/Quectel_BG96_TCP(IP)_AT_Commands_Manual_V1.0.pdf
             start = out.find('+QIACT: ')
             if start != -1:
@@ -164,16 +225,27 @@ class GPSModem:
                 self.logger.debug("line=%s, parts=%s", line, parts)
                 self.logger.info("[gps_modem] IP address is %s", parts[3])
                 return True
-            else:
-                if self.activate_context():
-                    self.test_qiact(attempts + 1)
-                else:
-                    self.logger.error("[gps_modem] Failed to activate PCP context (AT+QIACT?).")
-                    raise IOError("Failed to activate PCP context")
-        else:
-            self.logger.error("[gps_modem] Failed to activate PCP context (AT+QIACT?). attempts = %d, out = %s",
-                              attempts, out)
-            raise IOError("Failed to activate PCP context")
+
+            # activate_context raises if the modem refuses, otherwise query again
+            self.activate_context()
+            attempts += 1
+
+    def is_context_active(self):
+        """Non-raising AT+QIACT? check, True if PDP context 1 is up"""
+        try:
+            out = self.ser.write('AT+QIACT?\r')
+            return out.find('+QIACT: 1,1') != -1
+        except Exception as ex:
+            self.logger.exception("[gps_modem] Failed to query PCP context (AT+QIACT?): %s", ex)
+            return False
+
+    def deactivate_context(self):
+        self.logger.info("[gps_modem] Deactivating PCP context (AT+QIDEACT=1)...")
+        out = self.ser.write_wait('AT+QIDEACT=1\r', 5)
+        if out.find('OK') == -1:
+            self.logger.error("[gps_modem] Failed to deactivate PCP context (AT+QIDEACT=1). out = %s", out)
+            raise IOError("Failed to deactivate PCP context")
+        return True
 
     def activate_context(self):
         self.logger.info("[gps_modem] Attempting to active PCP context (AT+QIACT=1)...")
@@ -198,6 +270,39 @@ class GPSModem:
         else:
             self.logger.info("[gps_modem] GPS is enabled")
 
+    def get_registration(self):
+        """
+        Same query as test_cereg, but reports the status instead of raising when the modem is not registered.
+        :return:    the <stat> field of AT+CEREG? (0-5), or -1 if it could not be read
+        """
+        try:
+            out = self.ser.write('AT+CEREG?\r')
+            start = out.find('+CEREG: ')
+            if start != -1 and out.find('OK') != -1:
+                end = out.find('\r', start)
+                parts = out[start + 8:end].split(',')
+                return int(parts[1])
+            self.logger.error("[gps_modem] Failed to get registration. out = %s", out)
+        except Exception as ex:
+            self.logger.exception("[gps_modem] Failed to read registration (AT+CEREG?): %s", ex)
+        return -1
+
+    def get_service_mode(self):
+        """
+        Same query as test_qcsq, but reports NOSERVICE instead of raising.
+        :return:    the fields of AT+QCSQ, e.g. ['eMTC', '-75', '-96', '134', '-13'], or [] if it could not be read
+        """
+        try:
+            out = self.ser.write('AT+QCSQ\r')
+            start = out.find('+QCSQ: ')
+            if start != -1 and out.find('OK') != -1:
+                end = out.find('\r', start)
+                return [p.strip('"') for p in out[start + 7:end].split(',')]
+            self.logger.error("[gps_modem] Failed to get service mode. out = %s", out)
+        except Exception as ex:
+            self.logger.exception("[gps_modem] Failed to read service mode (AT+QCSQ): %s", ex)
+        return []
+
     def get_rssi(self):
         try:
             out = self.ser.write('AT+CSQ\r')
@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+"""
+grove_bus.py - owns the I2C buses used by the grove_* modules, so the OLED, accelerometer and SHT31 on bus 2 share
+one adapter and their transactions cannot interleave.
+
+Each bus is an I2CBus that opens its adapter (smbus2 if it is installed, otherwise smbus) the first time it is used,
+and has the smbus methods the sensors use, plus device() for the Adafruit_GPIO.I2C.Device methods the OLED uses. Every
+transaction waits for the bus, and waiting devices take turns: each device's transactions run in the order they were
+asked for, one device after another, so neither a thread streaming the accelerometer nor several threads drawing on the
+OLED can starve the rest. Writes to a device that queued up while it waited go out together as one combined transfer
+when the adapter has i2c_rdwr. Each bus keeps the transactions, bytes, bus time and waiting time of every
+device.
+
+A sequence of transactions that must reach a device together, like the OLED's window and then its data, or an SHT31
+command and then its result, runs inside hold(), which keeps the device to one thread while the other devices on the
+bus carry on:
+
+    with grove_bus.hold(device):
+        ...
+
+Nothing is opened and no hardware library is imported until a bus is used, so the grove_* modules can be imported off
+the board. A fake adapter (e.g. fake_i2c.FakeSMBus) can be put under a bus with set_smbus, and a fake device in place
+of the OLED with set_i2c_device.
+"""
+import collections
+import threading
+import time
+import tracing
+
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# Longest SMBus block transfer. Longer writes go in one i2c_rdwr message where the adapter has it.
+SMBUS_BLOCK_MAX = 32
+
+# Linux takes up to 42 messages per I2C_RDWR
+MAX_BATCH = 32
+
+_lock = threading.Lock()
+_buses = {}
+_devices = {}
+
+
+class _Op(object):
+    __slots__ = ('address', 'kind', 'args', 'write', 'done', 'result', 'error')
+
+    def __init__(self, address, kind, args, write):
+        self.address = address
+        self.kind = kind
+        self.args = args
+        self.write = write
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class DeviceStats(object):
+    __slots__ = ('transactions', 'bytes', 'bus_time', 'hold_time', 'wait_time', 'batched')
+
+    def __init__(self):
+        self.transactions = 0
+        self.bytes = 0
+        self.bus_time = 0.0
+        self.hold_time = 0.0
+        self.wait_time = 0.0
+        self.batched = 0
+
+
+class I2CBus(object):
+    def __init__(self, adapter=None, busnum=2, clock_hz=100000, max_batch=MAX_BATCH):
+        """
+        :param adapter:     an smbus.SMBus compatible object, or None to open bus ``busnum`` on first use
+        :param clock_hz:    the bus clock, to work out how long each transaction keeps the bus busy
+        :param max_batch:   most queued writes to send as one combined transfer
+        """
+        self.busnum = busnum
+        self.clock_hz = clock_hz
+        self.max_batch = max_batch
+        self._adapter = adapter
+        self._i2c_msg = None
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._turns = collections.deque()
+        self._holders = {}
+        self._busy = False
+        self.reset_stats()
+
+    @property
+    def adapter(self):
+        if self._adapter is None:
+            with self._cond:
+                if self._adapter is None:
+                    self._adapter = _open_smbus(self.busnum)
+        return self._adapter
+
+    def reset_stats(self):
+        self.stats = {}
+        self.batches = 0
+        self._stats_start = _monotonic()
+
+    def device(self, address):
+        """An Adafruit_GPIO.I2C.Device-like handle for ``address`` on this bus"""
+        return I2CDevice(self, address)
+
+    def hold(self, address):
+        """
+        A context manager that keeps ``address`` to the calling thread, so its transactions to the device inside it
+        have no other thread's in between. Transactions already queued for the device go first, other threads' wait
+        until it exits, and the other devices keep their turns. Holds nest.
+        """
+        return _Hold(self, address)
+
+    # The smbus methods, each one a transaction in turn on the bus
+
+    def write_byte_data(self, address, register, value):
+        self._submit(_Op(address, 'write', (register, [value & 0xFF]), True))
+
+    def write_i2c_block_data(self, address, register, data):
+        self._submit(_Op(address, 'write', (register, list(data)), True))
+
+    def read_byte_data(self, address, register):
+        return self._submit(_Op(address, 'read_byte', (register,), False))
+
+    def read_i2c_block_data(self, address, register, length=SMBUS_BLOCK_MAX):
+        return self._submit(_Op(address, 'read_block', (register, length), False))
+
+    def i2c_rdwr(self, *messages):
+        address = messages[0].addr if messages else None
+        return self._submit(_Op(address, 'rdwr', messages, False))
+
+    def close(self):
+        with self._cond:
+            if self._adapter is not None:
+                self._adapter.close()
+                self._adapter = None
+
+    def utilization(self):
+        """
+        Per device address: transactions, bytes, estimated bus time and its share of the time since the stats were
+        reset, how long the bus was held and how long callers waited for it (seconds), and writes that were batched
+        """
+        elapsed = max(_monotonic() - self._stats_start, 1e-9)
+        result = {}
+        for address, stats in list(self.stats.items()):
+            result[address] = {
+                'transactions': stats.transactions,
+                'bytes': stats.bytes,
+                'bus_time': stats.bus_time,
+                'utilization': stats.bus_time / elapsed,
+                'hold_time': stats.hold_time,
+                'wait_time': stats.wait_time,
+                'batched': stats.batched,
+            }
+        return result
+
+    def _acquire(self, address):
+        me = get_ident()
+        queued = _monotonic()
+        with tracing.span('grove_bus.wait', 'i2c', address):
+            with self._cond:
+                holder = self._holders.get(address)
+                if holder is not None and holder[0] == me:
+                    holder[1] += 1
+                    return
+                while address in self._holders:
+                    self._cond.wait()
+                self._holders[address] = [me, 1]
+                # Transactions queued for the device before the hold go first
+                while address in self._pending:
+                    self._cond.wait()
+                self._stats(address).wait_time += _monotonic() - queued
+
+    def _release(self, address):
+        with self._cond:
+            holder = self._holders[address]
+            holder[1] -= 1
+            if not holder[1]:
+                del self._holders[address]
+                self._cond.notify_all()
+
+    def _submit(self, op):
+        queued = _monotonic()
+        with tracing.span('grove_bus.wait', 'i2c', op.address):
+            with self._cond:
+                if self._holders:
+                    # Another thread's hold on the device keeps this one out of its queue until it is released
+                    me = get_ident()
+                    while self._holders.get(op.address, (me,))[0] != me:
+                        self._cond.wait()
+                pending = self._pending.get(op.address)
+                if pending is None:
+                    pending = self._pending[op.address] = collections.deque()
+                    self._turns.append(op.address)
+                pending.append(op)
+                while not op.done and (self._busy or self._turns[0] != op.address or pending[0] is not op):
+                    self._cond.wait()
+                if not op.done:
+                    # Our turn: take the bus, along with any writes to the same device queued right behind this one
+                    self._busy = True
+                    batch = [pending.popleft()]
+                    if op.write:
+                        while pending and len(batch) < self.max_batch and pending[0].write:
+                            batch.append(pending.popleft())
+                    # Then the next device gets a turn
+                    self._turns.popleft()
+                    if pending:
+                        self._turns.append(op.address)
+                    else:
+                        del self._pending[op.address]
+        if not op.done:
+            start = _monotonic()
+            try:
+                with tracing.span('grove_bus.transfer', 'i2c', op.address):
+                    self._run(batch)
+            finally:
+                held = _monotonic() - start
+                with self._cond:
+                    stats = self._stats(op.address)
+                    stats.wait_time += start - queued
+                    stats.hold_time += held
+                    for other in batch:
+                        other.done = True
+                    self._busy = False
+                    self._cond.notify_all()
+        else:
+            with self._cond:
+                self._stats(op.address).wait_time += _monotonic() - queued
+        if op.error is not None:
+            raise op.error
+        return op.result
+
+    def _stats(self, address):
+        stats = self.stats.get(address)
+        if stats is None:
+            stats = self.stats[address] = DeviceStats()
+        return stats
+
+    def _account(self, address, messages, length):
+        # 9 clocks per byte (the address byte and a register byte included), a start and a stop per transaction and a
+        # repeated start per extra message, as in fake_i2c
+        stats = self._stats(address)
+        stats.transactions += 1
+        stats.bytes += length
+        stats.bus_time += (11 + (messages - 1) + 9 * length) / float(self.clock_hz)
+
+    def _run(self, batch):
+        adapter = self.adapter
+        if len(batch) > 1 and hasattr(adapter, 'i2c_rdwr'):
+            messages = [self._write_msg(op.address, op.args) for op in batch]
+            try:
+                adapter.i2c_rdwr(*messages)
+            except Exception as ex:
+                for op in batch:
+                    op.error = ex
+                return
+            self.batches += 1
+            self._stats(batch[0].address).batched += len(batch)
+            self._account(batch[0].address, len(batch), sum(len(op.args[1]) + 2 for op in batch))
+            return
+        for op in batch:
+            try:
+                op.result = self._run_one(adapter, op)
+            except Exception as ex:
+                op.error = ex
+
+    def _run_one(self, adapter, op):
+        if op.kind == 'write':
+            register, data = op.args
+            if len(data) <= SMBUS_BLOCK_MAX or not hasattr(adapter, 'i2c_rdwr'):
+                adapter.write_i2c_block_data(op.address, register, data)
+            else:
+                adapter.i2c_rdwr(self._write_msg(op.address, op.args))
+            self._account(op.address, 1, 2 + len(data))
+        elif op.kind == 'read_byte':
+            result = adapter.read_byte_data(op.address, op.args[0])
+            self._account(op.address, 2, 4)
+            return result
+        elif op.kind == 'read_block':
+            result = adapter.read_i2c_block_data(op.address, op.args[0], op.args[1])
+            self._account(op.address, 2, 3 + op.args[1])
+            return result
+        else:
+            result = adapter.i2c_rdwr(*op.args)
+            self._account(op.address, len(op.args), sum(1 + len(m) for m in op.args))
+            return result
+
+    def _write_msg(self, address, args):
+        if self._i2c_msg is None:
+            self._i2c_msg = getattr(self.adapter, 'i2c_msg', None)
+            if self._i2c_msg is None:
+                from smbus2 import i2c_msg
+                self._i2c_msg = i2c_msg
+        register, data = args
+        return self._i2c_msg.write(address, [register] + list(data))
+
+
+class _Hold(object):
+    __slots__ = ('bus', 'address')
+
+    def __init__(self, bus, address):
+        self.bus = bus
+        self.address = address
+
+    def __enter__(self):
+        self.bus._acquire(self.address)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.bus._release(self.address)
+        return False
+
+
+class _NotHeld(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NOT_HELD = _NotHeld()
+
+
+class I2CDevice(object):
+    """The Adafruit_GPIO.I2C.Device methods for one device, through an I2CBus"""
+    def __init__(self, bus, address):
+        self.bus = bus
+        self.address = address
+
+    def hold(self):
+        """See I2CBus.hold"""
+        return self.bus.hold(self.address)
+
+    def write8(self, register, value):
+        self.bus.write_byte_data(self.address, register, value)
+
+    def writeList(self, register, data):
+        # Adafruit_PureIO sends any length in one write. An adapter without i2c_rdwr is held to SMBus blocks, which
+        # is the same for the OLED's command and data streams, the only longer writes.
+        if len(data) > SMBUS_BLOCK_MAX and not hasattr(self.bus.adapter, 'i2c_rdwr'):
+            for i in range(0, len(data), SMBUS_BLOCK_MAX):
+                self.bus.write_i2c_block_data(self.address, register, data[i:i + SMBUS_BLOCK_MAX])
+        else:
+            self.bus.write_i2c_block_data(self.address, register, data)
+
+    def readU8(self, register):
+        return self.bus.read_byte_data(self.address, register)
+
+    def readList(self, register, length):
+        return bytearray(self.bus.read_i2c_block_data(self.address, register, length))
+
+
+def _open_smbus(busnum):
+    try:
+        import smbus2 as smbus
+    except ImportError:
+        import smbus
+    return smbus.SMBus(busnum)
+
+
+def get_bus(busnum=2):
+    """The I2CBus for ``busnum``, shared by every device on that bus"""
+    bus = _buses.get(busnum)
+    if bus is None:
+        with _lock:
+            bus = _buses.get(busnum)
+            if bus is None:
+                bus = _buses[busnum] = I2CBus(busnum=busnum)
+    return bus
+
+
+def get_smbus(busnum=2):
+    """The smbus.SMBus-like handle for ``busnum``, shared by every sensor on that bus"""
+    return get_bus(busnum)
+
+
+def get_i2c_device(address, busnum=2):
+    """An Adafruit_GPIO.I2C.Device-like handle for ``address`` on ``busnum``, shared by everything that uses it"""
+    device = _devices.get((address, busnum))
+    if device is None:
+        bus = get_bus(busnum)
+        with _lock:
+            device = _devices.get((address, busnum))
+            if device is None:
+                device = _devices[(address, busnum)] = bus.device(address)
+    return device
+
+
+def set_smbus(adapter, busnum=2):
+    """Puts ``adapter`` (or an I2CBus) under bus ``busnum``, for the devices opened after this"""
+    with _lock:
+        _buses[busnum] = adapter if isinstance(adapter, I2CBus) else I2CBus(adapter, busnum)
+        # Handles on the old bus are opened again on the new one; devices put in place with set_i2c_device stay
+        for key, device in list(_devices.items()):
+            if key[1] == busnum and isinstance(device, I2CDevice):
+                del _devices[key]
+    return _buses[busnum]
+
+
+def set_i2c_device(device, address, busnum=2):
+    """Uses ``device`` for ``address`` on ``busnum`` directly, bypassing the bus"""
+    with _lock:
+        _devices[(address, busnum)] = device
+
+
+def hold(handle, *address):
+    """
+    ``handle.hold(*address)``, for an I2CDevice or an I2CBus and the address, or a hold that does nothing for a bare
+    adapter or a device put in place with set_i2c_device, which have no queue to hold
+    """
+    method = getattr(handle, 'hold', None)
+    return method(*address) if method is not None else _NOT_HELD
+
+
+def reset():
+    """Forgets every bus and device, so the next use opens (or is given) a new one"""
+    with _lock:
+        _buses.clear()
+        _devices.clear()
+
+
+def benchmark():
+    # Three threads each drawing a line of text on the OLED 20 times a second, one streaming the accelerometer at
+    # 400Hz and one reading the SHT31 at 10/s, for 3 seconds on a fake 400kHz bus 2 that runs in real time. First each
+    # thread uses the adapter directly, which lets transactions overlap, then all of them go through an I2CBus.
+    import fake_i2c
+    import grove_accel
+    import grove_oled
+    import grove_sht31
+
+    seconds = 3.0
+    for managed in (False, True):
+        adapter = fake_i2c.FakeSMBus(clock=time, clock_hz=400000)
+        oled = adapter.attach(grove_oled.Oled_Address, fake_i2c.FakeSSD1327(clock_hz=400000))
+        adapter.attach(grove_accel.ADXL345_DEVICE, fake_i2c.FakeADXL345(time))
+        adapter.attach(grove_sht31.SHT31_DEVICE, fake_i2c.FakeSHT31(time))
+        reset()
+        bus = set_smbus(I2CBus(adapter, clock_hz=400000)) if managed else adapter
+        if not managed:
+            set_i2c_device(_RawDevice(adapter, grove_oled.Oled_Address), grove_oled.Oled_Address)
+        adxl345 = grove_accel.ADXL345(bus=bus)
+        sht31 = grove_sht31.SHT31(bus=bus)
+        sht31.start(10)
+        end = _monotonic() + seconds
+        counts = collections.Counter()
+        errors = []
+
+        def drawer(row):
+            while _monotonic() < end:
+                with grove_oled.oled_hold():
+                    grove_oled.oled_setTextXY(row, 0)
+                    grove_oled.oled_putString("%-12d" % counts['oled'])
+                counts['oled'] += 1
+                time.sleep(0.05)
+
+        def streamer():
+            for timestamp, data, count in adxl345.stream(grove_accel.BW_RATE_400HZ):
+                counts['accel'] += count
+                if _monotonic() >= end:
+                    break
+
+        def thermometer():
+            while _monotonic() < end:
+                try:
+                    sht31.read()
+                    counts['sht31'] += 1
+                except IOError as ex:
+                    errors.append(ex)
+                time.sleep(0.01)
+
+        threads = [threading.Thread(target=drawer, args=(row,)) for row in range(3)]
+        threads += [threading.Thread(target=streamer), threading.Thread(target=thermometer)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print("%-10s %4d transfers overlapped, %5d text lines, %5d samples, %3d SHT31 reads, %d SHT31 errors, "
+              "bus %2.0f%% busy" % ('I2CBus' if managed else 'unmanaged', adapter.collisions, counts['oled'],
+                                    counts['accel'], counts['sht31'], len(errors),
+                                    adapter.bus_time() / seconds * 100))
+        if managed:
+            for address, stats in sorted(bus.utilization().items()):
+                print("    0x%02x %5d transactions %6d bytes, %4.1f%% of the bus, waited %6.1f ms in all, %4d writes "
+                      "batched" % (address, stats['transactions'], stats['bytes'], stats['utilization'] * 100,
+                                   stats['wait_time'] * 1000, stats['batched']))
+    reset()
+
+
+class _RawDevice(object):
+    # The OLED straight on an adapter, for the unmanaged benchmark run
+    def __init__(self, adapter, address):
+        self.adapter = adapter
+        self.address = address
+
+    def write8(self, register, value):
+        self.adapter.write_byte_data(self.address, register, value)
+
+    def writeList(self, register, data):
+        self.adapter.write_i2c_block_data(self.address, register, data)
+
+
+if __name__ == "__main__":
+    # The grove modules use the imported grove_bus, not this __main__ copy of it
+    import grove_bus
+    grove_bus.benchmark()
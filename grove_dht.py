@@ -1,30 +1,216 @@
 #!/usr/bin/python
 #
 #
+import logging
+import threading
 import time
-import Adafruit_DHT
+import tracing
 
+_monotonic = getattr(time, 'monotonic', time.time)
 
-def read():
-    pin = 2
-    sensor = Adafruit_DHT.DHT22
+DHT_PIN = 2
 
-    h2, t2 = Adafruit_DHT.read_retry(sensor, pin)
+# The DHT22 needs 2 seconds between reads
+MIN_INTERVAL = 2.0
 
-    if h2 is None or t2 is None:
-        h = 0
-        t = 0
-    else:
-        h = h2
-        t = t2
+# Anything outside the DHT22's range is a bad read that got past the checksum
+TEMPERATURE_RANGE = (-40.0, 80.0)
+HUMIDITY_RANGE = (0.0, 100.0)
 
-    return h, t
+
+class Reading(object):
+    """
+    The latest good reading and when it was taken, plus how many reads have failed since. ``valid`` is False before
+    the first good read and once the reading is older than ``max_age``.
+    """
+    __slots__ = ('humidity', 'temperature', 'timestamp', 'monotonic', 'failures', 'max_age')
+
+    def __init__(self, humidity=None, temperature=None, failures=0, max_age=None, timestamp=None, monotonic=None):
+        self.humidity = humidity
+        self.temperature = temperature
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        self.monotonic = monotonic if monotonic is not None else _monotonic()
+        self.failures = failures
+        self.max_age = max_age
+
+    def age(self):
+        return _monotonic() - self.monotonic
+
+    @property
+    def stale(self):
+        return self.max_age is not None and self.age() > self.max_age
+
+    @property
+    def valid(self):
+        return self.temperature is not None and not self.stale
+
+    def __repr__(self):
+        return 'Reading(humidity=%r, temperature=%r, age=%.1f, failures=%d, valid=%s)' % (
+            self.humidity, self.temperature, self.age(), self.failures, self.valid)
+
+
+class DHTReader(object):
+    # Reads the sensor on a background thread every interval seconds, retrying a failed read after MIN_INTERVAL, so
+    # get() only ever returns what is in memory.
+    # dht: Adafruit_DHT (the default, imported on the reader thread) or an object with the same read(sensor, pin)
+    # max_age: seconds after which the last good reading is no longer valid, by default three intervals
+    def __init__(self, pin=DHT_PIN, sensor=None, interval=10.0, max_age=None, dht=None):
+        self.logger = logging.getLogger('grove_dht')
+        self.pin = pin
+        self.sensor = sensor
+        self.interval = max(interval, MIN_INTERVAL)
+        self.max_age = max_age if max_age is not None else self.interval * 3
+        self.retry_interval = MIN_INTERVAL
+        self.dht = dht
+        self.reads = 0
+        self.failures = 0
+        self._reading = Reading(max_age=self.max_age)
+        self._first = threading.Event()
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='grove_dht')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # the latest Reading, starting the reader if it is not running. wait is how long to wait for the first good
+    # read, if there has not been one yet.
+    def get(self, wait=0):
+        if not self._running:
+            self.start()
+        if wait and not self._first.is_set():
+            self._first.wait(wait)
+        return self._reading
+
+    def _read(self):
+        if self.dht is None:
+            import Adafruit_DHT
+            self.dht = Adafruit_DHT
+        if self.sensor is None:
+            self.sensor = self.dht.DHT22
+        with tracing.span('grove_dht.read', 'sensor', self.pin) as span:
+            humidity, temperature = self.dht.read(self.sensor, self.pin)
+            if humidity is None or temperature is None:
+                span.set('failed')
+                return None
+            if not (TEMPERATURE_RANGE[0] <= temperature <= TEMPERATURE_RANGE[1] and
+                    HUMIDITY_RANGE[0] <= humidity <= HUMIDITY_RANGE[1]):
+                span.set('out of range')
+                return None
+        return humidity, temperature
+
+    def _run(self):
+        while self._running:
+            self.reads += 1
+            try:
+                values = self._read()
+            except Exception as ex:
+                self.logger.exception("[grove_dht] Failed to read the sensor: %s", ex)
+                values = None
+            last = self._reading
+            if values is not None:
+                self._reading = Reading(values[0], values[1], 0, self.max_age)
+                self._first.set()
+                wait = self.interval
+            else:
+                self.failures += 1
+                self._reading = Reading(last.humidity, last.temperature, last.failures + 1, self.max_age,
+                                        last.timestamp, last.monotonic)
+                wait = self.retry_interval
+            self._wakeup.wait(wait)
+
+
+_reader = None
+_reader_lock = threading.Lock()
+
+
+# the shared DHTReader for the Grove DHT22
+def reader():
+    global _reader
+    if _reader is None:
+        with _reader_lock:
+            if _reader is None:
+                _reader = DHTReader()
+    return _reader
+
+
+# (humidity, temperature) from the shared reader without waiting for the sensor, or (None, None) if there is no valid
+# reading
+def read(wait=0):
+    reading = reader().get(wait)
+    if not reading.valid:
+        return None, None
+    return reading.humidity, reading.temperature
+
+
+def benchmark():
+    # Caller latency of read_retry, the way read() used to work, against DHTReader.get, with a simulated DHT22 that
+    # fails every other read and one that fails them all. Sensor timings are scaled down 20 times to keep the run short,
+    # and the read_retry latencies scaled back up.
+    import fake_gpio
+
+    scale = 20.0
+    for name, fail_every in (('flaky sensor', 2), ('no sensor', 1)):
+        dht = fake_gpio.FakeDHT22(read_time=0.025 / scale, fail_every=fail_every)
+        calls = 3
+        latency = []
+        failed = 0
+        for n in range(calls):
+            stime = _monotonic()
+            humidity, temperature = dht.read_retry(dht.DHT22, DHT_PIN, delay_seconds=MIN_INTERVAL / scale)
+            latency.append(_monotonic() - stime)
+            if humidity is None or temperature is None:
+                failed += 1
+        print("%-12s read_retry    latency mean %8.3f ms max %8.3f ms, %d of %d calls failed (0 degrees)" % (
+            name, sum(latency) / calls * 1000 * scale, max(latency) * 1000 * scale, failed, calls))
+
+        dht = fake_gpio.FakeDHT22(read_time=0.025 / scale, fail_every=fail_every)
+        dht_reader = DHTReader(dht=dht)
+        dht_reader.interval = dht_reader.retry_interval = MIN_INTERVAL / scale
+        dht_reader.get(wait=0.5)
+        latency = []
+        invalid = 0
+        end = _monotonic() + 1.0
+        while _monotonic() < end:
+            stime = _monotonic()
+            reading = dht_reader.get()
+            latency.append(_monotonic() - stime)
+            if not reading.valid:
+                invalid += 1
+            time.sleep(0.001)
+        dht_reader.stop()
+        calls = len(latency)
+        print("%-12s DHTReader.get latency mean %8.3f ms max %8.3f ms, %d of %d calls invalid, %d sensor reads "
+              "(%d failed) on the reader thread" % (name, sum(latency) / calls * 1000, max(latency) * 1000, invalid,
+                                                    calls, dht_reader.reads, dht_reader.failures))
 
 
 if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+        sys.exit(0)
+
+    dht_reader = reader()
+    dht_reader.get(wait=10)
     while True:
-        humidity, temperature = read()
-        print('Temp={0:0.1f}*  Humidity={1:0.1f}%'.format(temperature, humidity))
+        reading = dht_reader.get()
+        if reading.valid:
+            print('Temp={0:0.1f}*  Humidity={1:0.1f}%'.format(reading.temperature, reading.humidity))
+        else:
+            print('No valid reading: {0}'.format(reading))
 
         # Wait half a second and repeat.
         time.sleep(0.5)
@@ -32,102 +32,150 @@
 # -*- coding: utf-8 -*-
 
 import time
-import Adafruit_BBIO.GPIO as GPIO
 
 CLK_PIN = "P9_14"
 DATA_PIN = "P9_16"
 NUMBER_OF_LEDS = 1
 
+
+def colorBytes(red, green, blue):
+    "The 4 bytes that set one LED: '1 1 /B7 /B6 /G7 /G6 /R7 /R6', then blue, green and red"
+    # prefix = B11000000
+    prefix = 0xC0
+    if (blue & 0x80) == 0:
+        prefix |= 0x20
+    if (blue & 0x40) == 0:
+        prefix |= 0x10
+    if (green & 0x80) == 0:
+        prefix |= 0x08
+    if (green & 0x40) == 0:
+        prefix |= 0x04
+    if (red & 0x80) == 0:
+        prefix |= 0x02
+    if (red & 0x40) == 0:
+        prefix |= 0x01
+    return bytearray([prefix, blue & 0xFF, green & 0xFF, red & 0xFF])
+
+
+def frameBits(frame):
+    "The bits of a frame, MSB first"
+    bits = []
+    for b in frame:
+        for i in range(7, -1, -1):
+            bits.append((b >> i) & 0x01)
+    return bits
+
+
 class ChainableLED():
-    def __init__(self, clk_pin, data_pin, number_of_leds):
-        self.__clk_pin = clk_pin
-        self.__data_pin = data_pin
+    """
+    A chain of P9813 RGB LEDs. setColor() only records the color; show() sends the whole chain in one frame, and does
+    nothing if the frame is the same as the last one sent. setColorRGB() does both, as before.
+
+    The frame's bits go out through a gpio_backend backend in one emit() call. By default that is a GPIOModuleBackend
+    on gpio, which is anything with the Adafruit_BBIO.GPIO setup/output interface (e.g. fake_gpio.FakeGPIO) and
+    defaults to Adafruit_BBIO.GPIO. clock_delay is the time each clock level is held; the P9813 takes clocks far
+    faster than Python can toggle a pin, so by default there is none.
+    """
+    def __init__(self, clk_pin, data_pin, number_of_leds, gpio=None, clock_delay=0, backend=None):
+        if backend is None:
+            import gpio_backend
+            backend = gpio_backend.GPIOModuleBackend(clk_pin, data_pin, gpio, clock_delay)
+        self.__backend = backend
         self.__number_of_leds = number_of_leds
+        self.__colors = [(0, 0, 0)] * number_of_leds
+        self.__sent = None
+        self.frames_sent = 0
+        self.frames_skipped = 0
 
-        GPIO.setup(self.__clk_pin, GPIO.OUT)
-        GPIO.setup(self.__data_pin, GPIO.OUT)
+        self.show()
 
-        for i in range(self.__number_of_leds):
-            self.setColorRGB(i, 0, 0, 0)
-
-    def clk(self):
-        GPIO.output(self.__clk_pin, GPIO.LOW)
-        time.sleep(0.00002)
-        GPIO.output(self.__clk_pin, GPIO.HIGH)
-        time.sleep(0.00002)
+    def sendBits(self, bits):
+        self.__backend.emit(bits)
 
     def sendByte(self, b):
         "Send one bit at a time, starting with the MSB"
-        for i in range(8):
-            # If MSB is 1, write one and clock it, else write 0 and clock
-            if (b & 0x80) != 0:
-                GPIO.output(self.__data_pin, GPIO.HIGH)
-            else:
-                GPIO.output(self.__data_pin, GPIO.LOW)
-            self.clk()
-
-            # Advance to the next bit to send
-            b = b << 1
+        self.sendBits(frameBits([b & 0xFF]))
 
     def sendColor(self, red, green, blue):
-        "Start by sending a byte with the format '1 1 /B7 /B6 /G7 /G6 /R7 /R6' "
-        # prefix = B11000000
-        prefix = 0xC0
-        if (blue & 0x80) == 0:
-            # prefix |= B00100000
-            prefix |= 0x20
-        if (blue & 0x40) == 0:
-            # prefix |= B00010000
-            prefix |= 0x10
-        if (green & 0x80) == 0:
-            # prefix |= B00001000
-            prefix |= 0x08
-        if (green & 0x40) == 0:
-            # prefix |= B00000100
-            prefix |= 0x04
-        if (red & 0x80) == 0:
-            # prefix |= B00000010
-            prefix |= 0x02
-        if (red & 0x40) == 0:
-            # prefix |= B00000001
-            prefix |= 0x01
-        self.sendByte(prefix)
-
-        # Now must send the 3 colors
-        self.sendByte(blue)
-        self.sendByte(green)
-        self.sendByte(red)
+        self.sendBits(frameBits(colorBytes(red, green, blue)))
+
+    def getColor(self, led):
+        return self.__colors[led]
+
+    def setColor(self, led, red, green, blue):
+        "Sets one LED's color for the next show()"
+        self.__colors[led] = (red, green, blue)
+
+    def fill(self, red, green, blue):
+        self.__colors = [(red, green, blue)] * self.__number_of_leds
+
+    def frame(self):
+        "The complete frame for the current colors: 32x '0', 4 bytes per LED, 32x '0'"
+        frame = bytearray(4)
+        for red, green, blue in self.__colors:
+            frame += colorBytes(red, green, blue)
+        frame += bytearray(4)
+        return frame
+
+    def show(self):
+        "Sends the colors to the chain if they changed since the last show(), returns whether anything was sent"
+        frame = self.frame()
+        if frame == self.__sent:
+            self.frames_skipped += 1
+            return False
+        self.sendBits(frameBits(frame))
+        self.__sent = frame
+        self.frames_sent += 1
+        return True
 
     def setColorRGB(self, led, red, green, blue):
-        # Send data frame prefix (32x '0')
-        self.sendByte(0x00)
-        self.sendByte(0x00)
-        self.sendByte(0x00)
-        self.sendByte(0x00)
-
-        # Send color data for each one of the leds
-        for i in range(self.__number_of_leds):
-            '''
-            if i == led:
-                _led_state[i*3 + _CL_RED] = red;
-                _led_state[i*3 + _CL_GREEN] = green;
-                _led_state[i*3 + _CL_BLUE] = blue;
-            sendColor(_led_state[i*3 + _CL_RED], 
-                      _led_state[i*3 + _CL_GREEN], 
-                      _led_state[i*3 + _CL_BLUE]);
-            '''
-            self.sendColor(red, green, blue)
-
-        # Terminate data frame (32x "0")
-        self.sendByte(0x00)
-        self.sendByte(0x00)
-        self.sendByte(0x00)
-        self.sendByte(0x00)
+        self.setColor(led, red, green, blue)
+        self.show()
+
+
+def benchmark():
+    # Frames per second for a long chain against a fake GPIO, which costs far less per call than Adafruit_BBIO
+    import fake_gpio
+    gpio = fake_gpio.FakeGPIO(CLK_PIN, DATA_PIN)
+    leds = 64
+    rgb_led = ChainableLED(CLK_PIN, DATA_PIN, leds, gpio=gpio)
+    frames = 200
+
+    gpio.reset_counters()
+    stime = time.time()
+    for n in range(frames):
+        rgb_led.setColor(n % leds, n % 256, 255 - n % 256, 0)
+        rgb_led.show()
+    elapsed = time.time() - stime
+    print("%d LEDs, one LED changed per frame: %.0f frames/s, %d GPIO calls per frame" % (
+        leds, frames / elapsed, gpio.outputs / frames))
+    expected = [rgb_led.getColor(i) for i in range(leds)]
+    print("colors match: %s" % (gpio.p9813_colors() == expected))
+
+    gpio.reset_counters()
+    stime = time.time()
+    for n in range(frames):
+        rgb_led.show()
+    elapsed = time.time() - stime
+    print("%d LEDs, unchanged frames: %.0f frames/s, %d GPIO calls" % (leds, frames / elapsed, gpio.outputs))
+
+    # The old driver: every clock edge slept 20us, which on Linux usually means 80us or more
+    gpio.reset_counters()
+    slow = ChainableLED(CLK_PIN, DATA_PIN, leds, gpio=gpio, clock_delay=0.00002)
+    stime = time.time()
+    slow.fill(255, 0, 0)
+    slow.show()
+    elapsed = time.time() - stime
+    print("%d LEDs with 20us clock sleeps: %.1f frames/s" % (leds, 1 / elapsed))
 
 
 # Note: Use P9_22(UART2_RXD) and P9_21(UART2_TXD) as GPIO.
 # Connect the Grove - Chainable RGB LED to UART Grove port of Beaglebone Green.
 if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+        sys.exit(0)
     rgb_led = ChainableLED(CLK_PIN, DATA_PIN, NUMBER_OF_LEDS)
     print('Cycling RGB LED...')
     while True:
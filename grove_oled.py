@@ -40,19 +40,35 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import Adafruit_GPIO.I2C as I2C
+import grove_bus
 import time
+import tracing
 
 
-Oled = I2C.Device(0x3c, 2)
+Oled_Address=0x3c
+Oled_Bus=2
 Command_Mode=0x80
+Command_Stream=0x00
 Data_mode=0x40
 
+# Largest writeList we send in one I2C transaction. grove_bus sends it as one i2c_rdwr message with smbus2, and in
+# SMBus blocks of 32 bytes with the C smbus module.
+Max_Block=1024
+
+Width=96
+Height=96
+Columns=48    # Each column address holds 2 pixels
+
+# Partial refresh: dirty columns this close together go in one window, since a new window costs about as many bus
+# bytes (a 7 byte command transaction and the data transaction's overhead) as resending a column of a text row.
+Merge_Gap=1
+
+Ram_Rows=128    # The controller has 128 rows of RAM, Height of which show, starting at the display start line
+
 grayH= 0xF0
 grayL= 0x0F
 Normal_Display_Cmd=0xA4
 
-BasicFont = [[0 for x in xrange(8)] for x in xrange(10)]
 BasicFont=[[0x00,0x00,0x00,0x00,0x00,0x00,0x00,0x00],
            [0x00,0x00,0x5F,0x00,0x00,0x00,0x00,0x00],
            [0x00,0x00,0x07,0x00,0x07,0x00,0x00,0x00],
@@ -200,20 +216,44 @@ def oled_init():
     grayH= 0xF0
     grayL= 0x0F
 
+def oled():
+    # The I2C device, opened on first use. grove_bus.set_i2c_device() puts a fake in its place.
+    return grove_bus.get_i2c_device(Oled_Address,Oled_Bus)
+
+def oled_hold():
+    # Keeps the OLED to this thread across a window and its data, or oled_setTextXY and the text, so another thread's
+    # drawing cannot land in between. See grove_bus.hold.
+    return grove_bus.hold(oled())
+
 def sendCommand(byte):
-    Oled.write8(Command_Mode,byte)
+    oled().write8(Command_Mode,byte)
 
 def sendData(byte):
-    Oled.write8(Data_mode,byte)
+    oled().write8(Data_mode,byte)
 
 def multi_comm(commands):
     for c in commands:
         sendCommand(c)
 
+def sendCommands(commands):
+    # One transaction for a run of commands and their arguments
+    oled().writeList(Command_Stream,commands)
+
+def sendDataBlock(data):
+    device=oled()
+    with tracing.span('grove_oled.sendDataBlock','i2c',len(data)):
+        for i in range(0,len(data),Max_Block):
+            device.writeList(Data_mode,data[i:i+Max_Block])
+
+def oled_setWindow(Col_start,Col_end,Row_start,Row_end):
+    # Columns are column addresses (0-47, 2 pixels each), rows are 0-95. In vertical mode the data then fills each
+    # column top to bottom before moving right.
+    sendCommands([0x15,0x08+Col_start,0x08+Col_end,0x75,Row_start,Row_end])
+
 def oled_clearDisplay():
-    for j in range (0,48):
-        for i in range (0,96):
-            sendData(0x00)
+    with oled_hold():
+        oled_setWindow(0,Columns-1,0,Height-1)
+        sendDataBlock(bytearray(Columns*Height))
 
 def oled_setNormalDisplay():
     sendCommand(Normal_Display_Cmd)
@@ -231,33 +271,411 @@ def oled_setTextXY(Row,Column):
     sendCommand(0x00+(Row*8))     # Start Row
     sendCommand(0x07+(Row*8))     # End Row
 
-def oled_putChar(C):
-    C_add=ord(C)
-    if C_add<32 or C_add>127:     # Ignore non-printable ASCII characters
-        C=' '
-        C_add=ord(C)
+def oled_setGrayLevel(grayLevel):
+    global grayH,grayL
+    grayH=(grayLevel<<4)&0xF0
+    grayL=grayLevel&0x0F
 
+def renderGlyph(C_add,High,Low):
+    # The 32 bytes of one 8x8 character, 4 column addresses of 8 rows each, in the order vertical mode takes them
+    glyph=bytearray(32)
+    n=0
     for i in range(0,8,2):
         for j in range(0,8):
             c=0x00
-            bit1=((BasicFont[C_add-32][i])>>j)&0x01
-            bit2=((BasicFont[C_add-32][i+1])>>j)&0x01
-            if bit1:
-                c=c|grayH
+            if ((BasicFont[C_add-32][i])>>j)&0x01:
+                c=c|High
+            if ((BasicFont[C_add-32][i+1])>>j)&0x01:
+                c=c|Low
+            glyph[n]=c
+            n+=1
+    return glyph
+
+# Rendered glyphs for each (grayH, grayL) used so far, filled in on first use
+Glyph_Cache={}
+
+def glyphTable():
+    table=Glyph_Cache.get((grayH,grayL))
+    if table is None:
+        table=[renderGlyph(C_add,grayH,grayL) for C_add in range(32,128)]
+        Glyph_Cache[(grayH,grayL)]=table
+    return table
+
+def glyphBytes(String):
+    # The rendered bytes of a run of characters, non-printable ones shown as spaces
+    table=glyphTable()
+    glyphs=[]
+    for C in String:
+        C_add=ord(C)
+        if C_add<32 or C_add>127:     # Ignore non-printable ASCII characters
+            C_add=32
+        glyphs.append(table[C_add-32])
+    return bytearray().join(glyphs)
+
+def oled_putChar(C):
+    sendDataBlock(glyphBytes(C))
+
+def oled_putString(String):
+    # One block write for the whole run. The window set by oled_setTextXY moves on to the next cell after 32 bytes.
+    with tracing.span('grove_oled.putString','i2c',String):
+        sendDataBlock(glyphBytes(String))
+
+def imageToGray(image):
+    # A 2-D NumPy array or a PIL image as 4-bit gray levels: uint8 images are quantized to their top 4 bits, boolean
+    # ones become 0 or 15, and anything else is taken to hold gray levels already
+    import numpy as np
+    if hasattr(image,'convert'):
+        image=np.asarray(image.convert('L'))
+    image=np.asarray(image)
+    if image.dtype==np.bool_:
+        return image.astype(np.uint8)*0x0F
+    if image.dtype==np.uint8:
+        return image>>4
+    return np.clip(image,0,15).astype(np.uint8)
+
+def packImage(gray):
+    # Packs an array of gray levels into one byte per column address and row, indexed [column, row] so that its bytes
+    # are in vertical mode order. Pairs of pixels share a byte, the left one in the high nibble, and an odd width gets
+    # a black column on the right.
+    import numpy as np
+    if gray.shape[1]&1:
+        gray=np.hstack((gray,np.zeros((gray.shape[0],1),dtype=np.uint8)))
+    return ((gray[:,0::2]<<4)|gray[:,1::2]).T
+
+def oled_drawImage(image,x=0,y=0):
+    # Draws an image with its top left corner at x, y (x is rounded down to an even pixel), clipped to the screen
+    packed=packImage(imageToGray(image)[:Height-y,:Width-(x&~1)])
+    cols,rows=packed.shape
+    if cols==0 or rows==0:
+        return
+    with oled_hold():
+        oled_setWindow(x>>1,(x>>1)+cols-1,y,y+rows-1)
+        sendDataBlock(bytearray(packed.tobytes()))
+
+def sparkline(values,width=Width,height=16,gray=0x0F,low=None,high=None):
+    # A line chart of the last ``width`` values in gray level ``gray`` (0-15), as an 8-bit image for oled_drawImage or
+    # draw_image
+    import numpy as np
+    gray=(gray&0x0F)*0x11
+    values=np.asarray(values,dtype=float)[-width:]
+    image=np.zeros((height,width),dtype=np.uint8)
+    if len(values)==0:
+        return image
+    low=values.min() if low is None else low
+    high=values.max() if high is None else high
+    span=float(high-low) or 1.0
+    ys=(height-1)-np.clip(np.round((values-low)/span*(height-1)),0,height-1).astype(int)
+    xs=np.arange(width-len(values),width)
+    image[ys,xs]=gray
+    # Join each point to the next with a vertical run so steep changes stay connected
+    if len(values)>1:
+        top=np.minimum(ys[:-1],ys[1:])
+        bottom=np.maximum(ys[:-1],ys[1:])
+        rows=np.arange(height)[:,None]
+        image[:,xs[1:]]=np.where((rows>=top)&(rows<=bottom),gray,image[:,xs[1:]])
+    return image
+
+
+class Framebuffer(object):
+    """
+    An in-memory copy of the 96x96 screen, 4 bits per pixel. Bytes are kept in the order the controller takes them in
+    vertical mode: two pixels per byte (the left one in the high nibble), 96 rows per column address. Draw into it,
+    then flush() sends what changed since the last flush in a few block writes.
+
+    A shadow copy of what is on the glass is kept to diff against. Call invalidate() if anything else draws on the
+    display, so the next flush() sends the whole screen.
+    """
+    def __init__(self):
+        self.buf=bytearray(Columns*Height)
+        self.shadow=None    # What the last flush put on the glass, None when unknown
+
+    def invalidate(self):
+        self.shadow=None
+
+    def clear(self,gray=0):
+        self.buf[:]=bytearray([(gray<<4)|gray])*len(self.buf)
+
+    def set_pixel(self,x,y,gray=0x0F):
+        i=(x>>1)*Height+y
+        if x&1:
+            self.buf[i]=(self.buf[i]&0xF0)|(gray&0x0F)
+        else:
+            self.buf[i]=(self.buf[i]&0x0F)|((gray&0x0F)<<4)
+
+    def get_pixel(self,x,y):
+        byte=self.buf[(x>>1)*Height+y]
+        return byte&0x0F if x&1 else byte>>4
+
+    def put_char(self,Row,Column,C):
+        # Same 8x8 text cells as oled_setTextXY/oled_putChar. A cell off the screen is clipped, like put_string.
+        if Row<0 or Row>=Height//8 or Column<0 or Column>=Columns//4:
+            return
+        glyph=glyphBytes(C)
+        for i in range(4):
+            base=(Column*4+i)*Height+Row*8
+            self.buf[base:base+8]=glyph[i*8:i*8+8]
+
+    def put_string(self,Row,Column,String):
+        for i in range(len(String)):
+            if Column+i>=Columns//4:
+                break
+            self.put_char(Row,Column+i,String[i])
+
+    def draw_image(self,image,x=0,y=0):
+        # As oled_drawImage, into the framebuffer
+        import numpy as np
+        packed=packImage(imageToGray(image)[:Height-y,:Width-(x&~1)])
+        cols,rows=packed.shape
+        screen=np.frombuffer(self.buf,dtype=np.uint8).reshape(Columns,Height)
+        screen[x>>1:(x>>1)+cols,y:y+rows]=packed
+
+    def dirty_windows(self):
+        """
+        Returns the (Col_start, Col_end, Row_start, Row_end) windows that differ from the glass. Each 8 row text band
+        is scanned for changed column addresses, runs of them become one window trimmed to the changed rows, and
+        windows spanning the same columns in adjacent bands are joined.
+        """
+        if self.shadow is None:
+            return [(0,Columns-1,0,Height-1)]
+        buf=self.buf
+        shadow=self.shadow
+        if buf==shadow:
+            return []
+        windows=[]
+        for band in range(0,Height,8):
+            run=None
+            for col in range(Columns):
+                i=col*Height+band
+                if buf[i:i+8]==shadow[i:i+8]:
+                    continue
+                rows=[r for r in range(8) if buf[i+r]!=shadow[i+r]]
+                if run and col-run[1]<=Merge_Gap+1:
+                    run[1]=col
+                    run[2]=min(run[2],band+rows[0])
+                    run[3]=max(run[3],band+rows[-1])
+                else:
+                    if run:
+                        windows.append(run)
+                    run=[col,col,band+rows[0],band+rows[-1]]
+            if run:
+                windows.append(run)
+
+        merged=[]
+        for w in windows:
+            for m in merged:
+                if m[0]==w[0] and m[1]==w[1] and m[3]+1==w[2]:
+                    m[3]=w[3]
+                    break
             else:
-                c=c|0x00
-            if bit2:
-                c=c|grayL
+                merged.append(w)
+        return [tuple(m) for m in merged]
+
+    def flush(self,full=False):
+        """Sends the changed regions (everything if ``full``) and returns the number of windows written"""
+        windows=[(0,Columns-1,0,Height-1)] if full else self.dirty_windows()
+        for Col_start,Col_end,Row_start,Row_end in windows:
+            if Row_start==0 and Row_end==Height-1:
+                data=self.buf[Col_start*Height:(Col_end+1)*Height]
             else:
-                c=c|0x00
-            sendData(c)
+                data=bytearray()
+                for col in range(Col_start,Col_end+1):
+                    data+=self.buf[col*Height+Row_start:col*Height+Row_end+1]
+            with oled_hold():
+                oled_setWindow(Col_start,Col_end,Row_start,Row_end)
+                sendDataBlock(data)
+        if self.shadow is None:
+            self.shadow=bytearray(self.buf)
+        else:
+            self.shadow[:]=self.buf
+        return len(windows)
 
-def oled_putString(String):
-    for i in range(len(String)):
-        oled_putChar(String[i])
+
+class Console(object):
+    """
+    A rolling log: each new line goes at the bottom and the older ones move up. Once the screen is full, a new line
+    is written to the RAM row just below the visible ones and the display start line (0xA1) is moved down a text row,
+    so the controller scrolls the picture and only one row of text crosses the bus. Lines longer than the screen are
+    wrapped.
+
+    The start line stays moved while the console is in use, so call close() before drawing anything else.
+    """
+    Chars=Width//8
+
+    def __init__(self):
+        self.top=0     # RAM row shown at the top of the screen
+        self.count=0   # Lines written since the last clear
+        self.clear()
+
+    def clear(self):
+        self.top=0
+        self.count=0
+        with oled_hold():
+            sendCommands([0xA1,0x00])
+            oled_setWindow(0,Columns-1,0,Ram_Rows-1)
+            sendDataBlock(bytearray(Columns*Ram_Rows))
+
+    def write(self,text):
+        for line in text.split('\n'):
+            for i in range(0,max(len(line),1),self.Chars):
+                self._append(line[i:i+self.Chars])
+
+    def _append(self,line):
+        if self.count<Height//8:
+            row=self.count*8
+        else:
+            row=(self.top+Height)%Ram_Rows
+        with oled_hold():
+            oled_setWindow(0,Columns-1,row,row+7)
+            sendDataBlock(glyphBytes(line.ljust(self.Chars)))
+            if self.count>=Height//8:
+                self.top=(self.top+8)%Ram_Rows
+                sendCommands([0xA1,self.top])
+        self.count+=1
+
+    def close(self):
+        # Back to the layout everything else expects
+        self.clear()
+
+
+def benchmark():
+    # Counts I2C transactions and times a clear and a full screen of text against a fake controller
+    import fake_i2c
+    Oled=fake_i2c.FakeSSD1327()
+    grove_bus.set_i2c_device(Oled,Oled_Address,Oled_Bus)
+    oled_init()
+    lines=["Line %d: 0123456789"%n for n in range(12)]
+
+    def run(name,draw):
+        Oled.reset_counters()
+        stime=time.time()
+        draw()
+        elapsed=time.time()-stime
+        print("%-32s %5d transactions %6d bytes %7.1f ms CPU %7.1f ms on a 100kHz bus"%(
+            name,Oled.transactions,Oled.bytes,elapsed*1000,Oled.bus_time()*1000))
+
+    def text_bytewise():
+        for n in range(12):
+            oled_setTextXY(n,0)
+            for C in lines[n][:12]:
+                for c in renderGlyph(ord(C),grayH,grayL):
+                    sendData(c)
+
+    def text_direct():
+        for n in range(12):
+            oled_setTextXY(n,0)
+            oled_putString(lines[n][:12])
+
+    fb=Framebuffer()
+
+    def text_framebuffer():
+        fb.clear()
+        for n in range(12):
+            fb.put_string(n,0,lines[n])
+        fb.flush()
+
+    def render(name,render_one):
+        text=''.join(chr(32+n%96) for n in range(9600))
+        stime=time.time()
+        for C in text:
+            render_one(C)
+        elapsed=time.time()-stime
+        print("%-32s %9.0f glyphs/s"%(name,len(text)/elapsed))
+
+    Glyph_Cache.clear()
+    render("glyphs, bit loops",lambda C: renderGlyph(ord(C),grayH,grayL))
+    render("glyphs, cached",glyphBytes)
+
+    run("clear, byte at a time",lambda: [sendData(0x00) for i in range(Columns*Height)])
+    run("clear, block writes",oled_clearDisplay)
+    run("full text, byte at a time",text_bytewise)
+    before=Oled.screen()
+    run("full text, putString per line",text_direct)
+    print("screens match: %s"%(before==Oled.screen()))
+    run("full text, framebuffer flush",text_framebuffer)
+    print("screens match: %s"%(before==Oled.screen()))
+
+    # A status screen where one RSSI digit and the last digits of the uptime change between updates
+    status=["IP:","192.168.7.2","","RSSI: -71dBm","Up: 00:41:07"]
+    updated=["IP:","192.168.7.2","","RSSI: -72dBm","Up: 00:41:08"]
+
+    def status_direct(lines):
+        for n in range(len(lines)):
+            oled_setTextXY(n,0)
+            oled_putString(lines[n].ljust(12))
+
+    def status_framebuffer(lines):
+        for n in range(len(lines)):
+            fb.put_string(n,0,lines[n].ljust(12))
+        fb.flush()
+
+    oled_clearDisplay()
+    status_direct(status)
+    fb.clear()
+    fb.invalidate()
+    status_framebuffer(status)
+    run("status update, rewrite strings",lambda: status_direct(updated))
+    expected=Oled.screen()
+    status_direct(status)
+    run("status update, dirty regions",lambda: status_framebuffer(updated))
+    print("screens match: %s, windows %s"%(expected==Oled.screen(),fb.dirty_windows() or "none left"))
+
+    # A modem event log, 200 lines
+    events=["%03d +CEREG:%d"%(n,n%6) for n in range(200)]
+
+    def log_redraw():
+        shown=[]
+        for line in events:
+            shown=(shown+[line])[-12:]
+            for n in range(len(shown)):
+                oled_setTextXY(n,0)
+                oled_putString(shown[n].ljust(12))
+
+    console=Console()
+
+    def log_console():
+        for line in events:
+            console.write(line)
+
+    def lines_per_second(name,draw):
+        run(name,draw)
+        print("    %.0f bytes per line, %.1f lines/s on a 100kHz bus"%(Oled.bytes/float(len(events)),
+                                                                len(events)/Oled.bus_time()))
+
+    lines_per_second("log, redraw every line",log_redraw)
+    expected=Oled.screen()
+    console.clear()
+    lines_per_second("log, hardware scrolling",log_console)
+    print("screens match: %s"%(expected==Oled.screen()))
+    console.close()
+
+    # A 96x96 8-bit image and an RSSI sparkline
+    try:
+        import numpy as np
+    except ImportError:
+        print("numpy is not installed, skipping the image benchmark")
+        return
+    image=(np.add.outer(np.arange(Height),np.arange(Width))*255//(Width+Height-2)).astype(np.uint8)
+    loops=1000
+    stime=time.time()
+    for n in range(loops):
+        data=packImage(imageToGray(image)).tobytes()
+    print("%-32s %9.1f us per 96x96 frame"%("image, quantize and pack",(time.time()-stime)*1e6/loops))
+    run("image, oled_drawImage",lambda: oled_drawImage(image))
+    print("pixels match: %s"%all(Oled.pixel(x,y)==image[y,x]>>4 for y in range(Height) for x in range(Width)))
+
+    rssi=-70+8*np.sin(np.arange(200)/7.0)
+    fb.invalidate()
+    fb.clear()
+    fb.flush()
+    fb.draw_image(sparkline(rssi,height=24),0,72)
+    run("sparkline, framebuffer flush",fb.flush)
 
 
 if __name__=="__main__":
+    import sys
+    if len(sys.argv)>1 and sys.argv[1]=='bench':
+        benchmark()
+        sys.exit(0)
     oled_init()
     oled_setNormalDisplay()
     oled_clearDisplay()
@@ -266,4 +684,4 @@ if __name__=="__main__":
     time.sleep(10)
     #Oled.write8(Command_Mode,0xFD)
     #sendCommand(0xFD)
-    print 'hello world'
\ No newline at end of file
+    print('hello world')
\ No newline at end of file
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+led_animation.py - runs fades and status patterns on a grove_led.ChainableLED from a background thread, e.g. breathing
+while the modem searches for the network or a blink when an SMS arrives.
+
+An animation is worked out once into a table of frames (one color per LED per frame) at the engine's frame rate, and
+tables are cached, so playing it only means looking up the frame that is due. Frames are scheduled against the
+monotonic clock from when the animation started, so timing does not drift. A frame whose deadline has passed by the
+time the thread gets to it is dropped rather than shown late.
+"""
+import logging
+import threading
+import time
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# Built frame tables, by (animation key, frame rate, number of LEDs)
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def _mix(a, b, f):
+    return tuple(int(round(a[i] + (b[i] - a[i]) * f)) for i in range(3))
+
+
+class Animation(object):
+    """
+    Colors over time, given as keyframes: (seconds, color) pairs in time order, where color is an (r, g, b) for every
+    LED or a list with one (r, g, b) per LED. Colors are faded linearly between keyframes. A looping animation
+    repeats every ``period`` seconds (by default the time of the last keyframe) and otherwise holds its last frame.
+    """
+    def __init__(self, keyframes, period=None, loop=True, key=None):
+        self.keyframes = keyframes
+        self.period = period if period is not None else keyframes[-1][0]
+        self.loop = loop
+        # Animations with the same key share a frame table
+        self.key = key if key is not None else (tuple((t, _freeze(c)) for t, c in keyframes), self.period, loop)
+
+    def color_at(self, t, leds):
+        keyframes = self.keyframes
+        if t <= keyframes[0][0]:
+            return _expand(keyframes[0][1], leds)
+        for n in range(1, len(keyframes)):
+            t1, c1 = keyframes[n]
+            if t <= t1:
+                t0, c0 = keyframes[n - 1]
+                f = (t - t0) / float(t1 - t0) if t1 > t0 else 1.0
+                return tuple(_mix(a, b, f) for a, b in zip(_expand(c0, leds), _expand(c1, leds)))
+        return _expand(keyframes[-1][1], leds)
+
+    def table(self, fps, leds):
+        """The frames at ``fps`` for a chain of ``leds``, built on first use"""
+        key = (self.key, fps, leds)
+        frames = _tables.get(key)
+        if frames is None:
+            count = max(1, int(round(self.period * fps)))
+            frames = [self.color_at(n / float(fps), leds) for n in range(count)]
+            if not self.loop:
+                frames.append(self.color_at(self.period, leds))
+            with _tables_lock:
+                _tables[key] = frames
+        return frames
+
+
+def _freeze(color):
+    return tuple(color) if isinstance(color[0], int) else tuple(tuple(c) for c in color)
+
+
+def _expand(color, leds):
+    if isinstance(color[0], int):
+        return (tuple(color),) * leds
+    return tuple(tuple(c) for c in color)
+
+
+def solid(color):
+    return Animation([(0, color), (1, color)])
+
+
+def blink(color, period=1.0, duty=0.5):
+    off = (0, 0, 0)
+    on_time = period * duty
+    return Animation([(0, color), (on_time, color), (on_time, off), (period, off)],
+                     key=('blink', _freeze(color), period, duty))
+
+
+def breathe(color, period=3.0, steps=24):
+    # A smooth rise and fall, from off to ``color`` and back, every ``period`` seconds
+    import math
+    keyframes = []
+    for n in range(steps + 1):
+        level = (1 - math.cos(2 * math.pi * n / steps)) / 2
+        keyframes.append((period * n / steps, tuple(int(round(c * level)) for c in color)))
+    return Animation(keyframes, key=('breathe', tuple(color), period, steps))
+
+
+def fade(from_color, to_color, duration=1.0):
+    return Animation([(0, from_color), (duration, to_color)], loop=False)
+
+
+class AnimationEngine(object):
+    def __init__(self, led, number_of_leds, fps=50, clock=None):
+        """
+        :param led:             a grove_led.ChainableLED
+        :param number_of_leds:  LEDs in the chain
+        :param fps:             frames per second to schedule
+        """
+        self.logger = logging.getLogger('led_animation')
+        self.led = led
+        self.number_of_leds = number_of_leds
+        self.fps = fps
+        self.clock = clock or _monotonic
+        self.lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._running = False
+        self._animation = None
+        self._frames = None
+        self._start = None
+        self._index = -1
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.frames_shown = 0
+        self.frames_dropped = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self._stats_start = self.clock()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='led_animation')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def play(self, animation):
+        """Switches to ``animation`` from its first frame"""
+        frames = animation.table(self.fps, self.number_of_leds)
+        with self.lock:
+            self._animation = animation
+            self._frames = frames
+            self._start = self.clock()
+            self._index = -1
+        self._wakeup.set()
+
+    def stats(self):
+        """Achieved frames per second, frames dropped and how late frames were shown (seconds)"""
+        elapsed = self.clock() - self._stats_start
+        shown = self.frames_shown
+        return {
+            'fps': shown / elapsed if elapsed > 0 else 0.0,
+            'shown': shown,
+            'dropped': self.frames_dropped,
+            'jitter_mean': self.jitter_total / shown if shown else 0.0,
+            'jitter_max': self.jitter_max,
+        }
+
+    def _run(self):
+        while self._running:
+            self._wakeup.clear()
+            # The index is read and advanced under the lock, so a play() from another thread either comes before this
+            # frame, or resets the index after it and starts the new animation from its first frame
+            with self.lock:
+                frames = self._frames
+                start = self._start
+                previous = self._index
+                if frames is not None:
+                    index = int((self.clock() - start) * self.fps)
+                    finished = not self._animation.loop and index >= len(frames) - 1
+                    if finished:
+                        # Done: show the last frame if it has not been, then wait for the next animation
+                        index = len(frames) - 1
+                    if index > previous:
+                        self._index = index
+            if frames is None:
+                self._wakeup.wait()
+                continue
+
+            now = self.clock()
+            if index > previous:
+                if previous >= 0 and index > previous + 1 and not finished:
+                    self.frames_dropped += index - previous - 1
+                self._show(frames[index % len(frames)], now - (start + index / float(self.fps)))
+            if finished:
+                self._wakeup.wait()
+                continue
+
+            deadline = start + (max(index, previous) + 1) / float(self.fps)
+            remaining = deadline - self.clock()
+            if remaining > 0:
+                self._wakeup.wait(remaining)
+
+    def _show(self, frame, late):
+        try:
+            for led in range(self.number_of_leds):
+                self.led.setColor(led, *frame[led])
+            self.led.show()
+        except Exception as ex:
+            self.logger.exception("[led_animation] Failed to show a frame: %s", ex)
+        self.frames_shown += 1
+        self.jitter_total += late
+        self.jitter_max = max(self.jitter_max, late)
+
+
+if __name__ == "__main__":
+    # Breathing on a 16 LED chain through the fake GPIO, then the same with frames that take longer than the frame
+    # period to send, which shows frames being dropped rather than the animation slowing down
+    import grove_led
+    import fake_gpio
+
+    leds = 16
+    for name, delay in (("fast GPIO", 0), ("slow GPIO (20us clock sleeps)", 0.00002)):
+        gpio = fake_gpio.FakeGPIO(grove_led.CLK_PIN, grove_led.DATA_PIN)
+        led = grove_led.ChainableLED(grove_led.CLK_PIN, grove_led.DATA_PIN, leds, gpio=gpio, clock_delay=delay)
+        engine = AnimationEngine(led, leds, fps=50)
+        animation = breathe((0, 0, 255), period=1.0)
+        stime = time.time()
+        animation.table(engine.fps, leds)
+        built = time.time() - stime
+        engine.start()
+        engine.play(animation)
+        engine.reset_stats()
+        time.sleep(2)
+        engine.stop()
+        stats = engine.stats()
+        print("%-30s table built in %.1f ms, %.1f fps of 50, %d shown, %d dropped, jitter mean %.2f ms max %.2f ms, "
+              "%d frames sent to the LEDs" % (name, built * 1000, stats['fps'], stats['shown'], stats['dropped'],
+                                               stats['jitter_mean'] * 1000, stats['jitter_max'] * 1000,
+                                               led.frames_sent))
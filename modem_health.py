@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""
+modem_health.py - keeps the modem's signal, registration and serving cell state refreshed in the background.
+
+Every GPSModem query is a locked serial round trip that takes a second or more. The monitor does those round trips
+on its own thread at a fixed interval per value (or straight away when the modem sends a relevant URC), and callers
+read the latest timestamped snapshot from memory instead.
+"""
+import collections
+import logging
+import threading
+import time
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# Network states, derived from AT+CEREG? and AT+QCSQ
+REGISTERED = 'registered'
+ROAMING = 'roaming'
+SEARCHING = 'searching'
+DENIED = 'denied'
+NOT_REGISTERED = 'not_registered'
+NO_SERVICE = 'no_service'
+UNKNOWN = 'unknown'
+
+_CEREG_STATES = {0: NOT_REGISTERED, 1: REGISTERED, 2: SEARCHING, 3: DENIED, 4: REGISTERED, 5: ROAMING}
+
+DEFAULT_INTERVALS = {
+    'rssi': 30,
+    'registration': 30,
+    'service': 60,
+    'servinfo': 300,
+    'cells': 300,
+}
+
+
+class Snapshot(object):
+    """A value read from the modem, when it was read and whether the read failed"""
+    __slots__ = ('value', 'timestamp', 'monotonic', 'error', 'max_age')
+
+    def __init__(self, value, error=None, max_age=None):
+        self.value = value
+        self.timestamp = time.time()
+        self.monotonic = _monotonic()
+        self.error = error
+        self.max_age = max_age
+
+    def age(self):
+        return _monotonic() - self.monotonic
+
+    @property
+    def stale(self):
+        return self.error is not None or (self.max_age is not None and self.age() > self.max_age)
+
+    def __repr__(self):
+        return 'Snapshot(value=%r, age=%.1f, stale=%s, error=%r)' % (self.value, self.age(), self.stale, self.error)
+
+
+class ModemHealthMonitor(object):
+    def __init__(self, modem, intervals=None, stale_after=2.0):
+        """
+        :param modem:       a GPSModem
+        :param intervals:   seconds between refreshes, keyed like DEFAULT_INTERVALS. A value of None disables it
+        :param stale_after: a snapshot is stale once it is older than this many refresh intervals
+        """
+        self.logger = logging.getLogger('modem_health')
+        self.modem = modem
+        self.intervals = dict(DEFAULT_INTERVALS)
+        if intervals:
+            self.intervals.update(intervals)
+        self.stale_after = stale_after
+        self.state = UNKNOWN
+        self.listeners = []
+        self._snapshots = {}
+        self._due = {}
+        self._urc_stats = collections.deque()
+        # Keys to refresh, from any thread. Only the monitor thread touches _due.
+        self._requests = collections.deque()
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+        self._readers = {
+            'rssi': self._read_rssi,
+            'registration': self._read_registration,
+            'service': self._read_service,
+            'servinfo': self._read_servinfo,
+            'cells': self._read_cells,
+        }
+        modem.ser.add_urc_listener(self.on_urc)
+
+    def add_listener(self, callback):
+        """
+        Registers ``callback(state, previous_state)``, called on the monitor thread whenever the network state
+        changes, so it may send AT commands of its own.
+        """
+        self.listeners.append(callback)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        now = _monotonic()
+        for key, interval in self.intervals.items():
+            if interval is not None:
+                self._due[key] = now
+        self._thread = threading.Thread(target=self._run, name='modem_health')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get(self, key):
+        """Returns the latest Snapshot for ``key``, or None if it has not been read yet"""
+        return self._snapshots.get(key)
+
+    def snapshots(self):
+        return dict(self._snapshots)
+
+    def is_registered(self):
+        return self.state in (REGISTERED, ROAMING)
+
+    def refresh(self, *keys):
+        """Asks the monitor thread to refresh ``keys`` (all of them if none are given) as soon as possible"""
+        self._requests.extend(keys or [None])
+        self._wakeup.set()
+
+    def on_urc(self, line):
+        # Called from the serial port, possibly with the port locked, so only queue it and wake the thread, which
+        # stores it and tells the listeners.
+        if line.startswith('+CEREG:'):
+            try:
+                stat = int(line[7:].split(',')[0])
+            except ValueError:
+                return
+            self._urc_stats.append(stat)
+            self.refresh('service')
+        elif line.startswith('+QIURC: "pdpdeact"'):
+            self.refresh('registration', 'service')
+
+    def _refresh(self, key):
+        """Reads ``key`` from the modem and returns the new Snapshot. Runs on the monitor thread."""
+        try:
+            value, error = self._readers[key]()
+        except Exception as ex:
+            self.logger.exception("[modem_health] Failed to refresh %s: %s", key, ex)
+            value, error = None, str(ex)
+        return self._store(key, value, error)
+
+    def _store(self, key, value, error=None):
+        interval = self.intervals.get(key)
+        max_age = interval * self.stale_after if interval else None
+        previous = self._snapshots.get(key)
+        if error is not None and previous is not None:
+            # Keep the last good value around, but flag it
+            value = previous.value
+        snapshot = Snapshot(value, error, max_age)
+        self._snapshots[key] = snapshot
+        if key in ('registration', 'service'):
+            self._update_state()
+        return snapshot
+
+    def _update_state(self):
+        registration = self._snapshots.get('registration')
+        service = self._snapshots.get('service')
+        if service is not None and service.error is None and service.value and service.value[0] == 'NOSERVICE':
+            state = NO_SERVICE
+        elif registration is not None and registration.error is None:
+            state = _CEREG_STATES.get(registration.value, UNKNOWN)
+        else:
+            state = UNKNOWN
+        if state != self.state:
+            previous = self.state
+            self.state = state
+            self.logger.info("[modem_health] Network state %s -> %s", previous, state)
+            for callback in self.listeners:
+                try:
+                    callback(state, previous)
+                except Exception as ex:
+                    self.logger.exception("[modem_health] State listener failed: %s", ex)
+
+    def _run(self):
+        while self._running:
+            self._wakeup.clear()
+            while self._urc_stats:
+                self._store('registration', self._urc_stats.popleft())
+            now = _monotonic()
+            # A key asked for while it was being read stays queued, so it is read again rather than rescheduled
+            while self._requests:
+                key = self._requests.popleft()
+                for requested in [key] if key is not None else list(self._due):
+                    if requested in self._readers:
+                        self._due[requested] = now
+            for key, due in list(self._due.items()):
+                if due <= now and self._running:
+                    self._refresh(key)
+                    if self.intervals.get(key) is None:
+                        # Only refreshed on request
+                        del self._due[key]
+                    else:
+                        self._due[key] = _monotonic() + self.intervals[key]
+            if hasattr(self.modem.ser, 'read_urcs'):
+                self.modem.ser.read_urcs()
+            timeout = min(self._due.values()) - _monotonic() if self._due else 1.0
+            # Poll for URCs at least once a second even when nothing is due
+            self._wakeup.wait(max(0.0, min(timeout, 1.0)))
+
+    def _read_rssi(self):
+        rssi, ber = self.modem.get_rssi()
+        if rssi == -1:
+            return None, 'AT+CSQ failed'
+        return (rssi, ber), None
+
+    def _read_registration(self):
+        stat = self.modem.get_registration()
+        if stat == -1:
+            return None, 'AT+CEREG? failed'
+        return stat, None
+
+    def _read_service(self):
+        mode = self.modem.get_service_mode()
+        if not mode:
+            return None, 'AT+QCSQ failed'
+        return mode, None
+
+    def _read_servinfo(self):
+        mcc, mnc = self.modem.get_servinfo()
+        if mcc == 0 and mnc == 0:
+            return None, 'AT#RFSTS failed'
+        return (mcc, mnc), None
+
+    def _read_cells(self):
+        return self.modem.get_cell_monitor(), None
+
+
+if __name__ == "__main__":
+    import gps_modem
+
+    monitor = ModemHealthMonitor(gps_modem.GPSModem(), intervals={'rssi': 10, 'registration': 10})
+
+    def on_state(state, previous):
+        print(">>> state %s -> %s" % (previous, state))
+
+    monitor.add_listener(on_state)
+    monitor.start()
+    while True:
+        time.sleep(5)
+        stime = _monotonic()
+        snapshots = monitor.snapshots()
+        elapsed = _monotonic() - stime
+        print(">>> %s (read in %.1f us)" % (monitor.state, elapsed * 1e6))
+        for name in sorted(snapshots):
+            print("    %s = %s" % (name, snapshots[name]))
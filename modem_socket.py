@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+modem_socket.py - TCP and UDP sockets over the modem's built-in TCP/IP stack, for uploads that are too big for SMS.
+
+The socket runs on the PDP context that GPSModem.test_qiact brings up, using the Quectel AT+QIOPEN / AT+QISEND /
+AT+QIRD / AT+QICLOSE commands in buffer access mode. Writes are buffered and sent in chunks of the largest size
+AT+QISEND accepts, and incoming data is read when the modem announces it with a +QIURC: "recv" URC.
+
+https://www.quectel.com/UploadImage/Downlad/Quectel_BG96_TCP(IP)_AT_Commands_Manual_V1.0.pdf
+"""
+import logging
+import threading
+import time
+
+# Largest payload AT+QISEND takes in one go
+MAX_SEND = 1460
+MAX_READ = 1500
+
+
+class ModemSocket(object):
+    def __init__(self, modem, connect_id=0, context_id=1, max_send=MAX_SEND, timeout=60, keepalive=(2, 75, 9)):
+        """
+        :param modem:       a GPSModem with an active PDP context
+        :param connect_id:  the modem's socket index (0-11)
+        :param max_send:    chunk size for AT+QISEND
+        :param timeout:     seconds to wait for the modem to open a socket or to accept data
+        :param keepalive:   TCP keepalive (idle minutes, probe interval seconds, probes), or None to leave it off
+        """
+        self.logger = logging.getLogger('modem_socket')
+        self.modem = modem
+        self.ser = modem.ser
+        self.connect_id = connect_id
+        self.context_id = context_id
+        self.max_send = max_send
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.connected = False
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._buffer = bytearray()
+        self._received = bytearray()
+        self._readable = False
+        self._open_result = None
+        self._event = threading.Event()
+        self.ser.add_urc_listener(self.on_urc)
+
+    def on_urc(self, line):
+        # May be called with the serial port locked, so only record what happened
+        if line.startswith('+QIOPEN:'):
+            parts = line[8:].split(',')
+            if int(parts[0]) == self.connect_id:
+                self._open_result = int(parts[1])
+        elif line.startswith('+QIURC: "recv",'):
+            if int(line[15:].split(',')[0]) == self.connect_id:
+                self._readable = True
+        elif line.startswith('+QIURC: "closed",'):
+            if int(line[17:]) == self.connect_id:
+                self.logger.info("[modem_socket] Socket %d closed by the remote end", self.connect_id)
+                self.connected = False
+        elif line.startswith('+QIURC: "pdpdeact"'):
+            self.connected = False
+        else:
+            return
+        self._event.set()
+
+    def _wait(self, predicate, timeout):
+        """Polls the modem for URCs until ``predicate()`` holds or ``timeout`` seconds pass"""
+        deadline = time.time() + timeout
+        while not predicate():
+            self._event.clear()
+            self.ser.read_urcs()
+            if predicate():
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self._event.wait(min(remaining, 0.05))
+        return True
+
+    def _command(self, command):
+        return self.ser.write_wait(command, 0)
+
+    def connect(self, host, port, protocol='TCP'):
+        if self.connected:
+            return
+        if protocol == 'TCP' and self.keepalive is not None:
+            self._command('AT+QICFG="tcp/keepalive",1,%d,%d,%d\r' % self.keepalive)
+
+        self.logger.info("[modem_socket] Opening %s socket %d to %s:%d", protocol, self.connect_id, host, port)
+        self._open_result = None
+        self._received = bytearray()
+        self._readable = False
+        out = self._command('AT+QIOPEN=%d,%d,"%s","%s",%d,0,0\r' % (self.context_id, self.connect_id, protocol, host,
+                                                                     port))
+        if out.find('OK') == -1:
+            self.logger.error("[modem_socket] Failed to open socket (AT+QIOPEN). out = %s", out)
+            raise IOError("Failed to open socket")
+
+        # The result usually arrives as a URC after the OK, but it can be in the same response
+        start = out.find('+QIOPEN: ')
+        if start != -1:
+            self.on_urc(out[start:out.find('\r', start)])
+        if not self._wait(lambda: self._open_result is not None, self.timeout):
+            self.logger.error("[modem_socket] Timed out opening socket %d", self.connect_id)
+            raise IOError("Timed out opening socket")
+        if self._open_result != 0:
+            self.logger.error("[modem_socket] Failed to open socket %d, error %d", self.connect_id, self._open_result)
+            raise IOError("Failed to open socket, error %d" % self._open_result)
+        self.connected = True
+
+    def write(self, data):
+        """Buffers ``data`` and sends every full chunk"""
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.max_send:
+            self._send_chunk(self.max_send)
+
+    def flush(self):
+        while self._buffer:
+            self._send_chunk(min(len(self._buffer), self.max_send))
+
+    def sendall(self, data):
+        """
+        Sends all of ``data``. If a chunk fails, the IOError raised has ``sent`` set to the number of bytes of
+        ``data`` that AT+QISEND had already accepted, so a retry can resume from there instead of repeating them.
+        """
+        pending = len(self._buffer)
+        bytes_sent = self.bytes_sent
+        try:
+            self.write(data)
+            self.flush()
+        except IOError as ex:
+            # Bytes buffered by earlier writes go out first
+            ex.sent = max(0, self.bytes_sent - bytes_sent - pending)
+            raise
+
+    def _send_chunk(self, size):
+        if not self.connected:
+            raise IOError("Socket is not connected")
+        chunk = bytes(self._buffer[:size])
+        out = self.ser.write_data('AT+QISEND=%d,%d\r' % (self.connect_id, size), chunk, self.timeout)
+        if out.find('SEND OK') == -1:
+            self.logger.error("[modem_socket] Failed to send %d bytes (AT+QISEND). out = %s", size, out)
+            if out.find('SEND FAIL') != -1:
+                self.connected = False
+            raise IOError("Failed to send data")
+        del self._buffer[:size]
+        self.bytes_sent += size
+
+    def recv(self, bufsize=MAX_READ, timeout=None):
+        """
+        Returns up to ``bufsize`` received bytes, waiting up to ``timeout`` seconds (default: the socket timeout) for
+        the modem to report data. Returns an empty string if nothing arrived or the socket was closed.
+        """
+        if not self._received:
+            if not self._readable:
+                self._wait(lambda: self._readable or not self.connected, self.timeout if timeout is None else timeout)
+            if self._readable:
+                self._read_available()
+        data = bytes(self._received[:bufsize])
+        del self._received[:len(data)]
+        return data
+
+    def _read_available(self):
+        self._readable = False
+        while True:
+            data, out = self.ser.read_data('AT+QIRD=%d,%d\r' % (self.connect_id, MAX_READ), '+QIRD:', self.timeout)
+            if data is None:
+                self.logger.error("[modem_socket] Failed to read data (AT+QIRD). out = %s", out)
+                raise IOError("Failed to read data")
+            if not data:
+                return
+            self._received.extend(data)
+            self.bytes_received += len(data)
+
+    def close(self):
+        self._buffer = bytearray()
+        if self.connected:
+            self.connected = False
+            out = self._command('AT+QICLOSE=%d\r' % self.connect_id)
+            if out.find('OK') == -1:
+                self.logger.warning("[modem_socket] Failed to close socket %d. out = %s", self.connect_id, out)
+
+
+class TelemetryUplink(object):
+    """Uploads batches to one server, keeping the connection open between uploads and reconnecting when it drops"""
+    def __init__(self, modem, host, port, protocol='TCP', connect_id=0, retries=1, **kwargs):
+        self.logger = logging.getLogger('modem_socket')
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.retries = retries
+        self.socket = ModemSocket(modem, connect_id, **kwargs)
+        self.connects = 0
+        self.uploads = 0
+
+    def upload(self, payload):
+        """Sends ``payload``. After a failure it reconnects and sends the rest, from the first byte not yet sent."""
+        attempt = 0
+        sent = 0
+        while True:
+            try:
+                if not self.socket.connected:
+                    self.socket.connect(self.host, self.port, self.protocol)
+                    self.connects += 1
+                self.socket.sendall(payload[sent:] if sent else payload)
+                self.uploads += 1
+                return
+            except IOError as ex:
+                sent += getattr(ex, 'sent', 0)
+                self.socket.close()
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                self.logger.warning("[modem_socket] Upload failed (%s), reconnecting", ex)
+
+    def close(self):
+        self.socket.close()
+
+
+if __name__ == "__main__":
+    # Benchmark: upload a 1 MB telemetry batch to a local TCP server through the fake modem
+    import socket
+    import gps_modem
+    import fake_modem
+
+    total = {'bytes': 0}
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def serve():
+        conn, _ = server.accept()
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            total['bytes'] += len(data)
+            if data.endswith(b'COMMIT\n'):
+                conn.sendall(b'ACK %d\n' % total['bytes'])
+
+    server_thread = threading.Thread(target=serve)
+    server_thread.daemon = True
+    server_thread.start()
+
+    fake = fake_modem.FakeModem()
+    modem = gps_modem.GPSModem(fake)
+    logging.getLogger().setLevel(logging.WARNING)
+    uplink = TelemetryUplink(modem, '127.0.0.1', server.getsockname()[1])
+
+    size = 1024 * 1024
+    batch = bytes(bytearray(i % 251 for i in range(64 * 1024)))
+    commands = len(fake.commands)
+    stime = time.time()
+    sim_start = fake.clock.time()
+    for n in range(size // len(batch)):
+        uplink.upload(batch)
+    uplink.upload(b'COMMIT\n')
+    ack = uplink.socket.recv(timeout=5)
+    wall = time.time() - stime
+    simulated = fake.clock.time() - sim_start
+
+    print("Uploaded %d bytes in %d uploads over %d connection(s), %d AT commands" % (
+        uplink.socket.bytes_sent, uplink.uploads, uplink.connects, len(fake.commands) - commands))
+    print("Server reply: %r" % ack)
+    print("Host CPU time: %.2fs (%.0f KB/s)" % (wall, size / 1024.0 / wall))
+    print("Simulated time at 115200 baud: %.1fs (%.1f KB/s)" % (simulated, size / 1024.0 / simulated))
+    print("The same data as 140 byte SMS messages: %d messages, about %.1f hours" % (size / 140 + 1,
+                                                                                    (size / 140 + 1) * 6 / 3600.0))
+    uplink.close()
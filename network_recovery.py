@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""
+network_recovery.py - brings the modem back onto the network after registration or the PDP context drops.
+
+Instead of constructing a new GPSModem (which re-runs every probe) or resetting the module, the recovery works out
+which layer failed and starts at the cheapest fix for that layer:
+
+    radio off       (AT+CFUN? != 1)         turn the radio on
+    no service      (AT+QCSQ NOSERVICE)     wait for the network, then cycle the radio
+    not registered  (AT+CEREG? 0, 2 or 3)   wait for the network, then reselect the operator, then cycle the radio
+    context down    (AT+QIACT? empty)       activate the context, then deactivate and activate it
+
+When a fix does not work after a few attempts it escalates one step up the ladder, with the wait between attempts
+doubling up to a cap. A module reboot is the last step. The time to recover is recorded per failure class.
+"""
+import logging
+import time
+import gps_modem
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+RADIO_OFF = 'radio_off'
+NO_SERVICE = 'no_service'
+NOT_REGISTERED = 'not_registered'
+CONTEXT_DOWN = 'context_down'
+
+# From the bottom of the stack to the top
+LAYERS = [RADIO_OFF, NO_SERVICE, NOT_REGISTERED, CONTEXT_DOWN]
+
+# Recovery actions, cheapest first
+ACTIVATE_CONTEXT = 'activate_context'
+REACTIVATE_CONTEXT = 'reactivate_context'
+WAIT = 'wait'
+RESELECT_OPERATOR = 'reselect_operator'
+RADIO_ON = 'radio_on'
+RADIO_CYCLE = 'radio_cycle'
+REBOOT = 'reboot'
+
+LADDER = [ACTIVATE_CONTEXT, REACTIVATE_CONTEXT, WAIT, RESELECT_OPERATOR, RADIO_ON, RADIO_CYCLE, REBOOT]
+
+# Where on the ladder each failure class starts
+START = {
+    CONTEXT_DOWN: LADDER.index(ACTIVATE_CONTEXT),
+    NOT_REGISTERED: LADDER.index(WAIT),
+    NO_SERVICE: LADDER.index(WAIT),
+    RADIO_OFF: LADDER.index(RADIO_ON),
+}
+
+# The steps that cannot help with a failure class are skipped while escalating
+SKIP = {
+    NOT_REGISTERED: (RADIO_ON,),
+    NO_SERVICE: (RESELECT_OPERATOR, RADIO_ON),
+}
+
+
+class RecoveryFailed(IOError):
+    pass
+
+
+class NetworkRecovery(object):
+    def __init__(self, modem, attempts_per_step=2, base_delay=2.0, max_delay=60.0, deadline=900.0, clock=None,
+                 sleep=None):
+        """
+        :param modem:               a GPSModem
+        :param attempts_per_step:   attempts at each step before escalating to the next one
+        :param base_delay:          seconds to wait after the first attempt, doubled per attempt up to ``max_delay``
+        :param deadline:            give up and raise RecoveryFailed after this many seconds
+        :param clock, sleep:        time source and sleep function, so a fake_modem.FakeClock can drive scenarios
+        """
+        self.logger = logging.getLogger('network_recovery')
+        self.modem = modem
+        self.attempts_per_step = attempts_per_step
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.clock = clock or _monotonic
+        self.sleep = sleep or time.sleep
+        self.history = []
+
+    def diagnose(self):
+        """Checks the layers from the radio up and returns the lowest one that has failed, or None if all is well"""
+        if self.modem.get_functionality() != 1:
+            return RADIO_OFF
+        mode = self.modem.get_service_mode()
+        if not mode or mode[0] == 'NOSERVICE':
+            return NO_SERVICE
+        if not gps_modem.is_registered(self.modem.get_registration()):
+            return NOT_REGISTERED
+        if not self.modem.is_context_active():
+            return CONTEXT_DOWN
+        return None
+
+    def recover(self):
+        """
+        Runs the recovery until the modem is registered with an active context.
+        :return:    the failure class that was recovered from, or None if nothing was wrong
+        """
+        failure = self.diagnose()
+        if failure is None:
+            return None
+
+        start = self.clock()
+        first = failure
+        step = START[failure]
+        attempt = 0
+        delay = self.base_delay
+        actions = []
+        self.logger.info("[network_recovery] Recovering from %s", failure)
+
+        while True:
+            action = LADDER[step]
+            actions.append(action)
+            self._perform(action)
+            self.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+
+            current = self.diagnose()
+            if current is None:
+                elapsed = self.clock() - start
+                self.history.append({'failure': first, 'seconds': elapsed, 'actions': actions})
+                self.logger.info("[network_recovery] Recovered from %s in %.1fs after %s", first, elapsed, actions)
+                return first
+
+            if self.clock() - start > self.deadline:
+                self.history.append({'failure': first, 'seconds': None, 'actions': actions})
+                self.logger.error("[network_recovery] Failed to recover from %s after %s", first, actions)
+                raise RecoveryFailed("Failed to recover from %s" % first)
+
+            if current != failure:
+                if LAYERS.index(current) > LAYERS.index(failure):
+                    # The last action got us part of the way, carry on from the first step for the next layer up.
+                    # The backoff carries on too, since that layer (e.g. registration) may still be settling, unless
+                    # all that is left is the context, which is a quick command.
+                    step = START[current]
+                    if current == CONTEXT_DOWN:
+                        delay = self.base_delay
+                else:
+                    # Something lower in the stack broke, never step back down the ladder
+                    step = max(step, START[current])
+                self.logger.info("[network_recovery] %s is now %s", failure, current)
+                failure = current
+                attempt = 0
+                continue
+
+            attempt += 1
+            if attempt >= self.attempts_per_step and step < len(LADDER) - 1:
+                step = self._escalate(step, failure)
+                attempt = 0
+
+    def _escalate(self, step, failure):
+        step += 1
+        while step < len(LADDER) - 1 and LADDER[step] in SKIP.get(failure, ()):
+            step += 1
+        self.logger.info("[network_recovery] Escalating %s to %s", failure, LADDER[step])
+        return step
+
+    def _perform(self, action):
+        self.logger.info("[network_recovery] %s", action)
+        try:
+            if action == ACTIVATE_CONTEXT:
+                self.modem.activate_context()
+            elif action == REACTIVATE_CONTEXT:
+                self.modem.deactivate_context()
+                self.modem.activate_context()
+            elif action == RESELECT_OPERATOR:
+                self.modem.select_operator_auto()
+            elif action == RADIO_ON:
+                self.modem.set_functionality(1)
+            elif action == RADIO_CYCLE:
+                self.modem.set_functionality(0)
+                self.modem.set_functionality(1)
+            elif action == REBOOT:
+                self.modem.set_functionality('1,1')
+        except IOError as ex:
+            # The diagnosis after the wait decides what happens next
+            self.logger.warning("[network_recovery] %s failed: %s", action, ex)
+
+    def mttr(self):
+        """Returns {failure class: (recoveries, mean seconds to recover)} over the successful recoveries"""
+        stats = {}
+        for entry in self.history:
+            if entry['seconds'] is None:
+                continue
+            count, total = stats.get(entry['failure'], (0, 0.0))
+            stats[entry['failure']] = (count + 1, total + entry['seconds'])
+        return dict((failure, (count, total / count)) for failure, (count, total) in stats.items())
+
+
+if __name__ == "__main__":
+    # Scenarios against the fault-injecting fake modem, timed in simulated seconds
+    import fake_modem
+
+    logging.basicConfig(level=logging.WARNING)
+    fake = fake_modem.FakeModem()
+    stime = fake.clock.time()
+    modem = gps_modem.GPSModem(fake)
+    logging.getLogger().setLevel(logging.WARNING)
+    print("Full GPSModem() re-initialization: %.0fs (when the network is already up)" % (fake.clock.time() - stime))
+
+    recovery = NetworkRecovery(modem, clock=fake.clock.time, sleep=fake.clock.sleep)
+    scenarios = [
+        ('context dropped', lambda: fake.inject_context_drop()),
+        ('radio switched off', lambda: fake.inject_radio_off()),
+        ('60s network outage', lambda: fake.inject_outage(60)),
+        ('deregistered, needs reselection', lambda: fake.inject_deregistration('cops')),
+        ('registration denied, needs radio cycle', lambda: fake.inject_deregistration('cycle', denied=True)),
+        ('stuck, needs reboot', lambda: fake.inject_deregistration('reset')),
+    ]
+    for name, inject in scenarios:
+        inject()
+        commands = len(fake.commands)
+        failure = recovery.recover()
+        entry = recovery.history[-1]
+        print("%-40s %-15s %6.0fs %3d commands  %s" % (name, failure, entry['seconds'], len(fake.commands) - commands,
+                                                       ' > '.join(entry['actions'])))
+
+    print("\nMean time to recover:")
+    for failure, (count, mean) in sorted(recovery.mttr().items()):
+        print("    %-15s %6.1fs over %d" % (failure, mean, count))
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+"""
+sampler.py - samples several sensors from one process, each at its own rate, and hands the samples to subscribers.
+
+A source is a name, a function that takes one reading and a target rate. A scheduler thread works out when each source
+is next due on the monotonic clock and passes the read to a small pool of worker threads, so a sensor that blocks
+(the modem's GPS takes a serial round trip of a second or more) does not hold the others up. A source is never read
+twice at once: if its previous read is still running when it is due again, that sample is skipped and counted.
+
+Samples go to every subscriber through a bounded queue. A subscriber that falls behind loses its oldest samples, which
+are counted, rather than holding up the sampler or growing without limit. stats() gives the achieved rate, jitter
+(how late reads started), skips, deadline misses and errors per source.
+"""
+import collections
+import logging
+import threading
+import time
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class Sample(object):
+    """One reading: its source, value (None if the read failed), when the read started and how long it took"""
+    __slots__ = ('source', 'value', 'monotonic', 'timestamp', 'latency', 'error')
+
+    def __init__(self, source, value, monotonic, timestamp, latency, error=None):
+        self.source = source
+        self.value = value
+        self.monotonic = monotonic
+        self.timestamp = timestamp
+        self.latency = latency
+        self.error = error
+
+    def __repr__(self):
+        return 'Sample(source=%r, value=%r, monotonic=%.3f, latency=%.4f, error=%r)' % (
+            self.source, self.value, self.monotonic, self.latency, self.error)
+
+
+class Source(object):
+    def __init__(self, name, read, rate, deadline=None):
+        """
+        :param read:        function taking no arguments that returns one reading, or raises
+        :param rate:        target samples per second
+        :param deadline:    seconds a read may take before it counts as missing its deadline, by default one period
+        """
+        if rate <= 0:
+            raise ValueError("The rate of %s must be positive" % name)
+        self.name = name
+        self.read = read
+        self.rate = float(rate)
+        self.period = 1.0 / rate
+        self.deadline = deadline if deadline is not None else self.period
+        self.due = None
+        self.busy = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.samples = 0
+        self.skipped = 0
+        self.missed_deadlines = 0
+        self.errors = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.latency_max = 0.0
+
+
+class Subscription(object):
+    """Samples for one subscriber, oldest first. Once ``maxsize`` are waiting the oldest is dropped for each new one."""
+    def __init__(self, sources=None, maxsize=100):
+        self.sources = set(sources) if sources is not None else None
+        self.queue = collections.deque(maxlen=maxsize)
+        self.condition = threading.Condition()
+        self.delivered = 0
+        self.dropped = 0
+
+    def put(self, sample):
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(sample)
+            self.delivered += 1
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """The next Sample, or None if there is none within ``timeout`` seconds"""
+        with self.condition:
+            if not self.queue:
+                self.condition.wait(timeout)
+            return self.queue.popleft() if self.queue else None
+
+    def drain(self):
+        """Every waiting Sample, without waiting"""
+        with self.condition:
+            samples = list(self.queue)
+            self.queue.clear()
+        return samples
+
+    def __len__(self):
+        return len(self.queue)
+
+
+class Sampler(object):
+    def __init__(self, workers=3):
+        """
+        :param workers: threads running reads. One per source that can block for longer than the others' periods
+                        keeps them on time.
+        """
+        self.logger = logging.getLogger('sampler')
+        self.workers = workers
+        self.sources = {}
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        self._jobs = collections.deque()
+        self._jobs_ready = threading.Condition(self.lock)
+        self._wakeup = threading.Event()
+        self._running = False
+        self._threads = []
+        self._stats_start = _monotonic()
+
+    def add(self, name, read, rate, deadline=None):
+        """Adds a source, sampled from the next scheduler pass"""
+        source = Source(name, read, rate, deadline)
+        with self.lock:
+            self.sources[name] = source
+        self._wakeup.set()
+        return source
+
+    def remove(self, name):
+        with self.lock:
+            self.sources.pop(name, None)
+
+    def subscribe(self, sources=None, maxsize=100):
+        """A Subscription to the samples of ``sources`` (names), or of every source"""
+        subscription = Subscription(sources, maxsize)
+        with self.lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self.reset_stats()
+        threads = [threading.Thread(target=self._schedule, name='sampler')]
+        threads += [threading.Thread(target=self._work, name='sampler_%d' % n) for n in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self._threads = threads
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        with self.lock:
+            self._jobs_ready.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def reset_stats(self):
+        with self.lock:
+            for source in self.sources.values():
+                source.reset_stats()
+            self._stats_start = _monotonic()
+
+    def stats(self):
+        """Per source: target and achieved rate, jitter (seconds a read started after it was due), skips, errors"""
+        elapsed = _monotonic() - self._stats_start
+        stats = {}
+        with self.lock:
+            sources = list(self.sources.values())
+        for source in sources:
+            samples = source.samples
+            stats[source.name] = {
+                'rate': source.rate,
+                'achieved': samples / elapsed if elapsed > 0 else 0.0,
+                'samples': samples,
+                'skipped': source.skipped,
+                'missed_deadlines': source.missed_deadlines,
+                'errors': source.errors,
+                'jitter_mean': source.jitter_total / samples if samples else 0.0,
+                'jitter_max': source.jitter_max,
+                'latency_max': source.latency_max,
+            }
+        return stats
+
+    def _schedule(self):
+        while self._running:
+            self._wakeup.clear()
+            now = _monotonic()
+            with self.lock:
+                next_due = None
+                for source in self.sources.values():
+                    if source.due is None:
+                        source.due = now
+                    if source.due <= now:
+                        if source.busy:
+                            source.skipped += 1
+                        else:
+                            source.busy = True
+                            self._jobs.append((source, source.due))
+                            self._jobs_ready.notify()
+                        # Stay on the original schedule, skipping any periods that have already gone by
+                        behind = int((now - source.due) / source.period)
+                        source.skipped += behind
+                        source.due += (behind + 1) * source.period
+                    if next_due is None or source.due < next_due:
+                        next_due = source.due
+            timeout = next_due - _monotonic() if next_due is not None else 1.0
+            if timeout > 0:
+                self._wakeup.wait(timeout)
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while self._running and not self._jobs:
+                    self._jobs_ready.wait()
+                if not self._running:
+                    return
+                source, due = self._jobs.popleft()
+            start = _monotonic()
+            timestamp = time.time()
+            try:
+                value, error = source.read(), None
+            except Exception as ex:
+                self.logger.debug("[sampler] Reading %s failed: %s", source.name, ex)
+                value, error = None, str(ex) or ex.__class__.__name__
+            latency = _monotonic() - start
+            sample = Sample(source.name, value, start, timestamp, latency, error)
+            with self.lock:
+                source.busy = False
+                source.samples += 1
+                jitter = start - due
+                source.jitter_total += jitter
+                source.jitter_max = max(source.jitter_max, jitter)
+                source.latency_max = max(source.latency_max, latency)
+                if error is not None:
+                    source.errors += 1
+                if latency > source.deadline:
+                    source.missed_deadlines += 1
+                subscriptions = [s for s in self.subscriptions if s.sources is None or source.name in s.sources]
+            for subscription in subscriptions:
+                subscription.put(sample)
+
+
+if __name__ == "__main__":
+    # Four simulated sensors sampled together for 5 seconds, with one worker thread and with three: the SHT31 at 10/s
+    # on a real time fake bus, the DHT22 through its cached reader at 5/s, the ADXL345 at 20/s and the modem's GPS at
+    # 1/s with every AT command taking 0.8s. One subscriber keeps up and a slow one can only hold 10 samples.
+    import fake_gpio
+    import fake_i2c
+    import fake_modem
+    import gps_modem
+    import grove_accel
+    import grove_dht
+    import grove_sht31
+
+    logging.basicConfig(level=logging.WARNING)
+    bus = fake_i2c.FakeSMBus(clock=time)
+    bus.attach(grove_sht31.SHT31_DEVICE, fake_i2c.FakeSHT31(time))
+    bus.attach(grove_accel.ADXL345_DEVICE, fake_i2c.FakeADXL345(time))
+    sht31 = grove_sht31.SHT31(bus=bus)
+    sht31.start(10)
+    adxl345 = grove_accel.ADXL345(bus=bus)
+    dht = grove_dht.DHTReader(dht=fake_gpio.FakeDHT22())
+    dht.start()
+    fake = fake_modem.FakeModem()
+    modem = gps_modem.GPSModem(fake)
+    logging.getLogger('gps_modem').setLevel(logging.WARNING)
+    fake.clock = time
+    fake.command_time = 0.8
+
+    for workers in (1, 3):
+        sampler = Sampler(workers=workers)
+        sampler.add('sht31', sht31.read, 10)
+        sampler.add('dht22', lambda: dht.get().temperature, 5)
+        sampler.add('accel', lambda: adxl345.get_axes(True), 20)
+        sampler.add('gps', modem.get_gps, 1)
+        everything = sampler.subscribe()
+        slow = sampler.subscribe(maxsize=10)
+        sampler.start()
+        received = collections.Counter()
+        end = _monotonic() + 5
+        while _monotonic() < end:
+            sample = everything.get(0.1)
+            if sample is not None:
+                received[sample.source] += 1
+        stats = sampler.stats()
+        sampler.stop()
+        print("%d worker%s:" % (workers, 's' if workers > 1 else ''))
+        for name in ('sht31', 'dht22', 'accel', 'gps'):
+            s = stats[name]
+            print("    %-6s %5.1f/s of %4.1f/s, jitter mean %6.2f ms max %6.2f ms, read max %6.1f ms, %3d skipped, "
+                  "%d missed deadlines, %d errors, %3d received" % (
+                      name, s['achieved'], s['rate'], s['jitter_mean'] * 1000, s['jitter_max'] * 1000,
+                      s['latency_max'] * 1000, s['skipped'], s['missed_deadlines'], s['errors'], received[name]))
+        print("    subscriber that kept up: %d delivered, %d dropped; slow subscriber: %d delivered, %d dropped, %d "
+              "waiting" % (everything.delivered, everything.dropped, slow.delivered, slow.dropped, len(slow)))
+    dht.stop()
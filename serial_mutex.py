@@ -3,19 +3,62 @@
 serial_mutex.py - A class to provide a mutex on key serial operations to the modem
 """
 
-import serial
 import logging
 import time
-from threading import Lock
+import tracing
 
 
 class SerialMutex(object):
-    def __init__(self):
+    def __init__(self, ser=None):
+        """
+        :param ser: the serial port to the modem. Defaults to /dev/ttyS4, pass a fake_modem.FakeSerial to run without
+                    hardware.
+        """
         fmt = '%(asctime)-15s %(message)s'
         logging.basicConfig(format=fmt, level=logging.INFO)
         self.logger = logging.getLogger('serial_mutex')
-        self.ser = serial.Serial('/dev/ttyS4', 115200, timeout=5)
-        self.lock = Lock()
+        if ser is None:
+            import serial
+            ser = serial.Serial('/dev/ttyS4', 115200, timeout=5)
+        self.ser = ser
+        # Time spent waiting for the port shows up in traces as serial_mutex.lock_wait
+        self.lock = tracing.TracedLock('serial_mutex.lock_wait', 'serial')
+        self.urc_listeners = []
+
+    def add_urc_listener(self, callback):
+        """
+        Registers ``callback(line)`` for unsolicited result codes (URCs) from the modem, e.g. '+CEREG: 5'. URCs are
+        picked out of command responses and out of anything read by read_urcs. Listeners may be called with the
+        port lock held, so they must not send commands themselves.
+        """
+        self.urc_listeners.append(callback)
+
+    def dispatch_urcs(self, command, rx_buffer):
+        if not self.urc_listeners:
+            return
+        for line in rx_buffer.split('\r\n'):
+            colon = line.find(':')
+            if not line.startswith('+') or colon == -1:
+                continue
+            # A '+XXX:' line belonging to the command we sent is its response, not a URC
+            if command is not None and line[:colon] in command:
+                continue
+            for callback in self.urc_listeners:
+                try:
+                    callback(line)
+                except Exception as ex:
+                    self.logger.exception("[serial_mutex] URC listener failed on %s: %s", line, ex)
+
+    def read_urcs(self):
+        """Reads whatever the modem has sent without being asked and hands the URCs to the listeners"""
+        with self.lock:
+            rx_buffer = ''
+            while self.ser.inWaiting():
+                rx_buffer += self.ser.read(self.ser.inWaiting())
+        if rx_buffer:
+            self.logger.info("[serial_mutex] urc rx_buffer = %s", [rx_buffer])
+            self.dispatch_urcs(None, rx_buffer)
+        return rx_buffer
 
     def write_message(self, recipient, text_content):
         self.logger.info("[serial_mutex] Recipient: %s Message: %s (%d)", recipient, text_content, len(text_content))
@@ -119,28 +162,83 @@ class SerialMutex(object):
             return self.write_(command, sleep_time)
 
     def write_(self, command, sleep_time):
-        self.ser.write(command)
-        self.ser.flushOutput()
-        time.sleep(sleep_time)
-        rx_buffer = ''
-        stime = time.time()
-        # Wait for our OK in our response buffer
-        while True:
-            rx_buffer += self.ser.read(1)
-            if time.time() - stime > 60:
-                self.logger.warning("[serial_mutex] Timed out - no response from modem => %s", command)
-                break
-            elif self.ser.inWaiting() > 0:
-                while self.ser.inWaiting():
-                    rx_buffer += (self.ser.read(self.ser.inWaiting()))
-                if rx_buffer.find('OK') != -1 or rx_buffer.find('ERROR') != -1:
-                    # self.logger.info("BREAK - %s", rx_buffer)
+        with tracing.span('serial_mutex.write_', 'serial', command):
+            self.ser.write(command)
+            self.ser.flushOutput()
+            with tracing.span('serial_mutex.sleep', 'serial', sleep_time):
+                time.sleep(sleep_time)
+            rx_buffer = ''
+            stime = time.time()
+            # Wait for our OK in our response buffer
+            while True:
+                rx_buffer += self.ser.read(1)
+                if time.time() - stime > 60:
+                    self.logger.warning("[serial_mutex] Timed out - no response from modem => %s", command)
                     break
+                elif self.ser.inWaiting() > 0:
+                    while self.ser.inWaiting():
+                        rx_buffer += (self.ser.read(self.ser.inWaiting()))
+                    if rx_buffer.find('OK') != -1 or rx_buffer.find('ERROR') != -1:
+                        # self.logger.info("BREAK - %s", rx_buffer)
+                        break
+
+            self.logger.info("[serial_mutex] rx_buffer = %s", [rx_buffer])
+            self.ser.flush()
+            self.dispatch_urcs(command, rx_buffer)
+            return rx_buffer
+
+    def read_until(self, terminators, timeout, rx_buffer=''):
+        """Reads until one of ``terminators`` shows up in the response, or ``timeout`` seconds pass"""
+        stime = time.time()
+        while not any(rx_buffer.find(t) != -1 for t in terminators) and time.time() - stime < timeout:
+            rx_buffer += self.ser.read(max(1, self.ser.inWaiting()))
+        return rx_buffer
 
-        self.logger.info("[serial_mutex] rx_buffer = %s", [rx_buffer])
-        self.ser.flush()
+    def write_data(self, command, data, timeout=10):
+        """
+        Sends a command that prompts for raw data, e.g. AT+QISEND=0,512, writes ``data`` once the modem shows the '>'
+        prompt and returns everything the modem answered, ending with SEND OK, SEND FAIL or ERROR.
+        """
+        with self.lock:
+            self.ser.write(command)
+            self.ser.flushOutput()
+            rx_buffer = self.read_until(('>', 'ERROR'), timeout)
+            if rx_buffer.find('>') != -1:
+                self.ser.write(data)
+                self.ser.flushOutput()
+                rx_buffer += self.read_until(('SEND OK', 'SEND FAIL', 'ERROR'), timeout)
+        self.logger.debug("[serial_mutex] rx_buffer = %s", [rx_buffer])
+        self.dispatch_urcs(command, rx_buffer)
         return rx_buffer
 
+    def read_data(self, command, prefix, timeout=10):
+        """
+        Sends a command whose response is '<prefix> <length>' followed by <length> raw bytes, e.g. AT+QIRD=0,1500.
+        The payload is read by length since it may well contain 'OK' or 'ERROR'.
+        :return:    data, rx_buffer (data is None if the command failed)
+        """
+        with self.lock:
+            self.ser.write(command)
+            self.ser.flushOutput()
+            rx_buffer = self.read_until((prefix, 'ERROR'), timeout)
+            data = None
+            start = rx_buffer.find(prefix)
+            if start != -1:
+                start += len(prefix)
+                stime = time.time()
+                while rx_buffer.find('\r\n', start) == -1 and time.time() - stime < timeout:
+                    rx_buffer += self.ser.read(max(1, self.ser.inWaiting()))
+                end = rx_buffer.find('\r\n', start)
+                length = int(rx_buffer[start:end].split(',')[0])
+                data = rx_buffer[end + 2:]
+                while len(data) < length and time.time() - stime < timeout:
+                    data += self.ser.read(length - len(data))
+                tail = self.read_until(('OK', 'ERROR'), timeout, data[length:])
+                data = data[:length]
+                rx_buffer = rx_buffer[:end + 2] + data + tail
+        self.dispatch_urcs(command, rx_buffer)
+        return data, rx_buffer
+
     def close(self):
         with self.lock:
             self.ser.close()
@@ -5,42 +5,51 @@ This code will demonstrate how to use SMS to control a Beagle Bone Green using a
 import sys
 import gps_modem
 import grove_dht
+import sms_dispatcher
 from datetime import datetime
 
 
-def process_message(modem, from_number, message):
-    lc_m = message.lower()
-    print("Processing message: {}".format(lc_m))
-    if lc_m.startswith('what time is it'):
-        reply = datetime.now().strftime('Hi! According to my watch the time is %I:%M:%S %p UTC')
-    elif lc_m.startswith('what is the temp'):
-        try:
-            hum, temp = grove_dht.read()
-            reply = 'The temperature is {.2f} celsius with a humidity of {}%'.format(temp, hum)
-        except Exception as e:
-            print("Failed to read temperature: {}".format(e.message))
-            reply = 'Sorry, I seem to be broken. :('
-    else:
-        print("Unknown message: {}".format(message))
-        reply = 'Sorry. I am not that smart. Roses are red...'
-    modem.write_message(from_number, reply)
+def what_time(match, sender, message):
+    return datetime.now().strftime('Hi! According to my watch the time is %I:%M:%S %p UTC')
+
+
+def temperature(match, sender, message):
+    hum, temp = grove_dht.read()
+    if temp is None:
+        print("Failed to read temperature: no valid reading from the DHT22")
+        return 'Sorry, I seem to be broken. :('
+    return 'The temperature is {:.2f} celsius with a humidity of {:.1f}%'.format(temp, hum)
+
+
+def unknown(match, sender, message):
+    print("Unknown message: {}".format(message))
+    return 'Sorry. I am not that smart. Roses are red...'
+
+
+def make_dispatcher(modem):
+    dispatcher = sms_dispatcher.Dispatcher(modem, workers=2)
+    dispatcher.register(r'what time is it', what_time)
+    # Readings only change every few seconds, so a burst of questions gets the same answer
+    dispatcher.register(r'what is the temp', temperature, ttl=10)
+    dispatcher.default(unknown)
+    return dispatcher
 
 
 def main():
     modem = gps_modem.GPSModem()
     modem.set_text_mode()
-
-    while True:
-        try:
-            mt_message, sender = modem.pop_message()
-            if mt_message is not None and sender is not None:
-                process_message(modem, sender, mt_message)
-
-        except KeyboardInterrupt:
-            print("Caught keyboard interrupt. Bye!")
-            if modem is not None:
-                modem.reset_modem()
-            sys.exit()
+    # Start sampling the DHT22 now, so a reading is ready by the time a message asks for one
+    grove_dht.reader().start()
+    dispatcher = make_dispatcher(modem)
+
+    try:
+        dispatcher.run()
+    except KeyboardInterrupt:
+        print("Caught keyboard interrupt. Bye!")
+        print("SMS stats: {}".format(dispatcher.stats()))
+        if modem is not None:
+            modem.reset_modem()
+        sys.exit()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""
+sms_dispatcher.py - answers SMS commands on a small pool of worker threads while the main loop keeps reading the inbox.
+
+Handlers are registered against a regular expression, matched against the lower cased message. The first one that
+matches is called with the match, the sender and the message, and returns the reply text. A handler registered with a
+``ttl`` has its replies memoized for that many seconds, per matched text, so a burst of the same question (say, the
+temperature) reads the sensor once; a question that comes in while the answer is being worked out waits for it rather
+than asking again.
+
+Each sender may send ``rate_limit`` messages per ``rate_period`` seconds, and the rest are dropped. Messages wait for a
+worker in a bounded queue; once it is full, new messages are dropped too. stats() reports the counts and the time from
+a message being read to its reply being sent.
+"""
+import collections
+import logging
+import re
+import threading
+import time
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class Handler(object):
+    def __init__(self, pattern, function, ttl=None):
+        self.pattern = re.compile(pattern)
+        self.function = function
+        self.ttl = ttl
+        self.calls = 0
+
+
+class Dispatcher(object):
+    def __init__(self, modem, workers=2, queue_size=20, rate_limit=5, rate_period=60.0):
+        """
+        :param modem:       a GPSModem, or anything with pop_message() and write_message(recipient, text)
+        :param workers:     threads running handlers and sending replies
+        :param queue_size:  messages that can wait for a worker
+        :param rate_limit:  messages each sender may send per ``rate_period`` seconds
+        """
+        self.logger = logging.getLogger('sms_dispatcher')
+        self.modem = modem
+        self.workers = workers
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.handlers = []
+        self.fallback = None
+        self.lock = threading.Lock()
+        self._queue = collections.deque()
+        self._queue_size = queue_size
+        self._ready = threading.Condition(self.lock)
+        self._senders = {}
+        self._memo = {}
+        self._running = False
+        self._threads = []
+        self.reset_stats()
+
+    def register(self, pattern, function, ttl=None):
+        """
+        Calls ``function(match, sender, message)`` for messages matching ``pattern`` (a regular expression matched at
+        the start of the lower cased message). With ``ttl``, replies are reused for that many seconds.
+        """
+        handler = Handler(pattern, function, ttl)
+        self.handlers.append(handler)
+        return handler
+
+    def default(self, function):
+        """Calls ``function(None, sender, message)`` for messages no handler matches"""
+        self.fallback = Handler('', function)
+
+    def reset_stats(self):
+        self.received = 0
+        self.replied = 0
+        self.rate_limited = 0
+        self.dropped = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.latencies = collections.deque(maxlen=1000)
+
+    def stats(self):
+        """Message counts, memoized replies used, and reply latency (seconds from read to sent)"""
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {
+            'received': self.received,
+            'replied': self.replied,
+            'rate_limited': self.rate_limited,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'cache_hits': self.cache_hits,
+            'latency_mean': sum(latencies) / count if count else 0.0,
+            'latency_p95': latencies[min(count - 1, int(count * 0.95))] if count else 0.0,
+            'latency_max': latencies[-1] if count else 0.0,
+        }
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._threads = [threading.Thread(target=self._work, name='sms_dispatcher_%d' % n)
+                         for n in range(self.workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stops the workers once the messages already queued have been answered"""
+        with self.lock:
+            self._running = False
+            self._ready.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, sender, message, received=None):
+        """Queues a message for a worker. Returns False if it was dropped for the rate limit or a full queue."""
+        now = _monotonic()
+        received = received if received is not None else now
+        with self.lock:
+            self.received += 1
+            recent = self._senders.get(sender)
+            if recent is None:
+                recent = self._senders[sender] = collections.deque()
+            while recent and now - recent[0] >= self.rate_period:
+                recent.popleft()
+            if len(recent) >= self.rate_limit:
+                self.rate_limited += 1
+                self.logger.warning("[sms_dispatcher] Rate limited %s: %s", sender, message)
+                return False
+            recent.append(now)
+            if len(self._queue) >= self._queue_size:
+                self.dropped += 1
+                self.logger.warning("[sms_dispatcher] Queue full, dropped a message from %s", sender)
+                return False
+            self._queue.append((sender, message, received))
+            self._ready.notify()
+        return True
+
+    def poll(self):
+        """Reads one message from the modem and queues it. Returns True if there was one."""
+        message, sender = self.modem.pop_message()
+        if message is None or sender is None:
+            return False
+        self.submit(sender, message, _monotonic())
+        return True
+
+    def run(self, idle_sleep=1.0):
+        """Starts the workers and keeps reading the inbox, sleeping ``idle_sleep`` seconds whenever it is empty"""
+        self.start()
+        while self._running:
+            if not self.poll():
+                time.sleep(idle_sleep)
+
+    def reply_for(self, sender, message):
+        """The reply to ``message``, from its handler or the memoized replies"""
+        text = message.strip().lower()
+        for handler in self.handlers:
+            match = handler.pattern.match(text)
+            if match is not None:
+                break
+        else:
+            handler, match = self.fallback, None
+            if handler is None:
+                return None
+        if not handler.ttl:
+            handler.calls += 1
+            return handler.function(match, sender, message)
+        return self._memoized(handler, match, sender, message)
+
+    def _memoized(self, handler, match, sender, message):
+        key = (handler.pattern.pattern, match.group(0))
+        with self.lock:
+            # [reply, when it was made (None while it is being worked out), event set once it is, whether it failed]
+            entry = self._memo.get(key)
+            now = _monotonic()
+            if entry is not None and (entry[1] is None or now - entry[1] < handler.ttl):
+                self.cache_hits += 1
+                owner = False
+            else:
+                entry = self._memo[key] = [None, None, threading.Event(), False]
+                owner = True
+        if not owner:
+            entry[2].wait()
+            if entry[3]:
+                # The handler raised for whoever was working it out, so try again
+                return self._memoized(handler, match, sender, message)
+            return entry[0]
+        try:
+            handler.calls += 1
+            entry[0] = handler.function(match, sender, message)
+        except Exception:
+            entry[3] = True
+            with self.lock:
+                if self._memo.get(key) is entry:
+                    del self._memo[key]
+            raise
+        finally:
+            entry[1] = _monotonic()
+            entry[2].set()
+        return entry[0]
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while self._running and not self._queue:
+                    self._ready.wait()
+                if not self._queue:
+                    return
+                sender, message, received = self._queue.popleft()
+            try:
+                reply = self.reply_for(sender, message)
+                if reply is not None:
+                    self.modem.write_message(sender, reply)
+                    with self.lock:
+                        self.replied += 1
+                        self.latencies.append(_monotonic() - received)
+            except Exception as ex:
+                self.logger.exception("[sms_dispatcher] Failed to answer %s: %s", sender, ex)
+                with self.lock:
+                    self.errors += 1
+
+
+if __name__ == "__main__":
+    # A burst of 24 messages arriving 0.1s apart: 12 asking for the temperature, from a sensor that takes 0.5s to
+    # read, a few others, and one sender sending 8 in a row. Each reply takes 0.3s to send. First answered one at a time
+    # in the read loop, the way skywire_sms_chat used to, then through a Dispatcher with 3 workers.
+    import fake_modem
+
+    logging.basicConfig(level=logging.ERROR)
+    reads = []
+
+    def temperature(match, sender, message):
+        reads.append(sender)
+        time.sleep(0.5)
+        return 'The temperature is {:.2f} celsius with a humidity of {:.1f}%'.format(23.7, 45.0)
+
+    def what_time(match, sender, message):
+        return time.strftime('Hi! According to my watch the time is %I:%M:%S %p')
+
+    def unknown(match, sender, message):
+        return 'Sorry. I am not that smart. Roses are red...'
+
+    burst = []
+    for n in range(24):
+        if n % 3 == 2:
+            burst.append(('+1415555%04d' % 9999, 'spam %d' % n))
+        elif n % 4 == 1:
+            burst.append(('+1415555%04d' % n, 'What time is it?'))
+        else:
+            burst.append(('+1415555%04d' % n, 'What is the temperature?'))
+
+    for name in ('inline', 'dispatcher'):
+        fake = fake_modem.FakeModem(clock=time, sms_time=0.3)
+        dispatcher = Dispatcher(fake, workers=3, rate_limit=3)
+        dispatcher.register(r'what time is it', what_time)
+        dispatcher.register(r'what is the temp', temperature, ttl=10 if name == 'dispatcher' else None)
+        dispatcher.default(unknown)
+        del reads[:]
+        stime = _monotonic()
+        if name == 'inline':
+            arrivals = [stime + n * 0.1 for n in range(len(burst))]
+            latencies = []
+            for arrival, (sender, message) in zip(arrivals, burst):
+                time.sleep(max(0.0, arrival - _monotonic()))
+                fake.write_message(sender, dispatcher.reply_for(sender, message))
+                latencies.append(_monotonic() - arrival)
+            latencies.sort()
+            stats = {'replied': len(latencies), 'rate_limited': 0, 'latency_mean': sum(latencies) / len(latencies),
+                     'latency_p95': latencies[int(len(latencies) * 0.95)], 'latency_max': latencies[-1]}
+        else:
+            dispatcher.start()
+            for n, (sender, message) in enumerate(burst):
+                time.sleep(max(0.0, stime + n * 0.1 - _monotonic()))
+                dispatcher.submit(sender, message)
+            dispatcher.stop()
+            stats = dispatcher.stats()
+        print("%-10s %2d replies in %4.1fs, %d rate limited, %2d sensor reads, reply latency mean %5.2fs p95 %5.2fs "
+              "max %5.2fs" % (name, stats['replied'], _monotonic() - stime, stats['rate_limited'], len(reads),
+                              stats['latency_mean'], stats['latency_p95'], stats['latency_max']))
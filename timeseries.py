@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+timeseries.py - a small embedded time-series store for sensor and GPS samples.
+
+Each metric is a directory of append-only segments, one file per day by default. Raw samples are fixed-width
+(timestamp, value) float64 pairs, and minute and hour rollups (min, max, sum, count) are kept up to date as samples
+are appended, so "average temperature over the last hour" never has to touch the raw data. Reads memory-map the
+segments with NumPy, and segments older than the retention period are deleted as new ones are started.
+"""
+import logging
+import math
+import os
+import re
+import struct
+import time
+import numpy as np
+
+RAW_DTYPE = np.dtype([('t', '<f8'), ('v', '<f8')])
+ROLLUP_DTYPE = np.dtype([('t', '<f8'), ('min', '<f8'), ('max', '<f8'), ('sum', '<f8'), ('count', '<i8')])
+RESOLUTIONS = (60, 3600)
+
+_RAW = struct.Struct('<dd')
+_ROLLUP = struct.Struct('<ddddq')
+_NAME = re.compile(r'^[A-Za-z0-9_.-]+$')
+_SEGMENT = re.compile(r'^(raw|rollup-\d+)-(\d+)\.dat$')
+
+
+class Metric(object):
+    def __init__(self, path, name, segment_seconds, retention):
+        self.dir = os.path.join(path, name)
+        self.name = name
+        self.segment_seconds = segment_seconds
+        self.retention = retention
+        self.last = None
+        self._writers = {}
+        self._open = dict((res, None) for res in RESOLUTIONS)
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        self._recover()
+
+    def _segment(self, t):
+        return int(t // self.segment_seconds) * self.segment_seconds
+
+    def _segments(self, kind):
+        """Returns [(segment start, file name)] for ``kind`` ('raw' or 'rollup-60'), oldest first"""
+        found = []
+        for name in os.listdir(self.dir):
+            m = _SEGMENT.match(name)
+            if m and m.group(1) == kind:
+                found.append((int(m.group(2)), name))
+        return sorted(found)
+
+    def _recover(self):
+        # Finished buckets are in the rollup files. The open ones are rebuilt from the raw samples after them.
+        segments = self._segments('raw')
+        if not segments:
+            return
+        data = self._read(segments[-1][1], RAW_DTYPE)
+        if not len(data):
+            return
+        self.last = float(data['t'][-1])
+        hour = int(self.last // RESOLUTIONS[-1]) * RESOLUTIONS[-1]
+        tail = self.raw(hour, self.last + 1)
+        for res in RESOLUTIONS:
+            start = int(self.last // res) * res
+            values = tail[1][tail[0] >= start]
+            self._open[res] = [start, float(values.min()), float(values.max()), float(values.sum()), len(values)]
+
+    def _file(self, kind, seg):
+        current = self._writers.get(kind)
+        if current is None or current[0] != seg:
+            if current is not None:
+                current[1].close()
+            self._writers[kind] = (seg, open(os.path.join(self.dir, '%s-%d.dat' % (kind, seg)), 'ab'))
+            if kind == 'raw' and self.retention:
+                self.evict(seg - self.retention)
+        return self._writers[kind][1]
+
+    def append(self, t, v):
+        if self.last is not None and t < self.last:
+            raise ValueError("Sample for %s at %s is older than the last one (%s)" % (self.name, t, self.last))
+        self._file('raw', self._segment(t)).write(_RAW.pack(t, v))
+        self.last = t
+        for res in RESOLUTIONS:
+            bucket = self._open[res]
+            start = int(t // res) * res
+            if bucket is None or bucket[0] != start:
+                if bucket is not None:
+                    self._write_bucket(res, bucket)
+                self._open[res] = [start, v, v, v, 1]
+            else:
+                if v < bucket[1]:
+                    bucket[1] = v
+                if v > bucket[2]:
+                    bucket[2] = v
+                bucket[3] += v
+                bucket[4] += 1
+
+    def append_batch(self, times, values):
+        """Appends arrays of samples at once, they must be in time order"""
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        if not len(times):
+            return
+        if (self.last is not None and times[0] < self.last) or np.any(np.diff(times) < 0):
+            raise ValueError("Samples for %s are out of order" % self.name)
+
+        raw = np.empty(len(times), dtype=RAW_DTYPE)
+        raw['t'] = times
+        raw['v'] = values
+        segs = (times // self.segment_seconds).astype(np.int64) * self.segment_seconds
+        for lo, hi in _runs(segs):
+            self._file('raw', int(segs[lo])).write(raw[lo:hi].tobytes())
+        self.last = float(times[-1])
+
+        for res in RESOLUTIONS:
+            starts = (times // res).astype(np.int64) * res
+            edges = np.flatnonzero(np.r_[True, starts[1:] != starts[:-1]])
+            buckets = np.empty(len(edges), dtype=ROLLUP_DTYPE)
+            buckets['t'] = starts[edges]
+            buckets['min'] = np.minimum.reduceat(values, edges)
+            buckets['max'] = np.maximum.reduceat(values, edges)
+            buckets['sum'] = np.add.reduceat(values, edges)
+            buckets['count'] = np.diff(np.r_[edges, len(values)])
+            bucket = self._open[res]
+            if bucket is not None:
+                if bucket[0] == buckets['t'][0]:
+                    first = buckets[0]
+                    first['min'] = min(first['min'], bucket[1])
+                    first['max'] = max(first['max'], bucket[2])
+                    first['sum'] += bucket[3]
+                    first['count'] += bucket[4]
+                else:
+                    self._write_bucket(res, bucket)
+            done = buckets[:-1]
+            for lo, hi in _runs((done['t'] // self.segment_seconds).astype(np.int64)):
+                self._file('rollup-%d' % res, self._segment(done['t'][lo])).write(done[lo:hi].tobytes())
+            last = buckets[-1]
+            self._open[res] = [int(last['t']), float(last['min']), float(last['max']), float(last['sum']),
+                               int(last['count'])]
+
+    def _write_bucket(self, res, bucket):
+        self._file('rollup-%d' % res, self._segment(bucket[0])).write(_ROLLUP.pack(*bucket))
+
+    def flush(self):
+        for seg, f in self._writers.values():
+            f.flush()
+
+    def close(self):
+        for seg, f in self._writers.values():
+            f.close()
+        self._writers = {}
+
+    def evict(self, before):
+        """Deletes the segments that end at or before ``before``"""
+        for kind in ['raw'] + ['rollup-%d' % res for res in RESOLUTIONS]:
+            current = self._writers.get(kind)
+            for seg, name in self._segments(kind):
+                if seg + self.segment_seconds > before:
+                    break
+                if current is not None and current[0] == seg:
+                    continue
+                logging.getLogger('timeseries').info("[timeseries] Evicting %s/%s", self.name, name)
+                os.remove(os.path.join(self.dir, name))
+
+    def _read(self, name, dtype):
+        path = os.path.join(self.dir, name)
+        size = os.path.getsize(path) // dtype.itemsize
+        if size == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(size,))
+
+    def _scan(self, kind, dtype, start, end):
+        self.flush()
+        parts = []
+        for seg, name in self._segments(kind):
+            if seg >= end or seg + self.segment_seconds <= start:
+                continue
+            data = self._read(name, dtype)
+            t = data['t']
+            parts.append(data[np.searchsorted(t, start, 'left'):np.searchsorted(t, end, 'left')])
+        if not parts:
+            return np.zeros(0, dtype=dtype)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def raw(self, start, end):
+        """Returns (times, values) arrays for the samples in [start, end)"""
+        data = self._scan('raw', RAW_DTYPE, start, end)
+        return data['t'], data['v']
+
+    def rollup(self, start, end, res=60):
+        """Returns the ``res`` second buckets starting in [start, end) as a ROLLUP_DTYPE array, open bucket included"""
+        data = self._scan('rollup-%d' % res, ROLLUP_DTYPE, start, end)
+        bucket = self._open[res]
+        if bucket is not None and start <= bucket[0] < end:
+            data = np.concatenate((data, np.array([tuple(bucket)], dtype=ROLLUP_DTYPE)))
+        return data
+
+    def aggregate(self, start, end):
+        """Returns {'min', 'max', 'mean', 'count'} over [start, end), using the coarsest rollups that fit"""
+        lo, hi, total, count = self._aggregate(start, end, len(RESOLUTIONS) - 1)
+        return {'min': lo if count else None, 'max': hi if count else None,
+                'mean': total / count if count else None, 'count': count}
+
+    def _aggregate(self, start, end, level):
+        if level < 0:
+            t, v = self.raw(start, end)
+            if not len(v):
+                return float('inf'), float('-inf'), 0.0, 0
+            return float(v.min()), float(v.max()), float(v.sum()), len(v)
+        res = RESOLUTIONS[level]
+        a = int(math.ceil(start / float(res))) * res
+        b = int(math.floor(end / float(res))) * res
+        if a >= b:
+            return self._aggregate(start, end, level - 1)
+        parts = [self._aggregate(start, a, level - 1), self._aggregate(b, end, level - 1)]
+        buckets = self.rollup(a, b, res)
+        if len(buckets):
+            parts.append((float(buckets['min'].min()), float(buckets['max'].max()), float(buckets['sum'].sum()),
+                          int(buckets['count'].sum())))
+        return (min(p[0] for p in parts), max(p[1] for p in parts), sum(p[2] for p in parts),
+                sum(p[3] for p in parts))
+
+
+def _runs(keys):
+    """Yields (lo, hi) slices of equal consecutive ``keys``"""
+    edges = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]).tolist() + [len(keys)]
+    for n in range(len(edges) - 1):
+        yield edges[n], edges[n + 1]
+
+
+class TimeSeriesStore(object):
+    def __init__(self, path, segment_seconds=86400, retention=90 * 86400):
+        """
+        :param path:            directory for the store, created if needed
+        :param segment_seconds: time span of one segment file
+        :param retention:       seconds of data to keep, or None to keep everything
+        """
+        self.path = path
+        self.segment_seconds = segment_seconds
+        self.retention = retention
+        self.metrics = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in os.listdir(path):
+            if os.path.isdir(os.path.join(path, name)) and _NAME.match(name):
+                self.metric(name)
+
+    def metric(self, name):
+        m = self.metrics.get(name)
+        if m is None:
+            if not _NAME.match(name):
+                raise ValueError("Bad metric name: %s" % name)
+            m = self.metrics[name] = Metric(self.path, name, self.segment_seconds, self.retention)
+        return m
+
+    def append(self, name, value, t=None):
+        self.metric(name).append(time.time() if t is None else t, float(value))
+
+    def record(self, prefix, sample, t=None):
+        """
+        Stores each numeric field of a reading dict as its own metric, e.g. record('gps', modem.get_gps()) stores
+        gps.lat, gps.lng, gps.alt... and record('accel', adxl345.get_axes()) stores accel.x, accel.y and accel.z.
+        """
+        if not sample:
+            return
+        if t is None:
+            t = sample.get('now', time.time())
+        for key, value in sample.items():
+            if key != 'now' and isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.append('%s.%s' % (prefix, key), value, t)
+
+    def query(self, name, start, end):
+        return self.metric(name).raw(start, end)
+
+    def rollup(self, name, start, end, res=60):
+        return self.metric(name).rollup(start, end, res)
+
+    def aggregate(self, name, start, end):
+        return self.metric(name).aggregate(start, end)
+
+    def flush(self):
+        for m in self.metrics.values():
+            m.flush()
+
+    def close(self):
+        for m in self.metrics.values():
+            m.close()
+
+
+if __name__ == "__main__":
+    # Benchmark: a month of 1 Hz temperature data
+    import shutil
+    import tempfile
+
+    path = tempfile.mkdtemp(prefix='timeseries-')
+    try:
+        store = TimeSeriesStore(path, retention=None)
+        t0 = 1572393600
+        month = 30 * 86400
+        times = t0 + np.arange(month, dtype=np.float64)
+        values = 20 + 5 * np.sin(times / 86400.0 * 2 * np.pi) + np.random.RandomState(1).normal(0, 0.2, month)
+
+        m = store.metric('temperature')
+        n = 86400
+        stime = time.time()
+        for i in range(n):
+            m.append(times[i], values[i])
+        elapsed = time.time() - stime
+        print("append():       %d samples in %.2fs, %.0f samples/s" % (n, elapsed, n / elapsed))
+
+        stime = time.time()
+        for day in range(1, 30):
+            m.append_batch(times[day * 86400:(day + 1) * 86400], values[day * 86400:(day + 1) * 86400])
+        elapsed = time.time() - stime
+        print("append_batch(): %d samples in %.2fs, %.0f samples/s" % (month - n, elapsed, (month - n) / elapsed))
+        store.flush()
+
+        def bench(name, fn, repeat=20):
+            stime = time.time()
+            for i in range(repeat):
+                result = fn()
+            print("%-34s %8.2f ms" % (name, (time.time() - stime) / repeat * 1000))
+            return result
+
+        end = t0 + month
+        bench("raw range, last hour", lambda: store.query('temperature', end - 3600, end))
+        bench("raw range, last day", lambda: store.query('temperature', end - 86400, end))
+        bench("minute rollups, last day", lambda: store.rollup('temperature', end - 86400, end, 60))
+        bench("aggregate, last hour (unaligned)", lambda: store.aggregate('temperature', end - 3630, end - 30))
+        result = bench("aggregate, whole month", lambda: store.aggregate('temperature', t0, end))
+        print("month: %s (raw mean %.4f)" % (result, values.mean()))
+        store.close()
+
+        stime = time.time()
+        store = TimeSeriesStore(path, retention=None)
+        print("reopen: %.1f ms" % ((time.time() - stime) * 1000))
+        store.close()
+    finally:
+        shutil.rmtree(path)
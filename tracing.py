@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""
+tracing.py - records nested timing spans around the modem, I2C and sensor calls, to see where a slow device spends
+its time.
+
+Spans are recorded into a ring buffer allocated when tracing is enabled, holding the last ``capacity`` spans, with
+start and end times from the monotonic performance counter. Spans on one thread nest by time, so a stall shows up as
+e.g. oled_putString > grove_bus.wait, or serial_mutex.write_ > serial_mutex.sleep. While tracing is disabled, which is
+the default, span() returns a shared do-nothing span, which costs a function call and a flag check.
+
+    with tracing.span('grove_oled.putString', 'i2c', text):
+        ...
+
+The buffer is written out in the Chrome trace event format, which chrome://tracing and https://ui.perfetto.dev show
+as a timeline per thread: with dump(), on a signal (SIGUSR1 by default) to /tmp/bbg-trace-<pid>.json, or to whoever
+connects to the Unix socket /tmp/bbg-trace-<pid>.sock:
+
+    $ BBG_TRACE=20000 python skywire_sms_chat.py        # enables tracing and installs both, keeping 20000 spans
+    $ kill -USR1 <pid>                                  # or
+    $ python tracing.py dump <pid> -o trace.json
+"""
+import itertools
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from array import array
+
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+
+_clock = getattr(time, 'perf_counter', None) or getattr(time, 'monotonic', time.time)
+
+DEFAULT_CAPACITY = 10000
+DUMP_PATH = '/tmp/bbg-trace-%d.json'
+SOCKET_PATH = '/tmp/bbg-trace-%d.sock'
+
+logger = logging.getLogger('tracing')
+
+enabled = False
+
+_capacity = 0
+_counter = itertools.count()
+_names = []
+_cats = []
+_details = []
+_tids = []
+_starts = array('d')
+_ends = array('d')
+_thread_names = {}
+_server = None
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def set(self, detail):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    __slots__ = ('name', 'cat', 'detail', 'start')
+
+    def __init__(self, name, cat, detail):
+        self.name = name
+        self.cat = cat
+        self.detail = detail
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        detail = self.detail
+        if exc_type is not None:
+            detail = '%s (%s)' % (detail, exc_type.__name__) if detail is not None else exc_type.__name__
+        record(self.name, self.cat, self.start, _clock(), detail)
+        return False
+
+    def set(self, detail):
+        """Replaces the span's detail, e.g. with the outcome of the call"""
+        self.detail = detail
+
+
+def span(name, cat='', detail=None):
+    """
+    A context manager timing its block as a span. ``detail`` (anything, shown as a string) is kept with it; pass
+    values as they are rather than formatting them, so nothing is spent on them while tracing is disabled.
+    """
+    if not enabled:
+        return _NULL_SPAN
+    return Span(name, cat, detail)
+
+
+def record(name, cat, start, end, detail=None):
+    """Records a span timed elsewhere, with start and end from clock()"""
+    if not enabled:
+        return
+    # next() on a count is atomic, so threads never write the same slot
+    slot = next(_counter) % _capacity
+    _names[slot] = None
+    _cats[slot] = cat
+    _details[slot] = detail
+    tid = _tids[slot] = get_ident()
+    if tid not in _thread_names:
+        _thread_names[tid] = threading.current_thread().name
+    _starts[slot] = start
+    _ends[slot] = end
+    _names[slot] = name
+
+
+def clock():
+    """The clock spans are timed with, in seconds"""
+    return _clock()
+
+
+class TracedLock(object):
+    """A threading.Lock that records the time spent waiting for it as a span, for locks that callers contend for"""
+    def __init__(self, name, cat=''):
+        self.name = name
+        self.cat = cat
+        self._lock = threading.Lock()
+
+    def acquire(self, blocking=True):
+        if not enabled:
+            return self._lock.acquire(blocking)
+        start = _clock()
+        acquired = self._lock.acquire(blocking)
+        record(self.name, self.cat, start, _clock())
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+        return False
+
+
+def enable(capacity=DEFAULT_CAPACITY):
+    """Starts recording into a new buffer of ``capacity`` spans"""
+    global enabled, _capacity, _counter, _names, _cats, _details, _tids, _starts, _ends
+    if capacity < 1:
+        raise ValueError("The trace buffer needs room for at least one span")
+    enabled = False
+    _capacity = capacity
+    _names = [None] * capacity
+    _cats = [None] * capacity
+    _details = [None] * capacity
+    _tids = [0] * capacity
+    _starts = array('d', [0.0]) * capacity
+    _ends = array('d', [0.0]) * capacity
+    _counter = itertools.count()
+    enabled = True
+
+
+def disable():
+    """Stops recording. What was recorded stays in the buffer until the next enable()."""
+    global enabled
+    enabled = False
+
+
+def events():
+    """The recorded spans, oldest first, as Chrome trace complete events"""
+    if not _capacity:
+        return []
+    # Taking a number leaves its slot empty, which the loop skips
+    count = next(_counter)
+    _names[count % _capacity] = None
+    pid = os.getpid()
+    result = []
+    for n in range(max(0, count - _capacity), count):
+        slot = n % _capacity
+        name = _names[slot]
+        if name is None:
+            continue
+        event = {'name': name, 'cat': _cats[slot] or 'default', 'ph': 'X', 'pid': pid, 'tid': _tids[slot],
+                 'ts': _starts[slot] * 1e6, 'dur': (_ends[slot] - _starts[slot]) * 1e6}
+        detail = _details[slot]
+        if detail is not None:
+            event['args'] = {'detail': detail if isinstance(detail, (int, float)) else str(detail)}
+        result.append(event)
+    result.sort(key=lambda e: e['ts'])
+    return result
+
+
+def trace():
+    """The whole trace: the spans plus the names of the threads that recorded them"""
+    pid = os.getpid()
+    spans = events()
+    threads = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+               for tid, name in list(_thread_names.items())]
+    return {'traceEvents': threads + spans, 'displayTimeUnit': 'ms',
+            'otherData': {'capacity': _capacity, 'enabled': enabled}}
+
+
+def dump(path=None):
+    """Writes the trace as JSON to ``path`` (or an open file), by default /tmp/bbg-trace-<pid>.json"""
+    if path is None:
+        path = DUMP_PATH % os.getpid()
+    data = trace()
+    if hasattr(path, 'write'):
+        json.dump(data, path)
+    else:
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        logger.info("[tracing] Wrote %d spans to %s", len(data['traceEvents']), path)
+    return path
+
+
+def install_signal(signum=signal.SIGUSR1, path=None):
+    """Dumps the trace whenever the process gets ``signum``. Must be called from the main thread."""
+    def handler(received, frame):
+        try:
+            dump(path)
+        except Exception as ex:
+            logger.exception("[tracing] Failed to dump the trace: %s", ex)
+    signal.signal(signum, handler)
+
+
+def serve(path=None):
+    """
+    Listens on the Unix socket ``path`` (by default /tmp/bbg-trace-<pid>.sock) on a background thread, sending the
+    trace as JSON to each connection and closing it
+    """
+    global _server
+    if _server is not None:
+        return _server.getsockname()
+    if path is None:
+        path = SOCKET_PATH % os.getpid()
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    _server = server
+
+    def run():
+        while True:
+            try:
+                connection, address = server.accept()
+            except (IOError, OSError):
+                return
+            try:
+                connection.sendall(json.dumps(trace()).encode())
+            except Exception as ex:
+                logger.exception("[tracing] Failed to send the trace: %s", ex)
+            finally:
+                connection.close()
+
+    thread = threading.Thread(target=run, name='tracing')
+    thread.daemon = True
+    thread.start()
+    return path
+
+
+def fetch(path):
+    """The trace from the process serving on the Unix socket ``path``, as JSON text"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    chunks = []
+    try:
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        client.close()
+    return b''.join(chunks).decode()
+
+
+def start_from_environment(variable='BBG_TRACE'):
+    """
+    If ``variable`` is set (to the number of spans to keep, or anything else for the default), enables tracing and
+    installs the signal handler and the socket
+    """
+    value = os.environ.get(variable)
+    if not value:
+        return False
+    enable(int(value) if value.isdigit() else DEFAULT_CAPACITY)
+    try:
+        install_signal()
+    except ValueError:
+        # Not imported on the main thread, so only the socket is available
+        pass
+    serve()
+    return True
+
+
+if __name__ != "__main__":
+    start_from_environment()
+
+
+def benchmark():
+    # The cost of a span while tracing is disabled and enabled, against an empty with block, then spans from threads
+    # contending for a SerialMutex on a fake port, an OLED and a flaky DHT22 dumped to trace.json
+    import fake_gpio
+    import fake_i2c
+    import fake_modem
+    import grove_bus
+    import grove_dht
+    import grove_oled
+    import serial_mutex
+
+    class Empty(object):
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_value, tb):
+            return False
+
+    calls = 200000
+    empty = Empty()
+    stime = _clock()
+    for n in range(calls):
+        with empty:
+            pass
+    baseline = (_clock() - stime) / calls
+    for state in ('disabled', 'enabled'):
+        if state == 'enabled':
+            enable(calls)
+        else:
+            disable()
+        stime = _clock()
+        for n in range(calls):
+            with span('bench', 'bench', n):
+                pass
+        elapsed = (_clock() - stime) / calls
+        print("span %-8s %6.0f ns, %6.0f ns more than an empty with block" % (
+            state, elapsed * 1e9, (elapsed - baseline) * 1e9))
+
+    logging.basicConfig(level=logging.WARNING)
+    enable(DEFAULT_CAPACITY)
+    bus = fake_i2c.FakeSMBus(clock=time)
+    bus.attach(grove_oled.Oled_Address, fake_i2c.FakeSSD1327())
+    grove_bus.set_smbus(bus, grove_oled.Oled_Bus)
+    grove_oled.oled_init()
+    ser = serial_mutex.SerialMutex(fake_modem.FakeSerial())
+    dht = grove_dht.DHTReader(dht=fake_gpio.FakeDHT22(fail_every=2))
+    dht.interval = dht.retry_interval = 0.2
+    dht.start()
+    end = _clock() + 1.0
+
+    def modem():
+        while _clock() < end:
+            ser.write_wait('AT+CSQ\r', 0.05)
+
+    def display(row):
+        while _clock() < end:
+            with grove_oled.oled_hold():
+                grove_oled.oled_setTextXY(row, 0)
+                grove_oled.oled_putString('Line %d %.2f' % (row, _clock()))
+
+    threads = [threading.Thread(target=modem, name='modem_%d' % n) for n in range(2)]
+    threads += [threading.Thread(target=display, args=(n,), name='display_%d' % n) for n in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    dht.stop()
+    disable()
+    totals = {}
+    for event in events():
+        count, total, longest = totals.get(event['name'], (0, 0.0, 0.0))
+        totals[event['name']] = (count + 1, total + event['dur'], max(longest, event['dur']))
+    for name in sorted(totals):
+        count, total, longest = totals[name]
+        print("%-28s %5d spans, %9.1f ms total, longest %8.2f ms" % (name, count, total / 1000, longest / 1000))
+    print("Wrote %s, open it in chrome://tracing or ui.perfetto.dev" % dump('trace.json'))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        # The traced modules record into the imported tracing, not this __main__ copy of it
+        import tracing
+        tracing.benchmark()
+        sys.exit(0)
+    if len(sys.argv) > 2 and sys.argv[1] == 'dump':
+        # python tracing.py dump <pid or socket path> [-o file]
+        target = sys.argv[2]
+        text = fetch(SOCKET_PATH % int(target) if target.isdigit() else target)
+        if len(sys.argv) > 4 and sys.argv[3] == '-o':
+            with open(sys.argv[4], 'w') as f:
+                f.write(text)
+        else:
+            sys.stdout.write(text)
+        sys.exit(0)
+    print("usage: python tracing.py bench | dump <pid or socket> [-o trace.json]")
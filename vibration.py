@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+vibration.py - turns the accelerometer stream into a few numbers per window that are small enough to send over the
+modem: RMS, peak and crest factor of the vibration, its dominant frequency, tilt, motion, taps and free fall.
+
+Samples are gathered into windows of ``window`` samples that overlap by ``overlap``. The sums, minimums and maximums
+are kept per hop (the part of a window that is new each time) and combined, so each sample is only summed once
+whatever the overlap. Each window gets one real FFT on the axis that vibrates most, using preallocated buffers.
+
+VibrationMonitor runs the whole chain from an ADXL345: FIFO streaming, block conversion and feature extraction. With
+``gate`` it uses the chip's activity/inactivity detection to skip the work while nothing moves, and reports taps and
+free falls the chip detected.
+"""
+import collections
+import math
+import time
+
+import numpy as np
+
+_process_time = getattr(time, 'process_time', time.time)
+
+
+class FeatureExtractor(object):
+    def __init__(self, rate, window=512, overlap=0.5, motion_rms=0.02, tap_g=1.5, freefall_g=0.4):
+        """
+        :param rate:        samples per second
+        :param window:      samples per window
+        :param overlap:     fraction of each window shared with the next one, which must leave a whole number of hops
+                            per window (0, 0.5 and 0.75 do for power of two windows)
+        :param motion_rms:  vibration RMS (g) above which a window counts as moving
+        :param tap_g:       peak (g) above which a window counts as having a shock or tap
+        :param freefall_g:  acceleration magnitude (g) below which a window counts as having a free fall
+        """
+        hop = int(round(window * (1 - overlap)))
+        if hop <= 0 or window % hop:
+            raise ValueError("The overlap must leave a whole number of hops per window")
+        self.rate = float(rate)
+        self.window = window
+        self.hop = hop
+        self.motion_rms = motion_rms
+        self.tap_g = tap_g
+        self.freefall_g = freefall_g
+
+        self.samples = np.zeros((window, 3), dtype=np.float32)
+        self.pending = np.zeros((hop, 3), dtype=np.float32)
+        self.filled = 0
+        self.hops = collections.deque(maxlen=window // hop)
+        self.taper = np.hanning(window).astype(np.float32)
+        self.fft_in = np.zeros(window, dtype=np.float32)
+        self.freqs = np.fft.rfftfreq(window, 1.0 / self.rate)
+        self.windows = 0
+        self.cpu_time = 0.0
+
+    def reset(self):
+        """Drops the partly filled windows, e.g. after a gap in the samples"""
+        self.filled = 0
+        self.hops.clear()
+
+    def add(self, timestamp, samples):
+        """
+        Adds an (N, 3) array of samples in g, the first taken at ``timestamp``. Returns the records of the windows
+        that completed.
+        """
+        stime = _process_time()
+        records = []
+        offset = 0
+        count = len(samples)
+        while offset < count:
+            take = min(self.hop - self.filled, count - offset)
+            self.pending[self.filled:self.filled + take] = samples[offset:offset + take]
+            self.filled += take
+            offset += take
+            if self.filled == self.hop:
+                self._hop_done()
+                if len(self.hops) == self.hops.maxlen:
+                    end = timestamp + (offset - 1) / self.rate
+                    records.append(self._features(end - (self.window - 1) / self.rate))
+        self.cpu_time += _process_time() - stime
+        return records
+
+    def _hop_done(self):
+        block = self.pending
+        magnitude = np.sqrt(np.einsum('ij,ij->i', block, block))
+        self.hops.append((block.sum(axis=0, dtype=np.float64), np.einsum('ij,ij->j', block, block, dtype=np.float64),
+                          block.min(axis=0), block.max(axis=0), magnitude.min()))
+        # Slide the window along by a hop
+        self.samples[:-self.hop] = self.samples[self.hop:]
+        self.samples[-self.hop:] = block
+        self.filled = 0
+
+    def _features(self, start):
+        self.windows += 1
+        n = float(self.window)
+        total = sum(h[0] for h in self.hops)
+        squares = sum(h[1] for h in self.hops)
+        low = np.min([h[2] for h in self.hops], axis=0)
+        high = np.max([h[3] for h in self.hops], axis=0)
+        min_magnitude = min(h[4] for h in self.hops)
+
+        mean = total / n
+        variance = np.maximum(squares / n - mean * mean, 0.0)
+        rms = math.sqrt(variance.sum())
+        peak = float(max((high - mean).max(), (mean - low).max()))
+
+        # Dominant frequency on the axis that varies most
+        axis = int(variance.argmax())
+        np.subtract(self.samples[:, axis], np.float32(mean[axis]), out=self.fft_in)
+        self.fft_in *= self.taper
+        spectrum = np.abs(np.fft.rfft(self.fft_in))
+        spectrum[0] = 0.0
+        frequency = float(self.freqs[spectrum.argmax()])
+
+        x, y, z = mean
+        return {
+            't': round(start, 3),
+            'rms': round(rms, 4),
+            'peak': round(peak, 4),
+            'crest': round(peak / rms, 2) if rms > 0 else 0.0,
+            'freq': round(frequency, 1),
+            'axis': 'xyz'[axis],
+            'pitch': round(math.degrees(math.atan2(-x, math.sqrt(y * y + z * z))), 1),
+            'roll': round(math.degrees(math.atan2(y, z)), 1),
+            'motion': bool(rms > self.motion_rms),
+            'shock': bool(peak > self.tap_g),
+            'freefall': bool(min_magnitude < self.freefall_g),
+        }
+
+
+class VibrationMonitor(object):
+    def __init__(self, adxl345, rate_flag=None, window=512, overlap=0.5, gate=False, idle_interval=10.0,
+                 clock=None, sleep=None, **kwargs):
+        """
+        :param adxl345:         a grove_accel.ADXL345
+        :param rate_flag:       one of grove_accel.BW_RATE_*, 800Hz by default
+        :param gate:            only extract features between the chip's activity and inactivity events, and send an
+                                idle record every ``idle_interval`` seconds in between
+        :param clock, sleep:    passed to ADXL345.stream, to run against a simulated device
+        """
+        import grove_accel
+        self.accel = grove_accel
+        self.adxl345 = adxl345
+        self.rate_flag = rate_flag if rate_flag is not None else grove_accel.BW_RATE_800HZ
+        self.gate = gate
+        self.idle_interval = idle_interval
+        self.clock = clock
+        self.sleep = sleep
+        self.extractor = FeatureExtractor(grove_accel.RATE_HZ[self.rate_flag], window, overlap, **kwargs)
+        self.samples = 0
+        self.skipped = 0
+        self.active = True
+
+    def run(self):
+        """Yields a feature record per window (plus idle records when gated)"""
+        accel = self.accel
+        taps = 0
+        falls = 0
+        last_idle = None
+        if self.gate:
+            self.adxl345.enable_motion_interrupts()
+            self.adxl345.interrupt_source()
+            self.active = False
+        for timestamp, data, count in self.adxl345.stream(self.rate_flag, clock=self.clock, sleep=self.sleep):
+            self.samples += count
+            if self.gate:
+                source = self.adxl345.interrupt_source()
+                taps += bool(source & (accel.INT_SINGLE_TAP | accel.INT_DOUBLE_TAP))
+                falls += bool(source & accel.INT_FREE_FALL)
+                if source & accel.INT_ACTIVITY:
+                    self.active = True
+                elif source & accel.INT_INACTIVITY:
+                    self.active = False
+                    self.extractor.reset()
+                if not self.active:
+                    self.skipped += count
+                    if last_idle is None or timestamp - last_idle >= self.idle_interval or taps or falls:
+                        last_idle = timestamp
+                        yield {'t': round(timestamp, 3), 'motion': False, 'taps': taps, 'falls': falls}
+                        taps = falls = 0
+                    continue
+            for record in self.extractor.add(timestamp, self.adxl345.convert(data, gforce=True)):
+                if self.gate:
+                    record['taps'] = taps
+                    record['falls'] = falls
+                    taps = falls = 0
+                yield record
+
+
+if __name__ == "__main__":
+    # 20 simulated seconds from a simulated ADXL345 at 800Hz on a 400kHz bus: 30Hz vibration, then still with a tap,
+    # then 80Hz vibration. Run with and without gating on the chip's activity detection.
+    import grove_accel
+    import fake_i2c
+    import fake_modem
+
+    def signal(t):
+        if t < 6:
+            return 0.3 * math.sin(2 * math.pi * 30 * t), 0.0, 1.0
+        if t < 14:
+            if 10.0 <= t < 10.004:
+                return 4.0, 0.0, 1.0
+            return 0.0, 0.0, 1.0
+        return 0.0, 0.4 * math.sin(2 * math.pi * 80 * t), 1.0
+
+    for gate in (False, True):
+        clock = fake_modem.FakeClock()
+        bus = fake_i2c.FakeSMBus(clock=clock, clock_hz=400000)
+        bus.attach(grove_accel.ADXL345_DEVICE, fake_i2c.FakeADXL345(clock, signal))
+        adxl345 = grove_accel.ADXL345(bus=bus)
+        monitor = VibrationMonitor(adxl345, window=1024, overlap=0.5, gate=gate, clock=clock.time, sleep=clock.sleep)
+        records = []
+        cpu = _process_time()
+        for record in monitor.run():
+            records.append(record)
+            if clock.time() >= 20:
+                break
+        cpu = _process_time() - cpu
+        extractor = monitor.extractor
+        print("gate=%s: %d records from %d samples (%d skipped), %d windows, %.2f ms CPU per window for a %.2f s "
+              "window, %.1f%% of one core overall" % (
+                  gate, len(records), monitor.samples, monitor.skipped, extractor.windows,
+                  extractor.cpu_time / max(1, extractor.windows) * 1000, extractor.window / extractor.rate,
+                  cpu / clock.time() * 100))
+        # Every third window, and anything the chip detected
+        for n, record in enumerate(records):
+            if n % 3 == 0 or 'rms' not in record or record.get('taps') or record.get('falls'):
+                print("    %s" % sorted(record.items()))